@@ -0,0 +1,137 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bedrockclient as bd
+import manageConfig as mc
+import requestScheduler
+import resilience
+import responseCache
+from logging_setup import get_logger
+
+# Set up logging configuration (shared, non-blocking pipeline)
+logger = get_logger(__name__)
+
+# Sentinel placed on the event queue when the underlying stream is exhausted
+_STREAM_END = object()
+
+# Async wrappers shared per endpoint URL
+_async_clients = {}
+_async_clients_lock = threading.Lock()
+
+# Async wrapper around the pooled Bedrock runtime client for one endpoint
+# botocore is synchronous, so each call is offloaded to a thread pool sized to the client's connection pool.
+# Every call reuses the same client, and therefore the same keep-alive HTTP connections to the endpoint.
+class AsyncBedrockRuntime:
+
+    # Args:
+    #   b_endpoint_url: The endpoint URL for the Bedrock runtime service (VPCE or public URL)
+    #   bedrock_runtime: Optional pre-built runtime client; the pooled client for the endpoint is used when omitted
+    def __init__(self, b_endpoint_url, bedrock_runtime=None):
+        self.endpoint_url = b_endpoint_url
+        self.client = bedrock_runtime or bd.get_pooled_runtime_client(b_endpoint_url)
+        # One worker thread per pooled connection so no caller waits on a connection held by a thread that is idle
+        max_workers = self.client.meta.config.max_pool_connections
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bedrock-runtime')
+
+    # Function to call Converse without blocking the event loop
+    # Args:
+    #   ticket: Optional requestScheduler Ticket of the request
+    #   request: The keyword arguments for converse (see invoke.build_converse_request)
+    # Returns:
+    #   The Converse response dictionary
+    async def converse(self, ticket=None, **request):
+        loop = asyncio.get_running_loop()
+        grant = await self._admit(ticket, request)
+        return await loop.run_in_executor(self._executor, lambda: requestScheduler.scheduled_call(
+            grant, request, lambda: resilience.get_controller().converse(self.client, request)))
+
+    # Function to call ConverseStream and yield its events without blocking the event loop
+    # The stream goes through the response cache (a hit is replayed without a call) and is read on a worker
+    # thread that hands the events to the loop through a queue. If the caller stops iterating early, the worker
+    # closes the stream at the next event so the underlying HTTP connection is released.
+    # Args:
+    #   ticket: Optional requestScheduler Ticket (or Grant already held) of the request
+    #   request: The keyword arguments for converse_stream
+    # Returns:
+    #   An async generator of ConverseStream event dictionaries
+    async def converse_stream(self, ticket=None, **request):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        cancelled = threading.Event()
+        grant = await self._admit(ticket, request)
+        try:
+            stream, _cached = await loop.run_in_executor(
+                self._executor, lambda: responseCache.converse_stream_cached(self.client, request, grant))
+        except BaseException:
+            if grant is not None:
+                grant.release()
+            raise
+
+        def pump():
+            try:
+                for event in stream:
+                    if cancelled.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, event)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                # The stream is a generator, so it must be closed on the thread that iterates it
+                stream.close()
+                # A live call has released the slot with its usage already; a cache hit or a coalesced request
+                # never used it
+                if grant is not None:
+                    grant.release()
+                loop.call_soon_threadsafe(queue.put_nowait, _STREAM_END)
+
+        loop.run_in_executor(self._executor, pump)
+        try:
+            while True:
+                event = await queue.get()
+                if event is _STREAM_END:
+                    break
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+        finally:
+            cancelled.set()
+
+    # Function to wait for the request scheduler on the event loop, so queued requests do not tie up worker threads
+    # Returns:
+    #   The Grant (the ticket itself when it already is one), or None when scheduling is not enabled
+    async def _admit(self, ticket, request):
+        scheduler = requestScheduler.get_scheduler()
+        if scheduler is None or isinstance(ticket, requestScheduler.Grant):
+            return ticket
+        return await scheduler.admit_async(ticket, request)
+
+    # Function to release the worker threads; the pooled HTTP client stays available to other callers
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+# Function to return the shared async wrapper for an endpoint, creating it on first use
+# Args:
+#   b_endpoint_url: The endpoint URL for the Bedrock runtime service
+# Returns:
+#   The AsyncBedrockRuntime for the endpoint
+def get_async_runtime_client(b_endpoint_url):
+    with _async_clients_lock:
+        client = _async_clients.get(b_endpoint_url)
+        if client is None:
+            client = AsyncBedrockRuntime(b_endpoint_url)
+            _async_clients[b_endpoint_url] = client
+            logger.info(f"Created async Bedrock runtime client for {b_endpoint_url}")
+        return client
+
+# Function called by manageConfig when the configuration is reloaded
+# The wrappers hold on to the pooled client they were built with, so they are dropped when that client is
+def _on_settings_changed(old_settings, new_settings, changed):
+    if changed & bd._CLIENT_SETTINGS:
+        with _async_clients_lock:
+            stale = list(_async_clients.values())
+            _async_clients.clear()
+        for client in stale:
+            client.close()
+
+mc.subscribe(_on_settings_changed)
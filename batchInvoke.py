@@ -0,0 +1,252 @@
+import argparse
+import json
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+import botocore
+
+import bedrockclient as bd
+import endpointPool
+import hedging
+import manageConfig as mc
+import metrics
+import modelRegistry
+import requestScheduler
+import resilience
+import responseCache
+import structuredOutput
+from invoke import build_converse_request, prompt_caching_enabled
+from myutils import render_prompt
+from promptTemplate import load_template
+from streamSinks import AccumulatorSink, consume, parse_events
+from logging_setup import setup_logging
+
+# Set up logging using the imported function
+setup_logging(log_level=logging.INFO)
+
+# Function to read batch inputs from a JSONL file
+# Args:
+#   input_file: Path to the JSONL file (one JSON object per line)
+#   id_field: Name of the field holding the record id (the line number is used when it is missing)
+#   text_field: Name of the field holding the text substituted for {{log_entry}} in the prompt template
+# Returns:
+#   A generator of (record_id, text, error) tuples; error is None when the line was parsed successfully
+def read_batch_inputs(input_file, id_field, text_field):
+    with open(input_file, 'r') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, None, {"code": "InvalidInput", "message": f"Line {line_number} is not valid JSON: {e}"}
+                continue
+            record_id = record.get(id_field, line_number)
+            if text_field not in record:
+                yield record_id, None, {"code": "InvalidInput", "message": f"Field '{text_field}' not found on line {line_number}"}
+                continue
+            yield record_id, str(record[text_field]), None
+
+# Function to send a single rendered prompt to the model without terminating the process on failure
+# Args:
+#   bedrock_runtime: The Bedrock runtime client (shared across worker threads)
+#   request: The keyword arguments built by build_converse_request
+#   use_stream: Use converse_stream instead of converse
+#   ticket: Optional requestScheduler Ticket of the request
+# Returns:
+#   A dictionary with the output text, stop reason, token usage and latency
+def converse_once(bedrock_runtime, request, use_stream=False, ticket=None):
+    # With [structured] Enabled the JSON answer is parsed and validated (and a stream is stopped once it is in)
+    structured = structuredOutput.get_structured_settings()
+
+    # Cached responses are stored as stream events, so the stream path is used whenever the cache is enabled
+    if not use_stream and responseCache.get_response_cache() is None:
+        response = requestScheduler.scheduled_call(
+            ticket, request, lambda: resilience.get_controller().converse(bedrock_runtime, request))
+        result = {
+            "output": "".join(block.get("text", "") for block in response["output"]["message"]["content"]),
+            "stop_reason": response.get("stopReason"),
+            "usage": response.get("usage"),
+            "latency_ms": response.get("metrics", {}).get("latencyMs"),
+        }
+        if structured.enabled:
+            result["structured"] = structuredOutput.parse_response(result["output"], structured.schema)
+        return result
+
+    started = time.perf_counter()
+    stream, cached = responseCache.converse_stream_cached(bedrock_runtime, request, ticket)
+    accumulator = AccumulatorSink()
+    sinks = [accumulator]
+    if not cached:
+        labels = {"model_id": request["modelId"], "endpoint": metrics.endpoint_label(bedrock_runtime.meta.endpoint_url)}
+        metrics.observe_phase('request_send', time.perf_counter() - started, **labels)
+        sinks.append(metrics.StreamTimingSink(started, **labels))
+    if structured.enabled:
+        sinks.append(structuredOutput.StructuredResponseSink(structured.schema, stop_early=structured.stop_early))
+    consume(parse_events(stream), sinks)
+    result = {**accumulator.result(), "cached": cached}
+    if structured.enabled:
+        result["structured"] = sinks[-1].result()
+    return result
+
+# Function to process one batch record, recording failures in the result instead of exiting
+# Args:
+#   bedrock_runtime: The Bedrock runtime client
+#   model_id: The ID of the model to invoke
+#   system_prompt: The system prompt text
+#   template: The compiled prompt template
+#   record_id: The id of the record being processed
+#   text: The text to substitute into the template
+#   use_stream: Use converse_stream instead of converse
+#   priority: The requestScheduler priority class of the batch
+#   tenant: The tenant the batch is scheduled as
+# Returns:
+#   The result dictionary written to the output file
+def process_record(bedrock_runtime, model_id, system_prompt, template, record_id, text, use_stream=False,
+                   priority=None, tenant=None):
+    started = time.perf_counter()
+    result = {"id": record_id, "model_id": model_id}
+    try:
+        static_prefix = template.static_prefix if prompt_caching_enabled() else None
+        request = build_converse_request(model_id, system_prompt, render_prompt(template, text), static_prefix)
+        # The deadline of the record (if its class has one) runs from the moment a worker picks it up
+        ticket = requestScheduler.make_ticket(priority, tenant)
+        result.update(converse_once(bedrock_runtime, request, use_stream, ticket))
+        result["status"] = "ok"
+    except botocore.exceptions.ClientError as error:
+        logging.error(f"Failed to invoke model {model_id} for record {record_id}: {error}")
+        result["status"] = "error"
+        result["error"] = {"code": error.response.get("Error", {}).get("Code", "ClientError"), "message": str(error)}
+    except Exception as e:
+        logging.error(f"Unexpected error for record {record_id}: {e}")
+        result["status"] = "error"
+        result["error"] = {"code": type(e).__name__, "message": str(e)}
+    result["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+# Function to run every record of the input file through the model with a bounded worker pool
+# Results are written in input order; at most workers * 4 records are in flight at any time
+# Args:
+#   bedrock_runtime: The Bedrock runtime client
+#   model_id: The ID of the model to invoke
+#   system_prompt: The system prompt text
+#   template: The compiled prompt template
+#   inputs: Iterable of (record_id, text, error) tuples
+#   output: Writable text file receiving one JSON result per line
+#   workers: Number of concurrent requests
+#   use_stream: Use converse_stream instead of converse
+#   priority: The requestScheduler priority class of the batch
+#   tenant: The tenant the batch is scheduled as
+# Returns:
+#   A tuple (succeeded, failed) with the number of records in each state
+def run_batch(bedrock_runtime, model_id, system_prompt, template, inputs, output, workers=4, use_stream=False,
+              priority=None, tenant=None):
+    succeeded = failed = 0
+    pending = deque()
+
+    def write_result(result):
+        nonlocal succeeded, failed
+        if result["status"] == "ok":
+            succeeded += 1
+        else:
+            failed += 1
+        output.write(json.dumps(result) + "\n")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for record_id, text, error in inputs:
+            if error is not None:
+                pending.append({"id": record_id, "model_id": model_id, "status": "error", "error": error})
+            else:
+                pending.append(executor.submit(process_record, bedrock_runtime, model_id, system_prompt,
+                                               template, record_id, text, use_stream, priority, tenant))
+            # Drain completed results from the head of the queue to keep the output in input order
+            while pending and (len(pending) > workers * 4 or isinstance(pending[0], dict) or pending[0].done()):
+                head = pending.popleft()
+                write_result(head if isinstance(head, dict) else head.result())
+        while pending:
+            head = pending.popleft()
+            write_result(head if isinstance(head, dict) else head.result())
+    return succeeded, failed
+
+# Function to resolve a model alias from the [models] section to its model id
+# Args:
+#   model: A model alias (e.g. Claude-3-Haiku) or a full model id
+# Returns:
+#   The model id
+def resolve_model_id(model):
+    return modelRegistry.get_registry().resolve(model)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a JSONL file of log entries through a Bedrock model concurrently.')
+    parser.add_argument('--input', required=True, help='JSONL file with one input record per line')
+    parser.add_argument('--output', required=True, help='JSONL file to write results to (in input order)')
+    parser.add_argument('--model', required=True, help='Model alias from the [models] section or a model id')
+    parser.add_argument('--config', default='config.properties', help='Configuration file (default: config.properties)')
+    parser.add_argument('--workers', type=int, default=4, help='Number of concurrent requests (default: 4)')
+    parser.add_argument('--id-field', default='request_id', help='Input field holding the record id (default: request_id)')
+    parser.add_argument('--text-field', default='log_entry', help='Input field substituted for {{log_entry}} (default: log_entry)')
+    parser.add_argument('--prompt-file', default='prompt.txt', help='Prompt template file (default: prompt.txt)')
+    parser.add_argument('--system-file', default='system.txt', help='System prompt file (default: system.txt)')
+    parser.add_argument('--stream', action='store_true', help='Use ConverseStream instead of Converse')
+    parser.add_argument('--priority', default='bulk', help='Scheduler priority class when [scheduler] is enabled (default: bulk)')
+    parser.add_argument('--tenant', default='batch', help='Tenant the batch is scheduled as (default: batch)')
+    args = parser.parse_args()
+
+    try:
+        if args.workers < 1:
+            print("--workers must be at least 1")
+            sys.exit(1)
+
+        # Ensure the config file is not empty and valid
+        if not mc._initialize_config(args.config):
+            print(f'Please make sure the provided config file path is correct and not empty, exiting .... ')
+            sys.exit(1)
+
+        # Set up the metrics exporter configured in the optional [metrics] section
+        metrics.configure_exporter()
+
+        # Reject an unknown priority class before any record is sent
+        requestScheduler.make_ticket(args.priority, args.tenant)
+
+        model_id = resolve_model_id(args.model)
+        # Reject a model that cannot be called this way before any record is sent
+        modelRegistry.get_model(model_id).check(streaming=args.stream or responseCache.get_response_cache() is not None)
+        b_endpoint_url = bd.get_runtime_endpoint_url()
+
+        # Size the connection pool so every worker can hold its own connection to the endpoint
+        # (with an [endpoints] pool, each endpoint's client is sized by [client] MaxPoolConnections instead)
+        bedrock_runtime = endpointPool.get_runtime(b_endpoint_url, {'max_pool_connections': args.workers})
+
+        # Load and compile the templates once for the whole batch
+        system_prompt = load_template(args.system_file).text
+        template = load_template(args.prompt_file)
+
+        logging.info(f"Starting batch {args.input} -> {args.output} with model {model_id} and {args.workers} workers")
+        started = time.perf_counter()
+        with open(args.output, 'w') as output:
+            succeeded, failed = run_batch(bedrock_runtime, model_id, system_prompt, template,
+                                          read_batch_inputs(args.input, args.id_field, args.text_field),
+                                          output, args.workers, args.stream, args.priority, args.tenant)
+        elapsed = time.perf_counter() - started
+        logging.info(f"Batch finished: {succeeded} succeeded, {failed} failed in {elapsed:.1f}s")
+        print(f"Batch finished: {succeeded} succeeded, {failed} failed in {elapsed:.1f}s. Results written to {args.output}")
+        if responseCache.get_response_cache() is not None:
+            stats = responseCache.get_response_cache().stats()
+            print(f"Response cache: hit rate {stats['hit_rate']:.1%}, {stats['bytes_saved']} bytes and {stats['tokens_saved']} tokens saved")
+        if hedging.get_hedger() is not None and hedging.get_hedger().stats()['requests']:
+            stats = hedging.get_hedger().stats()
+            print(f"Hedging: {stats['hedged']} of {stats['requests']} requests hedged ({stats['hedge_rate']:.1%}), "
+                  f"hedge won {stats['win_rate']:.1%}, {stats['denied']} hedges over budget")
+
+    except FileNotFoundError as e:
+        logging.error(f"File not found: {e}")
+        print(f"File not found: {e}")
+        sys.exit(1)
+    except Exception as e:
+        logging.error(f"Unexpected error in the batch runner: {e}")
+        print(f"Unexpected error: {e}")
+        sys.exit(1)
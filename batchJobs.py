@@ -0,0 +1,484 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, Tuple
+
+import bedrockclient as bd
+import manageConfig as mc
+import modelRegistry
+import resilience
+import structuredOutput
+import tokenBudget
+from batchInvoke import read_batch_inputs
+from promptTemplate import load_template
+from logging_setup import setup_logging
+
+# Offline batch inference: rendered prompts are written as model invocation records, uploaded to S3 and processed by
+# a CreateModelInvocationJob. The job runs at batch pricing and outside the on-demand quotas, so backfills do not
+# compete with real-time traffic; results arrive in hours rather than seconds.
+
+# Job states after which the job's output will not change
+TERMINAL_STATUSES = ('Completed', 'PartiallyCompleted', 'Failed', 'Stopped', 'Expired')
+
+# Service quotas of a single job input file; a job with fewer records than the minimum is rejected by the service
+MIN_RECORDS = 100
+MAX_RECORDS = 50000
+
+# Batch inference is billed at this fraction of the on-demand price
+BATCH_PRICE_FACTOR = 0.5
+
+# Function to return the system and user text of a Converse request
+# Models without system prompt support already carry the system prompt as the first user block
+def _request_text(request):
+    system = "\n\n".join(block["text"] for block in request.get("system", []) if "text" in block)
+    user = "\n\n".join(block["text"] for block in request["messages"][0]["content"] if "text" in block)
+    return system, user
+
+def _anthropic_input(system, user, config):
+    body = {"anthropic_version": "bedrock-2023-05-31", "max_tokens": config["maxTokens"],
+            "temperature": config["temperature"],
+            "messages": [{"role": "user", "content": [{"type": "text", "text": user}]}]}
+    if system:
+        body["system"] = system
+    return body
+
+def _anthropic_output(output):
+    text = "".join(block.get("text", "") for block in output.get("content", []) if block.get("type") == "text")
+    usage = output.get("usage", {})
+    return text, output.get("stop_reason"), usage.get("input_tokens"), usage.get("output_tokens")
+
+def _nova_input(system, user, config):
+    body = {"schemaVersion": "messages-v1", "messages": [{"role": "user", "content": [{"text": user}]}],
+            "inferenceConfig": {"max_new_tokens": config["maxTokens"], "temperature": config["temperature"]}}
+    if system:
+        body["system"] = [{"text": system}]
+    return body
+
+def _nova_output(output):
+    text = "".join(block.get("text", "") for block in output.get("output", {}).get("message", {}).get("content", []))
+    usage = output.get("usage", {})
+    return text, output.get("stopReason"), usage.get("inputTokens"), usage.get("outputTokens")
+
+def _titan_input(system, user, config):
+    return {"inputText": user, "textGenerationConfig": {"maxTokenCount": config["maxTokens"],
+                                                       "temperature": config["temperature"]}}
+
+def _titan_output(output):
+    result = (output.get("results") or [{}])[0]
+    return result.get("outputText", ""), result.get("completionReason"), output.get("inputTextTokenCount"), \
+        result.get("tokenCount")
+
+def _llama_input(system, user, config):
+    prompt = "<|begin_of_text|>"
+    if system:
+        prompt += f"<|start_header_id|>system<|end_header_id|>\n\n{system}<|eot_id|>"
+    prompt += f"<|start_header_id|>user<|end_header_id|>\n\n{user}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+    return {"prompt": prompt, "max_gen_len": config["maxTokens"], "temperature": config["temperature"]}
+
+def _llama_output(output):
+    return output.get("generation", ""), output.get("stop_reason"), output.get("prompt_token_count"), \
+        output.get("generation_token_count")
+
+def _mistral_input(system, user, config):
+    text = f"{system}\n\n{user}" if system else user
+    return {"prompt": f"<s>[INST] {text} [/INST]", "max_tokens": config["maxTokens"],
+            "temperature": config["temperature"]}
+
+def _mistral_output(output):
+    result = (output.get("outputs") or [{}])[0]
+    return result.get("text", ""), result.get("stop_reason"), None, None
+
+# Mistral Large 2 takes the chat-completion body on InvokeModel instead of the [INST] prompt of the older models
+def _mistral_chat_input(system, user, config):
+    messages = ([{"role": "system", "content": system}] if system else []) + [{"role": "user", "content": user}]
+    return {"messages": messages, "max_tokens": config["maxTokens"], "temperature": config["temperature"]}
+
+def _mistral_chat_output(output):
+    choice = (output.get("choices") or [{}])[0]
+    usage = output.get("usage", {})
+    return choice.get("message", {}).get("content") or "", choice.get("stop_reason") or choice.get("finish_reason"), \
+        usage.get("prompt_tokens"), usage.get("completion_tokens")
+
+# Native request and response format of each model family (batch records use InvokeModel bodies, not Converse);
+# the first matching prefix of the base model id wins
+MODEL_FORMATS = (
+    ('anthropic.', _anthropic_input, _anthropic_output),
+    ('amazon.nova-', _nova_input, _nova_output),
+    ('amazon.titan-', _titan_input, _titan_output),
+    ('meta.llama3', _llama_input, _llama_output),
+    ('mistral.mistral-large-2407', _mistral_chat_input, _mistral_chat_output),
+    ('mistral.', _mistral_input, _mistral_output),
+)
+
+# Function to look up the native format of a model
+# Raises:
+#   modelRegistry.UnsupportedModelOption for a model family without a known format
+def _model_format(model_id):
+    base_id = modelRegistry.base_model_id(model_id)
+    for prefix, build_input, parse_output in MODEL_FORMATS:
+        if base_id.startswith(prefix):
+            return build_input, parse_output
+    raise modelRegistry.UnsupportedModelOption(f"Batch inference records are not supported for {model_id}")
+
+# Function to turn a Converse request into the modelInput of a batch record
+# Args:
+#   request: The keyword arguments built by ModelSpec.build_request
+# Returns:
+#   The InvokeModel body of the request's model
+def model_input(request):
+    build_input, _ = _model_format(request["modelId"])
+    system, user = _request_text(request)
+    return build_input(system, user, request["inferenceConfig"])
+
+# Function to read the modelOutput of a batch record
+# Args:
+#   model_id: The model of the job
+#   output: The modelOutput dictionary
+# Returns:
+#   A dictionary with the output text, stop reason and usage in the same shape as a Converse result
+def parse_model_output(model_id, output):
+    _, parse_output = _model_format(model_id)
+    text, stop_reason, input_tokens, output_tokens = parse_output(output)
+    result = {"output": text, "stop_reason": stop_reason}
+    if input_tokens is not None and output_tokens is not None:
+        result["usage"] = {"inputTokens": input_tokens, "outputTokens": output_tokens,
+                           "totalTokens": input_tokens + output_tokens}
+    return result
+
+# Settings from the optional [batchjobs] section
+# Keys: Bucket and Prefix (where input and output are staged), RoleARN (service role the job runs as, with access to
+# the bucket), ControlEndpointURL and S3EndpointURL (VPC endpoints of the Bedrock control plane and S3; public
+# endpoints when empty), SubnetIds and SecurityGroupIds (comma separated; the job reads and writes S3 from this VPC),
+# TimeoutHours, PollSeconds, WorkDir (local copy of the records and the job state)
+@dataclass(frozen=True)
+class BatchJobSettings:
+    bucket: str = ''
+    prefix: str = 'bedrock-batch'
+    role_arn: str = ''
+    control_endpoint_url: Optional[str] = None
+    s3_endpoint_url: Optional[str] = None
+    subnet_ids: Tuple[str, ...] = ()
+    security_group_ids: Tuple[str, ...] = ()
+    timeout_hours: int = 24
+    poll_seconds: float = 60
+    work_dir: str = 'batch-jobs'
+
+# Function to read the [batchjobs] section
+def get_batch_job_settings():
+    def get(key, default=''):
+        return mc.getValueOrDefault('batchjobs', key, default).strip()
+
+    def items(key):
+        return tuple(item.strip() for item in get(key).split(',') if item.strip())
+
+    return BatchJobSettings(
+        bucket=get('Bucket'),
+        prefix=get('Prefix', 'bedrock-batch').strip('/'),
+        role_arn=get('RoleARN'),
+        control_endpoint_url=get('ControlEndpointURL') or None,
+        s3_endpoint_url=get('S3EndpointURL') or None,
+        subnet_ids=items('SubnetIds'),
+        security_group_ids=items('SecurityGroupIds'),
+        timeout_hours=int(get('TimeoutHours', '24')),
+        poll_seconds=float(get('PollSeconds', '60')),
+        work_dir=get('WorkDir', 'batch-jobs'),
+    )
+
+# Function to write the batch records of every input to a local JSONL file
+# Each input becomes one record, or several when [budget] is enabled and the log does not fit one request. Record ids
+# are sequential; the returned entries map them back to the input ids.
+# Args:
+#   spec: The ModelSpec of the model
+#   system_prompt: The system prompt text
+#   template: The compiled prompt template
+#   inputs: Iterable of (record_id, text, error) tuples from read_batch_inputs
+#   records_file: Path of the JSONL file to write
+# Returns:
+#   A tuple (entries, record_count); each entry is {"id", "record_ids"} or {"id", "error"} in input order
+def write_records(spec, system_prompt, template, inputs, records_file):
+    budget = tokenBudget.get_budget_settings()
+    entries = []
+    count = 0
+    with open(records_file, 'w') as f:
+        for input_id, text, error in inputs:
+            if error is not None:
+                entries.append({"id": input_id, "error": error})
+                continue
+            try:
+                if budget.enabled:
+                    requests = [spec.build_request(system_prompt, p.user_prompt, max_tokens=p.max_tokens)
+                                for p in tokenBudget.pack_prompts(spec, system_prompt, template, text, budget)]
+                else:
+                    requests = [spec.build_request(system_prompt, template.render(log_entry=text))]
+                records = [model_input(request) for request in requests]
+            except modelRegistry.UnsupportedModelOption as e:
+                entries.append({"id": input_id, "error": {"code": "UnsupportedModelOption", "message": str(e)}})
+                continue
+            record_ids = []
+            for body in records:
+                count += 1
+                record_id = f"R{count:010d}"
+                f.write(json.dumps({"recordId": record_id, "modelInput": body}) + "\n")
+                record_ids.append(record_id)
+            entries.append({"id": input_id, "record_ids": record_ids})
+    return entries, count
+
+# Function to split an s3:// URI into bucket and key
+def split_s3_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+# Function to write the job state, so a job can be collected by a later run
+def save_state(state):
+    with open(state["state_file"], 'w') as f:
+        json.dump(state, f, indent=2)
+
+def load_state(state_file):
+    with open(state_file, 'r') as f:
+        return json.load(f)
+
+# Function to render the inputs, upload them and submit the batch inference job
+# Args:
+#   bedrock: The Bedrock control plane client
+#   s3: The S3 client
+#   settings: The BatchJobSettings
+#   spec: The ModelSpec of the model
+#   system_prompt: The system prompt text
+#   template: The compiled prompt template
+#   inputs: Iterable of (record_id, text, error) tuples
+#   job_name: The name of the job
+# Returns:
+#   The job state dictionary (also saved to <WorkDir>/<job_name>.json)
+# Raises:
+#   ValueError if there are no records or more than one job file can hold
+def submit_job(bedrock, s3, settings, spec, system_prompt, template, inputs, job_name):
+    os.makedirs(settings.work_dir, exist_ok=True)
+    records_file = os.path.join(settings.work_dir, f"{job_name}.jsonl")
+    entries, count = write_records(spec, system_prompt, template, inputs, records_file)
+    if count == 0:
+        raise ValueError("No valid input records to submit")
+    if count > MAX_RECORDS:
+        raise ValueError(f"{count} records are more than the {MAX_RECORDS} one job accepts; split the input")
+    if count < MIN_RECORDS:
+        logging.warning(f"Only {count} records; the service rejects jobs with fewer than {MIN_RECORDS}")
+
+    # The file is streamed from disk, so memory use does not grow with the size of the backfill
+    input_key = f"{settings.prefix}/{job_name}/input/{os.path.basename(records_file)}"
+    with open(records_file, 'rb') as f:
+        s3.put_object(Bucket=settings.bucket, Key=input_key, Body=f)
+    logging.info(f"Uploaded {count} records to s3://{settings.bucket}/{input_key}")
+
+    job = {
+        "jobName": job_name,
+        "roleArn": settings.role_arn,
+        "modelId": spec.model_id,
+        "inputDataConfig": {"s3InputDataConfig": {"s3Uri": f"s3://{settings.bucket}/{input_key}",
+                                                  "s3InputFormat": "JSONL"}},
+        "outputDataConfig": {"s3OutputDataConfig": {"s3Uri": f"s3://{settings.bucket}/{settings.prefix}/{job_name}/output/"}},
+        "timeoutDurationInHours": settings.timeout_hours,
+    }
+    if settings.subnet_ids:
+        job["vpcConfig"] = {"subnetIds": list(settings.subnet_ids),
+                            "securityGroupIds": list(settings.security_group_ids)}
+    job_arn = bedrock.create_model_invocation_job(**job)["jobArn"]
+    logging.info(f"Submitted batch inference job {job_arn} with {count} records")
+
+    state = {"job_arn": job_arn, "job_name": job_name, "model_id": spec.model_id, "record_count": count,
+             "input_uri": job["inputDataConfig"]["s3InputDataConfig"]["s3Uri"],
+             "output_uri": job["outputDataConfig"]["s3OutputDataConfig"]["s3Uri"],
+             "records_file": records_file, "state_file": os.path.join(settings.work_dir, f"{job_name}.json"),
+             "entries": entries}
+    save_state(state)
+    return state
+
+# Function to poll a job until it reaches a terminal status
+# Args:
+#   bedrock: The Bedrock control plane client
+#   job_arn: The ARN of the job
+#   poll_seconds: Seconds between polls
+#   timeout: Seconds to wait before giving up (None waits until the job ends)
+# Returns:
+#   The GetModelInvocationJob response of the finished job
+# Raises:
+#   TimeoutError if the job is still running after timeout seconds
+def wait_for_job(bedrock, job_arn, poll_seconds=60, timeout=None):
+    started = time.monotonic()
+    status = None
+    while True:
+        job = bedrock.get_model_invocation_job(jobIdentifier=job_arn)
+        if job["status"] != status:
+            status = job["status"]
+            logging.info(f"Batch inference job {job_arn} is {status}")
+            print(f"Job status: {status}")
+        if status in TERMINAL_STATUSES:
+            return job
+        if timeout is not None and time.monotonic() - started > timeout:
+            raise TimeoutError(f"Job {job_arn} is still {status} after {timeout:.0f}s")
+        time.sleep(poll_seconds)
+
+# Function to download the job output and index it by record id
+# The output is written by the service to <output uri><job id>/<input file name>.out
+# Args:
+#   s3: The S3 client
+#   state: The job state dictionary
+# Returns:
+#   A dictionary of record id -> parsed result (output text, stop reason, usage) or {"error": ...}
+def read_outputs(s3, state):
+    job_id = state["job_arn"].rsplit('/', 1)[-1]
+    bucket, prefix = split_s3_uri(state["output_uri"])
+    key = f"{prefix.rstrip('/')}/{job_id}/{os.path.basename(split_s3_uri(state['input_uri'])[1])}.out"
+    outputs = {}
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+    for line in body.iter_lines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if "modelOutput" in record:
+            outputs[record["recordId"]] = parse_model_output(state["model_id"], record["modelOutput"])
+        else:
+            error = record.get("error", {})
+            if not isinstance(error, dict):
+                error = {"errorMessage": str(error)}
+            outputs[record["recordId"]] = {"error": {"code": str(error.get("errorCode", "RecordFailed")),
+                                                     "message": error.get("errorMessage", "")}}
+    logging.info(f"Read {len(outputs)} output records from s3://{bucket}/{key}")
+    return outputs
+
+# Function to join the job output back to the input ids and write one result per input, in input order
+# Results have the same fields as batchInvoke.py results; an input split over several records gets a "parts" list.
+# Args:
+#   state: The job state dictionary
+#   outputs: The dictionary returned by read_outputs
+#   output: Writable text file receiving one JSON result per line
+# Returns:
+#   A tuple (succeeded, failed, usage) with the number of inputs in each state and the summed token usage
+def join_results(state, outputs, output):
+    structured = structuredOutput.get_structured_settings()
+    succeeded = failed = 0
+    usage = {"inputTokens": 0, "outputTokens": 0, "totalTokens": 0}
+    for entry in state["entries"]:
+        result = {"id": entry["id"], "model_id": state["model_id"]}
+        if "error" in entry:
+            result.update(status="error", error=entry["error"])
+        else:
+            parts = []
+            for record_id in entry["record_ids"]:
+                part = outputs.get(record_id) or {"error": {"code": "MissingOutput",
+                                                            "message": f"No output for record {record_id}"}}
+                if structured.enabled and "error" not in part:
+                    part = {**part, "structured": structuredOutput.parse_response(part["output"], structured.schema)}
+                for key in usage:
+                    usage[key] += part.get("usage", {}).get(key, 0)
+                parts.append(part)
+            failed_part = next((part for part in parts if "error" in part), None)
+            if len(parts) == 1:
+                result.update(parts[0])
+            else:
+                result["parts"] = parts
+            result["status"] = "error" if failed_part else "ok"
+            if failed_part:
+                result["error"] = failed_part["error"]
+        if result["status"] == "ok":
+            succeeded += 1
+        else:
+            failed += 1
+        output.write(json.dumps(result) + "\n")
+    return succeeded, failed, usage
+
+# Function to wait for a submitted job and write its results
+# Args:
+#   bedrock: The Bedrock control plane client
+#   s3: The S3 client
+#   state: The job state dictionary
+#   output_file: Path of the results JSONL file
+#   poll_seconds: Seconds between status polls
+#   timeout: Seconds to wait for the job (None waits until it ends)
+# Returns:
+#   A summary dictionary
+def collect_job(bedrock, s3, state, output_file, poll_seconds=60, timeout=None):
+    job = wait_for_job(bedrock, state["job_arn"], poll_seconds, timeout)
+    if job["status"] not in ('Completed', 'PartiallyCompleted'):
+        raise RuntimeError(f"Job {state['job_arn']} ended as {job['status']}: {job.get('message', '')}")
+    outputs = read_outputs(s3, state)
+    with open(output_file, 'w') as output:
+        succeeded, failed, usage = join_results(state, outputs, output)
+    # Some model families (e.g. Mistral) report no usage in their output, so no cost can be estimated
+    cost = modelRegistry.get_model(state["model_id"]).estimate_cost(usage) if usage["totalTokens"] else None
+    return {"status": job["status"], "succeeded": succeeded, "failed": failed, "usage": usage,
+            "estimated_cost": cost * BATCH_PRICE_FACTOR if cost is not None else None}
+
+# Function to print the summary of a collected job
+def print_summary(summary, output_file):
+    print(f"Job {summary['status']}: {summary['succeeded']} succeeded, {summary['failed']} failed. "
+          f"Results written to {output_file}")
+    usage = summary["usage"]
+    cost = f", estimated cost ${summary['estimated_cost']:.4f} at batch pricing" \
+        if summary["estimated_cost"] is not None else ""
+    print(f"Tokens: {usage['inputTokens']} input, {usage['outputTokens']} output{cost}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a JSONL file of log entries through a Bedrock batch inference job.')
+    parser.add_argument('--config', default='config.properties', help='Configuration file (default: config.properties)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    submit = commands.add_parser('submit', help='Render and upload the records and submit the job')
+    run = commands.add_parser('run', help='Submit the job, wait for it and write the results')
+    for command in (submit, run):
+        command.add_argument('--input', required=True, help='JSONL file with one input record per line')
+        command.add_argument('--model', required=True, help='Model alias from the [models] section or a model id')
+        command.add_argument('--job-name', help='Job name (default: log-triage-<timestamp>)')
+        command.add_argument('--id-field', default='request_id', help='Input field holding the record id (default: request_id)')
+        command.add_argument('--text-field', default='log_entry', help='Input field substituted for {{log_entry}} (default: log_entry)')
+        command.add_argument('--prompt-file', default='prompt.txt', help='Prompt template file (default: prompt.txt)')
+        command.add_argument('--system-file', default='system.txt', help='System prompt file (default: system.txt)')
+    collect = commands.add_parser('collect', help='Wait for a submitted job and write the results')
+    collect.add_argument('--state', required=True, help='State file written by submit (<WorkDir>/<job name>.json)')
+    for command in (run, collect):
+        command.add_argument('--output', required=True, help='JSONL file to write results to (in input order)')
+        command.add_argument('--timeout', type=float, help='Seconds to wait for the job (default: until it ends)')
+    args = parser.parse_args()
+
+    setup_logging(log_level=logging.INFO)
+    try:
+        # Ensure the config file is not empty and valid
+        if not mc._initialize_config(args.config):
+            print(f'Please make sure the provided config file path is correct and not empty, exiting .... ')
+            sys.exit(1)
+        settings = get_batch_job_settings()
+        bedrock = bd.get_bedrock_client(settings.control_endpoint_url)
+        s3 = bd.get_s3_client(settings.s3_endpoint_url)
+
+        if args.command == 'collect':
+            state = load_state(args.state)
+        else:
+            if not settings.bucket or not settings.role_arn:
+                print("Set Bucket and RoleARN in the [batchjobs] section")
+                sys.exit(1)
+            spec = modelRegistry.get_model(args.model)
+            job_name = args.job_name or f"log-triage-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+            state = submit_job(bedrock, s3, settings, spec, load_template(args.system_file).text,
+                               load_template(args.prompt_file), read_batch_inputs(args.input, args.id_field,
+                                                                                  args.text_field), job_name)
+            print(f"Submitted job {state['job_arn']} with {state['record_count']} records. State saved to "
+                  f"{state['state_file']}")
+
+        if args.command in ('run', 'collect'):
+            summary = collect_job(bedrock, s3, state, args.output, settings.poll_seconds, args.timeout)
+            logging.info(f"Batch inference job {state['job_arn']} collected: {summary}")
+            print_summary(summary, args.output)
+
+    except FileNotFoundError as e:
+        logging.error(f"File not found: {e}")
+        print(f"File not found: {e}")
+        sys.exit(1)
+    except Exception as e:
+        # Service errors carry their error code (e.g. ValidationException, ServiceQuotaExceededException)
+        code = resilience.error_code(e)
+        logging.error(f"Batch inference job failed: {code + ': ' if code else ''}{e}")
+        print(f"Batch inference job failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,345 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import struct
+import threading
+import time
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the Bedrock runtime Converse and ConverseStream APIs
+# It answers with realistic application/vnd.amazon.eventstream frames (the same binary framing botocore parses
+# from the real service), with configurable time to first token, token rate and output length, so the client
+# path can be benchmarked offline. Credentials and request signatures are not checked.
+# The same server also stands in for the parts of S3 (path-style PutObject/GetObject, in memory) and of the Bedrock
+# control plane (CreateModelInvocationJob/GetModelInvocationJob) that batchJobs.py uses, so batch inference jobs can
+# be run end to end offline.
+
+_MODEL_PATH = re.compile(r'^/model/(?P<model_id>[^/]+)/(?P<operation>converse-stream|converse)$')
+_JOB_PATH = re.compile(r'^/model-invocation-job(?:/(?P<job>[^/?]+))?$')
+
+# Function to build the native modelOutput of a batch record for a model family
+# Returns:
+#   The InvokeModel response body the model family would return for text
+def native_output(model_id, text, input_tokens, output_tokens):
+    base_id = model_id.split('.', 1)[1] if model_id.split('.', 1)[0] in ('us', 'eu', 'apac') else model_id
+    if base_id.startswith('anthropic.'):
+        return {"type": "message", "role": "assistant", "content": [{"type": "text", "text": text}],
+                "stop_reason": "end_turn", "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens}}
+    if base_id.startswith('amazon.nova-'):
+        return {"output": {"message": {"role": "assistant", "content": [{"text": text}]}}, "stopReason": "end_turn",
+                "usage": {"inputTokens": input_tokens, "outputTokens": output_tokens}}
+    if base_id.startswith('amazon.titan-'):
+        return {"inputTextTokenCount": input_tokens,
+                "results": [{"tokenCount": output_tokens, "outputText": text, "completionReason": "FINISH"}]}
+    if base_id.startswith('meta.'):
+        return {"generation": text, "prompt_token_count": input_tokens, "generation_token_count": output_tokens,
+                "stop_reason": "stop"}
+    if base_id.startswith('mistral.mistral-large-2407'):
+        return {"object": "chat.completion", "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                                          "stop_reason": "stop"}]}
+    return {"outputs": [{"text": text, "stop_reason": "stop"}]}
+
+# Function to encode one event-stream message
+# Args:
+#   event_type: The :event-type header (e.g. messageStart, contentBlockDelta)
+#   payload: The JSON-serialisable event body
+# Returns:
+#   The encoded frame as bytes
+def encode_event(event_type, payload):
+    headers = b''
+    for name, value in ((':event-type', event_type), (':content-type', 'application/json'), (':message-type', 'event')):
+        name_bytes, value_bytes = name.encode(), value.encode()
+        # Header value type 7 is a string with a 2-byte length prefix
+        headers += struct.pack('>B', len(name_bytes)) + name_bytes + struct.pack('>BH', 7, len(value_bytes)) + value_bytes
+    body = json.dumps(payload).encode()
+    total_length = 12 + len(headers) + len(body) + 4
+    prelude = struct.pack('>II', total_length, len(headers))
+    message = prelude + struct.pack('>I', zlib.crc32(prelude)) + headers + body
+    return message + struct.pack('>I', zlib.crc32(message))
+
+# Behaviour of the stand-in; shared by every request handler thread
+class StandInProfile:
+
+    # Args:
+    #   ttft_ms: Delay before the first token
+    #   tokens_per_sec: Rate at which tokens are streamed after the first one
+    #   output_tokens: Number of tokens in each response
+    #   jitter: Relative random variation applied to every delay (0.1 = +/-10%)
+    #   input_tokens: Input token count reported in the usage metadata
+    #   response_text: Text to answer with, streamed four characters per token (replaces output_tokens " token"s)
+    #   job_seconds: Time a batch inference job spends in each of the Submitted and InProgress states
+    #   job_error_every: Every nth record of a batch inference job fails (0: none fail)
+    #   tail_ratio: Fraction of streams whose first token is slowed down by tail_ms (to try hedged requests)
+    #   tail_ms: Extra delay before the first token of a slow stream
+    def __init__(self, ttft_ms=400, tokens_per_sec=80, output_tokens=200, jitter=0.1, input_tokens=1200,
+                 response_text=None, job_seconds=1, job_error_every=0, tail_ratio=0.0, tail_ms=0):
+        self.ttft_ms = ttft_ms
+        self.tail_ratio = tail_ratio
+        self.tail_ms = tail_ms
+        self.job_seconds = job_seconds
+        self.job_error_every = job_error_every
+        self.tokens_per_sec = tokens_per_sec
+        self.jitter = jitter
+        self.input_tokens = input_tokens
+        if response_text is None:
+            self.pieces = [" token"] * output_tokens
+        else:
+            self.pieces = [response_text[i:i + 4] for i in range(0, len(response_text), 4)]
+        self.output_tokens = len(self.pieces)
+
+    # Function to return the delay before the first token of a stream, in seconds
+    def first_token_delay(self):
+        slow = self.tail_ratio and random.random() < self.tail_ratio
+        return (self.ttft_ms + (self.tail_ms if slow else 0)) / 1000
+
+    def delay(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds * (1 + random.uniform(-self.jitter, self.jitter)))
+
+# Objects and batch inference jobs of the stand-in; shared by every request handler thread
+class _StandInStore:
+
+    def __init__(self):
+        self.objects = {}
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    profile = StandInProfile()
+    store = _StandInStore()
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.path == '/model-invocation-job':
+            self._create_job(json.loads(body))
+            return
+        match = _MODEL_PATH.match(self.path)
+        if not match:
+            self._send_json(404, {"message": f"Unknown path {self.path}"})
+            return
+        started = time.perf_counter()
+        try:
+            if match.group('operation') == 'converse':
+                self._converse(started)
+            else:
+                self._converse_stream(started)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early (e.g. its caller went away)
+            self.close_connection = True
+
+    def _converse(self, started):
+        profile = self.profile
+        profile.delay(profile.ttft_ms / 1000 + profile.output_tokens / profile.tokens_per_sec)
+        self._send_json(200, {
+            "output": {"message": {"role": "assistant", "content": [{"text": "".join(profile.pieces)}]}},
+            "stopReason": "end_turn",
+            "usage": self._usage(),
+            "metrics": {"latencyMs": int((time.perf_counter() - started) * 1000)},
+        })
+
+    def _converse_stream(self, started):
+        profile = self.profile
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.amazon.eventstream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self._send_chunk(encode_event('messageStart', {"role": "assistant"}))
+        profile.delay(profile.first_token_delay())
+        for i, piece in enumerate(profile.pieces):
+            if i:
+                profile.delay(1 / profile.tokens_per_sec)
+            self._send_chunk(encode_event('contentBlockDelta', {"contentBlockIndex": 0, "delta": {"text": piece}}))
+        self._send_chunk(encode_event('contentBlockStop', {"contentBlockIndex": 0}))
+        self._send_chunk(encode_event('messageStop', {"stopReason": "end_turn"}))
+        self._send_chunk(encode_event('metadata', {
+            "usage": self._usage(),
+            "metrics": {"latencyMs": int((time.perf_counter() - started) * 1000)},
+        }))
+        self.wfile.write(b'0\r\n\r\n')
+
+    # S3 PutObject (path style: /bucket/key)
+    def do_PUT(self):
+        body = self._read_body()
+        with self.store.lock:
+            self.store.objects[urllib.parse.unquote(self.path.split('?', 1)[0])] = body
+        self.send_response(200)
+        self.send_header('ETag', '"%s"' % hashlib.md5(body).hexdigest())
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    # S3 GetObject and GetModelInvocationJob
+    def do_GET(self):
+        path = urllib.parse.unquote(self.path.split('?', 1)[0])
+        match = _JOB_PATH.match(self.path.split('?', 1)[0])
+        if match and match.group('job'):
+            with self.store.lock:
+                job = self.store.jobs.get(urllib.parse.unquote(match.group('job')))
+                job = dict(job) if job else None
+            if job is None:
+                self._send_json(404, {"message": "Job not found"}, 'ResourceNotFoundException')
+            else:
+                self._send_json(200, job)
+            return
+        with self.store.lock:
+            data = self.store.objects.get(path)
+        if data is None:
+            self._send_xml_error(404, 'NoSuchKey', 'The specified key does not exist.')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _create_job(self, request):
+        with self.store.lock:
+            job_id = f"{len(self.store.jobs) + 1:012d}"
+            job_arn = f"arn:aws:bedrock:us-west-2:000000000000:model-invocation-job/{job_id}"
+            job = {"jobArn": job_arn, "jobName": request["jobName"], "modelId": request["modelId"],
+                   "roleArn": request["roleArn"], "status": "Submitted", "submitTime": time.time(),
+                   "inputDataConfig": request["inputDataConfig"], "outputDataConfig": request["outputDataConfig"]}
+            self.store.jobs[job_arn] = self.store.jobs[job_id] = job
+        threading.Thread(target=self._run_job, args=(job,), daemon=True).start()
+        self._send_json(200, {"jobArn": job_arn})
+
+    # Function to process a job in the background: read the input records, answer each with the profile's text in
+    # the model's native format, and write the output where the service writes it (<output uri><job id>/<file>.out)
+    def _run_job(self, job):
+        profile, store = self.profile, self.store
+        time.sleep(profile.job_seconds)
+        with store.lock:
+            job["status"] = "InProgress"
+        time.sleep(profile.job_seconds)
+        input_uri = job["inputDataConfig"]["s3InputDataConfig"]["s3Uri"]
+        output_uri = job["outputDataConfig"]["s3OutputDataConfig"]["s3Uri"]
+        with store.lock:
+            data = store.objects.get('/' + input_uri[len('s3://'):])
+        if data is None:
+            with store.lock:
+                job.update(status="Failed", message=f"Input {input_uri} not found", endTime=time.time())
+            return
+        text = "".join(profile.pieces)
+        lines, errors = [], 0
+        for number, line in enumerate(data.decode().splitlines(), start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if profile.job_error_every and number % profile.job_error_every == 0:
+                errors += 1
+                record["error"] = {"errorCode": 400, "errorMessage": "Malformed input request"}
+            else:
+                record["modelOutput"] = native_output(job["modelId"], text, profile.input_tokens,
+                                                      profile.output_tokens)
+            lines.append(json.dumps(record))
+        job_id = job["jobArn"].rsplit('/', 1)[-1]
+        key = '/' + output_uri[len('s3://'):].rstrip('/') + f"/{job_id}/{input_uri.rsplit('/', 1)[-1]}.out"
+        with store.lock:
+            store.objects[key] = ("\n".join(lines) + "\n").encode()
+            job.update(status="PartiallyCompleted" if errors else "Completed", endTime=time.time(),
+                       totalRecordCount=len(lines), processedRecordCount=len(lines),
+                       successRecordCount=len(lines) - errors, errorRecordCount=errors)
+
+    # Function to read the request body, decoding the aws-chunked encoding botocore uses for streamed uploads
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            data = b''
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    # Trailing headers (e.g. the upload checksum) end with an empty line
+                    while self.rfile.readline().strip():
+                        pass
+                    break
+                data += self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if 'aws-chunked' in self.headers.get('Content-Encoding', ''):
+            decoded, rest = b'', data
+            while rest:
+                header, _, rest = rest.partition(b'\r\n')
+                size = int(header.split(b';')[0], 16)
+                if size == 0:
+                    break
+                decoded += rest[:size]
+                rest = rest[size + 2:]
+            data = decoded
+        return data
+
+    def _send_xml_error(self, status, code, message):
+        data = f"<Error><Code>{code}</Code><Message>{message}</Message></Error>".encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _usage(self):
+        return {"inputTokens": self.profile.input_tokens, "outputTokens": self.profile.output_tokens,
+                "totalTokens": self.profile.input_tokens + self.profile.output_tokens}
+
+    def _send_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def _send_json(self, status, body, error_type=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if error_type:
+            self.send_header('x-amzn-ErrorType', error_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+# Function to start the stand-in on a background thread
+# Args:
+#   profile: The StandInProfile to serve with
+#   host: The interface to listen on
+#   port: The port to listen on (0 picks a free port)
+# Returns:
+#   A tuple (server, endpoint_url); call server.shutdown() to stop it
+def start_stand_in(profile=None, host='127.0.0.1', port=0):
+    handler = type('StandInHandler', (_StandInHandler,), {"profile": profile or StandInProfile(),
+                                                          "store": _StandInStore()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='bedrock-stand-in', daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Bedrock runtime Converse/ConverseStream APIs and batch inference jobs.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--ttft-ms', type=float, default=400, help='Delay before the first token (default: 400)')
+    parser.add_argument('--tokens-per-sec', type=float, default=80, help='Token rate after the first token (default: 80)')
+    parser.add_argument('--output-tokens', type=int, default=200, help='Tokens per response (default: 200)')
+    parser.add_argument('--jitter', type=float, default=0.1, help='Relative random variation of delays (default: 0.1)')
+    parser.add_argument('--response-file', help='Answer with the text of this file instead of " token" repeated')
+    parser.add_argument('--job-seconds', type=float, default=1, help='Seconds a batch job spends queued and running (default: 1)')
+    parser.add_argument('--job-error-every', type=int, default=0, help='Fail every nth record of a batch job (default: none)')
+    parser.add_argument('--tail-ratio', type=float, default=0, help='Fraction of streams with a slow first token (default: 0)')
+    parser.add_argument('--tail-ms', type=float, default=0, help='Extra delay before the first token of a slow stream (default: 0)')
+    args = parser.parse_args()
+
+    response_text = None
+    if args.response_file:
+        with open(args.response_file, 'r') as f:
+            response_text = f.read()
+    server, url = start_stand_in(StandInProfile(args.ttft_ms, args.tokens_per_sec, args.output_tokens, args.jitter,
+                                                response_text=response_text, job_seconds=args.job_seconds,
+                                                job_error_every=args.job_error_every, tail_ratio=args.tail_ratio,
+                                                tail_ms=args.tail_ms), args.host, args.port)
+    print(f"Bedrock stand-in listening on {url} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,22 +1,20 @@
-import boto3
-import datetime
-import json
-import pytz
-import encryption as en
-import base64encode as enc
 import creds
 import sys
 import logging
-from botocore.exceptions import ClientError
+from logging_setup import get_logger
+import threading
 import manageConfig as mc
+import metrics
 
-# Set up logging configuration
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s  %(name)s  %(levelname)s: %(message)s')
-file_handler = logging.FileHandler('invoke.log')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+# Set up logging configuration (shared, non-blocking pipeline)
+logger = get_logger(__name__)
+
+# boto3 and botocore are imported inside the functions that build clients, so importing this module (and the
+# CLIs that use it) stays fast until a client is actually needed
+
+# Runtime clients shared per (endpoint URL, config overrides), guarded by a lock so concurrent callers build each client only once
+_runtime_clients = {}
+_runtime_clients_lock = threading.Lock()
 
 # Function to create and return a Bedrock client
 # Args:
@@ -24,6 +22,8 @@ logger.addHandler(file_handler)
 # Returns:
 #   The Bedrock client object
 def get_bedrock_client(b_endpoint_url):
+    import boto3
+    from botocore.exceptions import ClientError
     try:
         # Fetch the region from the configuration and create a Bedrock client
         bedrock = boto3.client('bedrock', mc.getValue('default', 'Region'), endpoint_url=b_endpoint_url)
@@ -31,79 +31,169 @@ def get_bedrock_client(b_endpoint_url):
     except ClientError as error:
         logger.error(f"Failed to create Bedrock client: {error}")
         print(f"Failed to create Bedrock client: {error}")
-        sys.exit(0)
+        sys.exit(1)
     except Exception as e:
         logger.error(f"Unexpected error when creating Bedrock client: {e}")
         print(f"Unexpected error when creating Bedrock client: {e}")
-        sys.exit(0)
+        sys.exit(1)
+
+# Function to create and return an S3 client (used to stage batch inference input and output)
+# Args:
+#   s3_endpoint_url: The S3 endpoint URL (e.g. an S3 interface VPC endpoint); the public endpoint when None
+# Returns:
+#   The S3 client object
+def get_s3_client(s3_endpoint_url=None):
+    import boto3
+    from botocore.config import Config
+    try:
+        # Path-style addressing works with interface endpoint URLs, where the bucket cannot be a host name prefix
+        config = Config(s3={'addressing_style': 'path'}) if s3_endpoint_url else None
+        return boto3.client('s3', mc.getValue('default', 'Region'), endpoint_url=s3_endpoint_url, config=config)
+    except Exception as e:
+        logger.error(f"Unexpected error when creating S3 client: {e}")
+        print(f"Unexpected error when creating S3 client: {e}")
+        sys.exit(1)
+
+# Function to resolve the Bedrock runtime endpoint URL from the configuration
+# Returns:
+#   The decrypted VPC Endpoint URL if UseVPCe is 'true', otherwise the public Bedrock Service URL for the region
+def get_runtime_endpoint_url():
+    settings = mc.get_settings()
+    b_endpoint_url = settings.runtime_endpoint_url
+    if settings.use_vpce:
+        logger.info(f'Bedrock VPCE is enabled. Here is the EndPoint URL - {b_endpoint_url}')
+    else:
+        logger.info(f'Bedrock VPCE is not enabled. Here is the Bedrock Service URL - {b_endpoint_url}')
+    return b_endpoint_url
 
 # Function to create and return a Bedrock runtime client based on the configured credentials method
 # Args:
 #   b_endpoint_url: The endpoint URL for the Bedrock runtime service
+#   client_config: Optional botocore Config (e.g. to size the connection pool for concurrent callers)
+#   region: Optional region of the endpoint; defaults to the configured Region
 # Returns:
 #   The Bedrock runtime client object
-def get_bedrock_runtime_client(b_endpoint_url):
+def get_bedrock_runtime_client(b_endpoint_url, client_config=None, region=None):
+    with metrics.timer('client_construction', endpoint=metrics.endpoint_label(b_endpoint_url)):
+        return _create_bedrock_runtime_client(b_endpoint_url, client_config, region)
+
+def _create_bedrock_runtime_client(b_endpoint_url, client_config, region):
+    import boto3
+    from botocore.exceptions import ClientError
     try:
+        # Values are decrypted once when the settings are loaded
+        settings = mc.get_settings()
+        region = region or settings.region
+
         # Log the method of credential retrieval as configured
-        logger.info(f"GetCredentialsFrom value is {mc.getValue('default', 'GetCredentialsFrom')}")
-        print(f"GetCredentialsFrom value is {mc.getValue('default', 'GetCredentialsFrom')}")
+        logger.info(f"GetCredentialsFrom value is {settings.get_credentials_from}")
+        print(f"GetCredentialsFrom value is {settings.get_credentials_from}")
 
         # Option 1: Fetch Bedrock runtime client via cross-account role assumption
-        if mc.getValue('default', 'GetCredentialsFrom') == str(1):
+        if settings.get_credentials_from == str(1):
+            assume_role_arn = settings.assume_role_arn
             try:
-                # Decrypt the AssumeRoleARN and retrieve credentials by assuming the role
-                decoded = enc.decode_base64_to_string(mc.getValue('default', 'AssumeRoleARN'))
-                assume_role_arn = en.decrypt(mc.getValue('default', 'SecretKeyFernet').encode(), decoded)
-                credentials = creds.getCredentialsForRole(assume_role_arn, "MyBedrockClient")
-                
-                # Create a Bedrock runtime client using the assumed role credentials
-                bedrock = boto3.client('bedrock-runtime', mc.getValue('default', 'Region'), endpoint_url=b_endpoint_url, 
-                                       aws_access_key_id=credentials["AccessKeyId"],
-                                       aws_secret_access_key=credentials["SecretAccessKey"],
-                                       aws_session_token=credentials["SessionToken"])
+                # Retrieve credentials by assuming the role
+                session = creds.getSessionForRole(assume_role_arn, "MyBedrockClient")
+
+                # Create a Bedrock runtime client using the cached, auto-refreshing assumed role credentials
+                bedrock = session.client('bedrock-runtime', region, endpoint_url=b_endpoint_url, config=client_config)
             except ClientError as error:
                 logger.error(f"Unable to assume role {assume_role_arn}. Ensure APIKey and APISecret are correct and have permission to assume the role. Error: {error}")
                 print(f"Unable to assume role {assume_role_arn}. Ensure APIKey and APISecret are correct and have permission to assume the role. Error: {error}")
-                sys.exit(0)
+                sys.exit(1)
 
         # Option 2: Fetch Bedrock runtime client using IAM API Key and Secret
-        elif mc.getValue('default', 'GetCredentialsFrom') == str(2):
+        elif settings.get_credentials_from == str(2):
+            assume_role_arn = settings.assume_role_arn
             try:
-                # Decrypt the API keys and assume the specified role using those credentials
-                decoded = enc.decode_base64_to_string(mc.getValue('default', 'AssumeRoleARN'))
-                assume_role_arn = en.decrypt(mc.getValue('default', 'SecretKeyFernet').encode(), decoded)
-                decoded = enc.decode_base64_to_string(mc.getValue('default', 'AccessKey'))
-                api_key = en.decrypt(mc.getValue('default', 'SecretKeyFernet').encode(), decoded)
-                decoded = enc.decode_base64_to_string(mc.getValue('default', 'SecretKey'))
-                api_secret = en.decrypt(mc.getValue('default', 'SecretKeyFernet').encode(), decoded)
-                
-                logger.info(f"api_key is {api_key}")
-                logger.info(f"api_secret is {api_secret}")
                 logger.info(f"assume_role_arn is {assume_role_arn}")
-                print(api_key, api_secret, assume_role_arn)
-                
+
                 # Retrieve credentials by assuming the specified role with the API keys
-                credentials = creds.getCredentialsfromAPIKeybyAssumingRole(api_key, api_secret, assume_role_arn)
-                bedrock = boto3.client('bedrock-runtime', mc.getValue('default', 'Region'), endpoint_url=b_endpoint_url, 
-                                       aws_access_key_id=credentials["AccessKeyId"],
-                                       aws_secret_access_key=credentials["SecretAccessKey"],
-                                       aws_session_token=credentials["SessionToken"])
+                session = creds.getSessionForRole(assume_role_arn, 'my-session-name', settings.access_key, settings.secret_key)
+                bedrock = session.client('bedrock-runtime', region, endpoint_url=b_endpoint_url, config=client_config)
             except ClientError as error:
                 logger.error(f"Unable to assume role {assume_role_arn}. Ensure permission to assume the role. Error: {error}")
                 print(f"Unable to assume role {assume_role_arn}. Ensure permission to assume the role. Error: {error}")
-                sys.exit(0)
+                sys.exit(1)
 
         # Default: Fetch Bedrock runtime client based on EC2 role permissions (no additional credentials required)
         else:
-            bedrock = boto3.client('bedrock-runtime', mc.getValue('default', 'Region'), endpoint_url=b_endpoint_url)
+            bedrock = boto3.client('bedrock-runtime', region, endpoint_url=b_endpoint_url, config=client_config)
     
         return bedrock
 
     except ClientError as error:
         logger.error(f"Failed to create Bedrock runtime client: {error}")
         print(f"Failed to create Bedrock runtime client: {error}")
-        sys.exit(0)
+        sys.exit(1)
     except Exception as e:
         logger.error(f"Unexpected error when creating Bedrock runtime client: {e}")
         print(f"Unexpected error when creating Bedrock runtime client: {e}")
-        sys.exit(0)
+        sys.exit(1)
+
+# Function to build the botocore client configuration from the optional [client] section
+# Keys (all optional): MaxPoolConnections, TCPKeepAlive, ConnectTimeout, ReadTimeout, RetryMode, RetryMaxAttempts
+# Returns:
+#   A botocore Config object
+def get_client_config():
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=int(mc.getValueOrDefault('client', 'MaxPoolConnections', '10')),
+        tcp_keepalive=mc.getValueOrDefault('client', 'TCPKeepAlive', 'false').lower() == 'true',
+        connect_timeout=float(mc.getValueOrDefault('client', 'ConnectTimeout', '60')),
+        read_timeout=float(mc.getValueOrDefault('client', 'ReadTimeout', '60')),
+        # botocore's own retries stay short; longer backoff and circuit breaking happen in resilience.py
+        retries={'mode': mc.getValueOrDefault('client', 'RetryMode', 'adaptive'),
+                 'max_attempts': int(mc.getValueOrDefault('client', 'RetryMaxAttempts', '2'))},
+    )
+
+# Function to return the long-lived Bedrock runtime client for an endpoint, creating it on first use
+# The client keeps its HTTP connection pool (and the TLS sessions to the endpoint) between calls. Its config starts
+# from the [client] settings; callers that need something different (e.g. a connection pool sized to their worker
+# count) pass overrides, which are merged on top and get a client of their own.
+# Args:
+#   b_endpoint_url: The endpoint URL for the Bedrock runtime service
+#   region: Optional region of the endpoint; defaults to the configured Region
+#   overrides: Optional dict of botocore Config options (e.g. {'max_pool_connections': 32})
+# Returns:
+#   The shared Bedrock runtime client object
+def get_pooled_runtime_client(b_endpoint_url, region=None, overrides=None):
+    key = (b_endpoint_url, repr(sorted(overrides.items())) if overrides else None)
+    bedrock = _runtime_clients.get(key)
+    if bedrock is None:
+        with _runtime_clients_lock:
+            bedrock = _runtime_clients.get(key)
+            if bedrock is None:
+                client_config = get_client_config()
+                if overrides:
+                    from botocore.config import Config
+                    client_config = client_config.merge(Config(**overrides))
+                bedrock = get_bedrock_runtime_client(b_endpoint_url, client_config, region)
+                _runtime_clients[key] = bedrock
+                logger.info(f"Created pooled Bedrock runtime client for {b_endpoint_url}")
+    return bedrock
+
+# Function to drop pooled runtime clients so they are rebuilt on next use
+# Args:
+#   b_endpoint_url: The endpoint whose clients should be dropped; all clients are dropped when None
+def reset_pooled_runtime_clients(b_endpoint_url=None):
+    with _runtime_clients_lock:
+        if b_endpoint_url is None:
+            _runtime_clients.clear()
+        else:
+            for key in [key for key in _runtime_clients if key[0] == b_endpoint_url]:
+                del _runtime_clients[key]
+
+# Settings fields that affect how runtime clients are built
+_CLIENT_SETTINGS = {'use_vpce', 'vpc_endpoint_url', 'region', 'get_credentials_from',
+                    'assume_role_arn', 'access_key', 'secret_key', 'client', 'endpoints'}
+
+# Function called by manageConfig when the configuration is reloaded
+# Pooled clients are dropped only when a field that affects them changed; they are rebuilt on next use
+def _on_settings_changed(old_settings, new_settings, changed):
+    if changed & _CLIENT_SETTINGS:
+        logger.info(f"Runtime client settings changed ({sorted(changed & _CLIENT_SETTINGS)}), dropping pooled clients")
+        reset_pooled_runtime_clients()
+
+mc.subscribe(_on_settings_changed)
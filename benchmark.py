@@ -0,0 +1,151 @@
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+import bedrockclient as bd
+import manageConfig as mc
+import metrics
+import modelRegistry
+from bedrockStandIn import StandInProfile, start_stand_in
+from invoke import build_converse_request
+from myutils import read_file_contents, render_prompt
+from promptTemplate import load_template
+from streamSinks import AccumulatorSink, MetricsSink, consume, parse_events
+
+# Function to return the p-th percentile (nearest rank) of a list of values
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(len(ordered) * p / 100.0)) - 1))]
+
+# Function to send one ConverseStream request and measure it on the client side
+# Args:
+#   bedrock_runtime: The Bedrock runtime client
+#   request: The Converse request
+# Returns:
+#   A dictionary with ttft_ms, total_ms and output_tokens, or an error
+def measure_request(bedrock_runtime, request):
+    started = time.perf_counter()
+    try:
+        response = bedrock_runtime.converse_stream(**request)
+        timing, accumulator = consume(parse_events(response.get('stream') or []),
+                                      [MetricsSink(started), AccumulatorSink()])
+        summary = timing.summary()
+        return {"ttft_ms": summary["ttft_ms"], "total_ms": summary["total_ms"],
+                "output_tokens": (accumulator.usage or {}).get('outputTokens', 0)}
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+
+# Function to run a number of requests at a fixed concurrency against one client
+# Args:
+#   bedrock_runtime: The Bedrock runtime client
+#   request: The Converse request sent every time
+#   concurrency: Number of requests in flight at once
+#   total_requests: Number of measured requests
+# Returns:
+#   A dictionary with throughput, percentiles of TTFT and end-to-end latency, and the error count
+def run_level(bedrock_runtime, request, concurrency, total_requests):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: measure_request(bedrock_runtime, request), range(total_requests)))
+    elapsed = time.perf_counter() - started
+
+    succeeded = [r for r in results if "error" not in r]
+    ttft = [r["ttft_ms"] for r in succeeded if r["ttft_ms"] is not None]
+    total = [r["total_ms"] for r in succeeded]
+    errors = [r["error"] for r in results if "error" in r]
+    return {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "requests_per_sec": len(succeeded) / elapsed if elapsed else 0.0,
+        "output_tokens_per_sec": sum(r["output_tokens"] for r in succeeded) / elapsed if elapsed else 0.0,
+        "ttft_ms": {"p50": percentile(ttft, 50), "p95": percentile(ttft, 95), "p99": percentile(ttft, 99)},
+        "total_ms": {"p50": percentile(total, 50), "p95": percentile(total, 95), "p99": percentile(total, 99)},
+    }
+
+# Function to build a runtime client for a benchmark target
+# The stand-in does not check signatures, so it gets static dummy credentials; real endpoints go through
+# bedrockclient so the configured credentials option is exercised as well
+def build_client(target, concurrency):
+    client_config = Config(max_pool_connections=concurrency, retries={"max_attempts": 1})
+    if target["stand_in"]:
+        return boto3.client('bedrock-runtime', target["region"], endpoint_url=target["url"], config=client_config,
+                            aws_access_key_id='stand-in', aws_secret_access_key='stand-in')
+    return bd.get_bedrock_runtime_client(target["url"], client_config)
+
+# Function to format one result row for the summary table
+def format_row(label, result):
+    def ms(value):
+        return f"{value:8.1f}" if value is not None else "       -"
+    return (f"{label:<40} {result['concurrency']:>4} {result['requests_per_sec']:8.2f} {result['output_tokens_per_sec']:9.1f} "
+            f"{ms(result['ttft_ms']['p50'])} {ms(result['ttft_ms']['p95'])} {ms(result['ttft_ms']['p99'])} "
+            f"{ms(result['total_ms']['p50'])} {ms(result['total_ms']['p95'])} {ms(result['total_ms']['p99'])} {result['errors']:>4}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark ConverseStream through VPC endpoint, public endpoint or a local stand-in.')
+    parser.add_argument('--config', default='config.properties', help='Configuration file (default: config.properties)')
+    parser.add_argument('--endpoint-url', action='append', default=[],
+                        help='Runtime endpoint URL to benchmark; repeat to compare endpoints. Use "config" for the configured endpoint')
+    parser.add_argument('--stand-in', action='store_true', help='Also benchmark a local Bedrock stand-in server')
+    parser.add_argument('--stand-in-ttft-ms', type=float, default=400)
+    parser.add_argument('--stand-in-tokens-per-sec', type=float, default=80)
+    parser.add_argument('--stand-in-output-tokens', type=int, default=200)
+    parser.add_argument('--model', default='anthropic.claude-3-haiku-20240307-v1:0', help='Model id or alias from [models]')
+    parser.add_argument('--concurrency', default='1,4,16', help='Comma separated concurrency levels (default: 1,4,16)')
+    parser.add_argument('--requests', type=int, default=32, help='Measured requests per concurrency level (default: 32)')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    try:
+        mc._initialize_config(args.config)
+        model_id = modelRegistry.get_registry().resolve(args.model)
+        region = mc.getValueOrDefault('default', 'Region', 'us-west-2')
+
+        targets = []
+        for url in args.endpoint_url:
+            if url == 'config':
+                url = bd.get_runtime_endpoint_url()
+            targets.append({"label": f"{metrics.endpoint_label(url)} {url}", "url": url, "region": region, "stand_in": False})
+        server = None
+        if args.stand_in:
+            server, url = start_stand_in(StandInProfile(args.stand_in_ttft_ms, args.stand_in_tokens_per_sec,
+                                                        args.stand_in_output_tokens))
+            targets.append({"label": f"stand-in {url}", "url": url, "region": region, "stand_in": True})
+        if not targets:
+            print("Nothing to benchmark: pass --endpoint-url and/or --stand-in")
+            sys.exit(1)
+
+        request = build_converse_request(model_id, load_template('system.txt').text,
+                                         render_prompt(load_template('prompt.txt'), read_file_contents('user-query.txt')))
+        levels = [int(level) for level in args.concurrency.split(',')]
+
+        print(f"{'target':<40} {'conc':>4} {'req/s':>8} {'tok/s':>9} {'ttft50':>8} {'ttft95':>8} {'ttft99':>8} "
+              f"{'e2e50':>8} {'e2e95':>8} {'e2e99':>8} {'err':>4}")
+        report = []
+        for target in targets:
+            for concurrency in levels:
+                client = build_client(target, concurrency)
+                # One unmeasured request per level opens the connection (and the TLS session) first
+                measure_request(client, request)
+                result = run_level(client, request, concurrency, args.requests)
+                print(format_row(target["label"][:40], result))
+                report.append({"target": target["label"], **result})
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({"model_id": model_id, "results": report}, f, indent=2)
+            print(f"Results written to {args.output}")
+        if server is not None:
+            server.shutdown()
+
+    except Exception as e:
+        print(f"Benchmark failed: {e}")
+        sys.exit(1)
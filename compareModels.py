@@ -0,0 +1,216 @@
+import argparse
+import json
+import logging
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import bedrockclient as bd
+import endpointPool
+import manageConfig as mc
+import metrics
+import modelRegistry
+import resilience
+from invoke import prompt_caching_enabled
+from myutils import create_complete_prompt
+from promptTemplate import load_template
+from streamSinks import AccumulatorSink, MetricsSink, StreamSink, TextDelta, consume, parse_events
+
+# Sink that prints one progress line per model when the first token and the end of the stream arrive
+class ProgressSink(StreamSink):
+
+    # Args:
+    #   label: The model label printed in front of every line
+    #   started: perf_counter() value when the request was sent
+    #   lock: Lock shared by all progress sinks so lines from parallel streams do not interleave
+    def __init__(self, label, started, lock, out=None):
+        self.label = label
+        self.started = started
+        self.lock = lock
+        self.out = out or sys.stdout
+        self._first_token = True
+
+    def on_event(self, event):
+        if isinstance(event, TextDelta) and self._first_token:
+            self._first_token = False
+            self._print(f"first token after {(time.perf_counter() - self.started) * 1000:.0f} ms")
+
+    def close(self):
+        self._print(f"done after {(time.perf_counter() - self.started) * 1000:.0f} ms")
+
+    def _print(self, text):
+        with self.lock:
+            self.out.write(f"[{self.label}] {text}\n")
+            self.out.flush()
+
+# Function to send the prompt to one model over ConverseStream and measure it
+# The response cache is bypassed so every run is a live call; rate limits and retries still apply
+# Args:
+#   bedrock_runtime: The Bedrock runtime client (or endpoint pool)
+#   spec: The ModelSpec of the model
+#   system_prompt: The system prompt text
+#   user_prompt: The complete user prompt text
+#   static_prefix: Optional static prefix marked for prompt caching
+#   progress_lock: Lock for progress output, or None to stay quiet
+# Returns:
+#   A dictionary with the measurements, token usage, estimated cost and output text, or an error
+def run_model(bedrock_runtime, spec, system_prompt, user_prompt, static_prefix=None, progress_lock=None):
+    label = spec.alias or spec.model_id
+    result = {"model": label, "model_id": spec.model_id}
+    started = time.perf_counter()
+    try:
+        request = spec.build_request(system_prompt, user_prompt, static_prefix)
+        stream = resilience.get_controller().converse_stream(bedrock_runtime, request)
+        sinks = [MetricsSink(started), AccumulatorSink(),
+                 metrics.StreamTimingSink(started, model_id=spec.model_id,
+                                          endpoint=metrics.endpoint_label(bedrock_runtime.meta.endpoint_url))]
+        if progress_lock is not None:
+            sinks.append(ProgressSink(label, started, progress_lock))
+        timing, accumulator = consume(parse_events(stream), sinks)[:2]
+        usage = accumulator.usage or {}
+        result.update(timing.summary())
+        result.update({"input_tokens": usage.get('inputTokens'), "output_tokens": usage.get('outputTokens'),
+                       "cost_usd": spec.estimate_cost(usage), "stop_reason": accumulator.stop_reason,
+                       "output": accumulator.text})
+    except Exception as e:
+        logging.error(f"Comparison run failed for {spec.model_id}: {e}")
+        result["error"] = f"{resilience.error_code(e) or type(e).__name__}: {e}"
+        if progress_lock is not None:
+            with progress_lock:
+                print(f"[{label}] failed: {result['error']}")
+    return result
+
+# Function to run the same prompt across several models in parallel
+# Args:
+#   bedrock_runtime: The Bedrock runtime client (or endpoint pool)
+#   specs: The ModelSpecs to compare
+#   system_prompt: The system prompt text
+#   user_prompt: The complete user prompt text
+#   static_prefix: Optional static prefix marked for prompt caching
+#   repeat: Number of runs per model
+#   concurrency: Maximum number of requests in flight (defaults to one per model)
+#   progress: Print a line per model as first tokens and completions arrive
+# Returns:
+#   A list with one result dictionary per run, in completion order
+def compare_models(bedrock_runtime, specs, system_prompt, user_prompt, static_prefix=None, repeat=1,
+                   concurrency=None, progress=True):
+    progress_lock = threading.Lock() if progress else None
+    with ThreadPoolExecutor(max_workers=concurrency or len(specs)) as executor:
+        # Runs are interleaved (every model once, then again) so no model gets all its samples in one burst
+        futures = [executor.submit(run_model, bedrock_runtime, spec, system_prompt, user_prompt, static_prefix,
+                                   progress_lock)
+                   for _ in range(repeat) for spec in specs]
+        return [future.result() for future in as_completed(futures)]
+
+# Function to aggregate the runs of each model
+# Args:
+#   specs: The ModelSpecs in the order they should be reported
+#   runs: The result dictionaries returned by compare_models
+# Returns:
+#   A list with one summary dictionary per model (medians over the successful runs)
+def summarize(specs, runs):
+    def median(values):
+        values = [v for v in values if v is not None]
+        return statistics.median(values) if values else None
+
+    summaries = []
+    for spec in specs:
+        label = spec.alias or spec.model_id
+        model_runs = [r for r in runs if r["model"] == label]
+        ok = [r for r in model_runs if "error" not in r]
+        summaries.append({
+            "model": label,
+            "model_id": spec.model_id,
+            "runs": len(model_runs),
+            "errors": len(model_runs) - len(ok),
+            "ttft_ms": median(r["ttft_ms"] for r in ok),
+            "total_ms": median(r["total_ms"] for r in ok),
+            "input_tokens": median(r["input_tokens"] for r in ok),
+            "output_tokens": median(r["output_tokens"] for r in ok),
+            "tokens_per_sec": median(r["tokens_per_sec"] for r in ok),
+            "cost_usd": median(r["cost_usd"] for r in ok),
+        })
+    return summaries
+
+# Function to format the summaries as a text table
+def format_table(summaries):
+    def num(value, width, fmt):
+        return f"{value:{width}{fmt}}" if value is not None else " " * (width - 1) + "-"
+
+    lines = [f"{'model':<28} {'runs':>4} {'err':>3} {'ttft ms':>9} {'total ms':>9} {'in tok':>7} {'out tok':>7} "
+             f"{'tok/s':>7} {'cost $':>10}"]
+    for s in summaries:
+        lines.append(f"{s['model'][:28]:<28} {s['runs']:>4} {s['errors']:>3} {num(s['ttft_ms'], 9, '.0f')} "
+                     f"{num(s['total_ms'], 9, '.0f')} {num(s['input_tokens'], 7, '.0f')} "
+                     f"{num(s['output_tokens'], 7, '.0f')} {num(s['tokens_per_sec'], 7, '.1f')} "
+                     f"{num(s['cost_usd'], 10, '.6f')}")
+    return "\n".join(lines)
+
+# Function to resolve a comma separated list of aliases / model ids (or 'all') to model specs
+# Raises:
+#   ValueError for a name that is neither a configured alias nor a model id
+def select_models(names):
+    registry = modelRegistry.get_registry()
+    if names == 'all':
+        return list(registry.models)
+    specs = []
+    for name in (n.strip() for n in names.split(',') if n.strip()):
+        if name not in registry and '.' not in name:
+            raise ValueError(f"Unknown model {name}: use an alias from [models] or a model id")
+        specs.append(registry.get(name))
+    return specs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send the same prompt to several Bedrock models in parallel and compare them.')
+    parser.add_argument('--config', default='config.properties', help='Configuration file (default: config.properties)')
+    parser.add_argument('--models', default='all', help='Comma separated aliases from [models] or model ids (default: all)')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per model (default: 1)')
+    parser.add_argument('--concurrency', type=int, help='Maximum requests in flight (default: one per model)')
+    parser.add_argument('--prompt-file', default='prompt.txt', help='Prompt template file (default: prompt.txt)')
+    parser.add_argument('--system-file', default='system.txt', help='System prompt file (default: system.txt)')
+    parser.add_argument('--query-file', default='user-query.txt', help='File substituted for {{log_entry}} (default: user-query.txt)')
+    parser.add_argument('--output', help='Write every run (including the output text) and the summary as JSON to this file')
+    parser.add_argument('--show-output', action='store_true', help="Print each model's response after the table")
+    args = parser.parse_args()
+
+    try:
+        if args.repeat < 1:
+            print("--repeat must be at least 1")
+            sys.exit(1)
+        if not mc._initialize_config(args.config):
+            print(f'Please make sure the provided config file path is correct and not empty, exiting .... ')
+            sys.exit(1)
+        metrics.configure_exporter()
+
+        # Resolve and check every model before anything is sent
+        specs = select_models(args.models)
+        for spec in specs:
+            spec.check(streaming=True)
+
+        system_prompt = load_template(args.system_file).text
+        user_prompt = create_complete_prompt(args.prompt_file, args.query_file)
+        static_prefix = load_template(args.prompt_file).static_prefix if prompt_caching_enabled() else None
+        bedrock_runtime = endpointPool.get_runtime(bd.get_runtime_endpoint_url())
+
+        print(f"Comparing {len(specs)} models, {args.repeat} run(s) each\n")
+        runs = compare_models(bedrock_runtime, specs, system_prompt, user_prompt, static_prefix,
+                              args.repeat, args.concurrency)
+        summaries = summarize(specs, runs)
+        print("\n" + format_table(summaries))
+
+        if args.show_output:
+            for spec in specs:
+                label = spec.alias or spec.model_id
+                run = next((r for r in runs if r["model"] == label and "error" not in r), None)
+                print(f"\n===== {label} =====\n{run['output'] if run else '(no successful run)'}")
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({"summary": summaries, "runs": runs}, f, indent=2)
+            print(f"\nResults written to {args.output}")
+
+    except Exception as e:
+        logging.error(f"Model comparison failed: {e}")
+        print(f"Model comparison failed: {e}")
+        sys.exit(1)
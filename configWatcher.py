@@ -0,0 +1,89 @@
+import os
+import threading
+
+import manageConfig as mc
+from logging_setup import get_logger
+
+# Set up logging configuration (shared, non-blocking pipeline)
+logger = get_logger(__name__)
+
+# Background watcher that reloads the configuration file when it changes on disk
+# The file is polled for changes to its modification time, size or inode (the latter covers editors and deployment
+# tools that replace the file atomically). Parsing, validation and decryption run on the watcher thread, and
+# manageConfig.reload_settings swaps the new snapshot in, so request threads only ever see a complete configuration.
+class ConfigWatcher:
+
+    # Args:
+    #   file_path: The configuration file to watch; defaults to the file manageConfig last loaded
+    #   interval: Seconds between checks
+    def __init__(self, file_path=None, interval=2.0):
+        self.file_path = file_path or mc._config_file_path
+        self.interval = interval
+        self.reloads = 0
+        self.failures = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._signature = self._file_signature()
+
+    # Function to start watching in a daemon thread
+    # Returns:
+    #   The watcher itself, so it can be created and started in one expression
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='config-watcher', daemon=True)
+            self._thread.start()
+            logger.info(f"Watching configuration file {self.file_path} every {self.interval}s")
+        return self
+
+    # Function to stop the watcher thread
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Function to check the file once and reload it if it changed
+    # Returns:
+    #   True if a new configuration was loaded
+    def check(self):
+        signature = self._file_signature()
+        if signature is None or signature == self._signature:
+            return False
+        self._signature = signature
+        try:
+            mc.reload_settings(self.file_path)
+            self.reloads += 1
+            return True
+        except Exception as e:
+            # Keep serving the previous configuration until the file is fixed
+            self.failures += 1
+            logger.error(f"Ignoring invalid configuration in {self.file_path}: {e}")
+            return False
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.check()
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.file_path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+# Function to create and start a watcher for the loaded configuration file
+# Args:
+#   interval: Seconds between checks
+# Returns:
+#   The running ConfigWatcher
+def start_config_watcher(interval=2.0):
+    return ConfigWatcher(interval=interval).start()
+
+# Function to start a watcher for a long-running entry point, as set in its section of the configuration
+# Args:
+#   section: The entry point's section (e.g. 'server'); WatchConfigSeconds sets the interval and 0 turns watching off
+# Returns:
+#   The running ConfigWatcher, or None when watching is off
+def start_config_watcher_from_config(section):
+    interval = float(mc.getValueOrDefault(section, 'WatchConfigSeconds', '2'))
+    return start_config_watcher(interval) if interval > 0 else None
@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+import logging_setup
+
+# Every module logs through the shared pipeline from import time on; the first setup_logging() call decides the file,
+# so the tests send it to a temporary file instead of appending to the tracked invoke.log
+logging_setup.setup_logging(log_file=os.path.join(tempfile.mkdtemp(prefix='bedrock-tests-'), 'invoke.log'))
@@ -1,15 +1,227 @@
-import boto3
-from botocore.exceptions import ClientError
+import datetime
 import logging
+from logging_setup import get_logger
 import sys
+import threading
+from concurrent.futures import Future
+import metrics
 
-# Set up logging configuration
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s  %(name)s  %(levelname)s: %(message)s')
-file_handler = logging.FileHandler('invoke.log')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+# Set up logging configuration (shared, non-blocking pipeline)
+logger = get_logger(__name__)
+
+# Caching credential provider for assumed roles (GetCredentialsFrom modes 1 and 2)
+# Credentials are cached per role ARN (and source access key) as botocore RefreshableCredentials. A timer
+# re-assumes the role RefreshMargin seconds before Expiration, so by the time botocore asks for a refresh the
+# new credentials are already in the cache and no STS round trip happens on the request path.
+class AssumeRoleCredentialProvider:
+
+    # Args:
+    #   duration_seconds: Session duration requested from STS
+    #   refresh_margin: Seconds before Expiration at which the background refresh runs
+    #   retry_interval: Seconds to wait before retrying a failed background refresh
+    def __init__(self, duration_seconds=900, refresh_margin=300, retry_interval=30):
+        self.duration_seconds = duration_seconds
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self._entries = {}
+        # Roles being assumed for the first time: cache key -> Future of the entry
+        self._pending = {}
+        # Bumped by clear(); entries of an older generation are neither cached nor refreshed again
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "refreshes": 0, "refresh_failures": 0}
+
+    # Function to return refreshable credentials for a role, assuming it only on the first request
+    # Args:
+    #   role_arn: The ARN of the role to assume
+    #   role_session_name: A name for the session during which the role is assumed
+    #   access_key: Optional IAM Access Key used to call STS (mode 2); default credentials are used when omitted
+    #   secret_key: Optional IAM Secret Key used to call STS (mode 2)
+    # Returns:
+    #   A botocore RefreshableCredentials object shared by every client for this role
+    def get_credentials(self, role_arn, role_session_name, access_key=None, secret_key=None):
+        return self._get_entry(role_arn, role_session_name, access_key, secret_key)["credentials"]
+
+    # Function to return the boto3 session for a role, backed by its refreshable credentials
+    # Args:
+    #   role_arn: The ARN of the role to assume
+    #   role_session_name: A name for the session during which the role is assumed
+    #   access_key: Optional IAM Access Key used to call STS (mode 2); default credentials are used when omitted
+    #   secret_key: Optional IAM Secret Key used to call STS (mode 2)
+    # Returns:
+    #   A boto3 Session shared by every caller for this role
+    def get_session(self, role_arn, role_session_name, access_key=None, secret_key=None):
+        return self._get_entry(role_arn, role_session_name, access_key, secret_key)["session"]
+
+    def _get_entry(self, role_arn, role_session_name, access_key, secret_key):
+        cache_key = (role_arn, access_key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                self._counters["hits"] += 1
+                return entry
+            # Only the first caller for a role calls STS; callers for the same role wait for its result, while
+            # callers for other roles are not held up by the round trip
+            pending = self._pending.get(cache_key)
+            if pending is not None:
+                self._counters["hits"] += 1
+            else:
+                self._counters["misses"] += 1
+                self._pending[cache_key] = Future()
+            generation = self._generation
+        if pending is not None:
+            return pending.result()
+
+        entry = {"role_arn": role_arn, "role_session_name": role_session_name, "access_key": access_key,
+                 "secret_key": secret_key, "metadata": None, "timer": None, "generation": generation}
+        try:
+            entry["metadata"] = self._assume_role(entry)
+            # botocore only refreshes within these windows; both are shorter than refresh_margin so the
+            # background timer always runs first and botocore picks up the already-fetched credentials
+            from botocore.credentials import RefreshableCredentials
+            entry["credentials"] = RefreshableCredentials.create_from_metadata(
+                metadata=entry["metadata"],
+                refresh_using=lambda: self._current_metadata(entry),
+                method='sts-assume-role',
+                advisory_timeout=self.refresh_margin // 2,
+                mandatory_timeout=self.refresh_margin // 4,
+            )
+            entry["session"] = _session_with_credentials(entry["credentials"])
+        except Exception as err:
+            with self._lock:
+                pending = self._pending.pop(cache_key)
+            pending.set_exception(err)
+            raise
+        with self._lock:
+            # A clear() during the STS call empties the cache; the caller still gets the credentials it waited for
+            if generation == self._generation:
+                self._entries[cache_key] = entry
+            pending = self._pending.pop(cache_key)
+        pending.set_result(entry)
+        self._schedule_refresh(entry)
+        return entry
+
+    # Function to return the cache counters
+    # Returns:
+    #   A dictionary with hits, misses, refreshes and refresh_failures
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    # Function to cancel background refreshes and empty the cache
+    # A refresh that is already running when the cache is cleared finishes, but does not schedule another one
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            for entry in self._entries.values():
+                if entry["timer"] is not None:
+                    entry["timer"].cancel()
+            self._entries.clear()
+
+    # Function to call STS AssumeRole for a cache entry
+    # Returns:
+    #   Credential metadata in the format expected by RefreshableCredentials
+    def _assume_role(self, entry):
+        logger.info(f"Assuming role {entry['role_arn']}")
+        import boto3
+        if entry["access_key"]:
+            sts_client = boto3.client('sts', aws_access_key_id=entry["access_key"],
+                                      aws_secret_access_key=entry["secret_key"])
+        else:
+            sts_client = boto3.client('sts')
+        with metrics.timer('sts_assume_role'):
+            response = sts_client.assume_role(
+                RoleArn=entry["role_arn"],
+                RoleSessionName=entry["role_session_name"],
+                DurationSeconds=self.duration_seconds
+            )
+        credentials = response['Credentials']
+        return {
+            "access_key": credentials["AccessKeyId"],
+            "secret_key": credentials["SecretAccessKey"],
+            "token": credentials["SessionToken"],
+            "expiry_time": credentials["Expiration"].isoformat(),
+        }
+
+    # Function used by botocore as refresh_using: returns the cached metadata unless it is about to expire
+    def _current_metadata(self, entry):
+        if self._seconds_to_expiry(entry["metadata"]) > self.refresh_margin // 2:
+            return entry["metadata"]
+        # The background refresh has not succeeded in time; fall back to a synchronous STS call
+        self._refresh(entry, reschedule=False)
+        return entry["metadata"]
+
+    # Function to re-assume the role and store the new metadata on the entry
+    def _refresh(self, entry, reschedule=True):
+        try:
+            entry["metadata"] = self._assume_role(entry)
+            with self._lock:
+                self._counters["refreshes"] += 1
+        except Exception as err:
+            with self._lock:
+                self._counters["refresh_failures"] += 1
+            logger.error(f"Unable to refresh credentials for role {entry['role_arn']}: {err}")
+            if reschedule:
+                self._schedule_refresh(entry, delay=self.retry_interval)
+            else:
+                raise
+            return
+        if reschedule:
+            self._schedule_refresh(entry)
+
+    # Function to start the timer that refreshes an entry ahead of its expiry
+    def _schedule_refresh(self, entry, delay=None):
+        if delay is None:
+            delay = max(self._seconds_to_expiry(entry["metadata"]) - self.refresh_margin, 0)
+        with self._lock:
+            if entry["generation"] != self._generation:
+                return
+            timer = threading.Timer(delay, self._refresh, args=(entry,))
+            timer.daemon = True
+            entry["timer"] = timer
+            timer.start()
+
+    @staticmethod
+    def _seconds_to_expiry(metadata):
+        expiry = datetime.datetime.fromisoformat(metadata["expiry_time"])
+        return (expiry - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
+# Function to create a boto3 session whose clients sign with the given refreshable credentials
+# botocore has no public way to hand a session a RefreshableCredentials object (boto3.Session only takes static
+# keys), so the session's private _credentials attribute is set here, in this one place, once per cached role
+def _session_with_credentials(credentials):
+    import boto3
+    import botocore.session
+    botocore_session = botocore.session.get_session()
+    botocore_session._credentials = credentials
+    return boto3.Session(botocore_session=botocore_session)
+
+# Provider shared by every client created in this process
+_provider = AssumeRoleCredentialProvider()
+
+# Function to return the process-wide credential provider (e.g. to read its counters)
+def get_credential_provider():
+    return _provider
+
+# Function to return the boto3 session backed by cached, auto-refreshing credentials for a role
+# Args:
+#   role_arn: The ARN of the role to assume
+#   role_session_name: A name for the session during which the role is assumed
+#   access_key: Optional IAM Access Key used to call STS
+#   secret_key: Optional IAM Secret Key used to call STS
+# Returns:
+#   The role's shared boto3 Session, whose clients never need to be rebuilt when the credentials rotate
+def getSessionForRole(role_arn, role_session_name, access_key=None, secret_key=None):
+    return _provider.get_session(role_arn, role_session_name, access_key, secret_key)
+
+# Function to convert refreshable credentials to the dictionary format returned by STS
+def _credentials_to_dict(credentials):
+    frozen = credentials.get_frozen_credentials()
+    return {
+        "AccessKeyId": frozen.access_key,
+        "SecretAccessKey": frozen.secret_key,
+        "SessionToken": frozen.token,
+    }
 
 # Function to assume an AWS role and obtain temporary credentials
 # Args:
@@ -18,26 +230,18 @@ logger.addHandler(file_handler)
 # Returns:
 #   A dictionary containing temporary credentials obtained from assuming the role
 def getCredentialsForRole(assume_role_arn, role_session_name):
+    from botocore.exceptions import ClientError
     logger.info(f"Assumed role ARN is {assume_role_arn}")
     
-    # Initialize the STS client to use for assuming roles
-    sts_client = boto3.client('sts')
-    
     try:
-        # Attempt to assume the specified role with a session duration of 15 minutes (900 seconds)
-        response = sts_client.assume_role(
-            RoleArn=assume_role_arn, 
-            RoleSessionName=role_session_name, 
-            DurationSeconds=900
-        )
-        temp_credentials = response['Credentials']
-        return temp_credentials
+        # Assume the role with a session duration of 15 minutes (900 seconds), reusing cached credentials
+        return _credentials_to_dict(_provider.get_credentials(assume_role_arn, role_session_name))
     
     except ClientError as err:
         # Handle and log any errors encountered during role assumption
         logger.error(f"Unable to assume role {assume_role_arn}")
         logger.error(f"Error: {err}")
-        sys.exit(0)  # Exit the program if role assumption fails
+        sys.exit(1)  # Exit the program if role assumption fails
 
 # Function to get temporary AWS STS credentials by assuming a role using provided IAM access and secret keys
 # Args:
@@ -47,26 +251,16 @@ def getCredentialsForRole(assume_role_arn, role_session_name):
 # Returns:
 #   A dictionary containing the temporary AWS STS credentials
 def getCredentialsfromAPIKeybyAssumingRole(access_key, secret_key, role_arn):
+    from botocore.exceptions import ClientError
     logger.info(f"Attempting to assume role {role_arn} using provided API keys.")
     
     try:
-        # Initialize the STS client with the provided access and secret keys
-        sts_client = boto3.client(
-            'sts', 
-            aws_access_key_id=access_key,
-            aws_secret_access_key=secret_key
-        )
-        
-        # Attempt to assume the specified role
-        assume_role_response = sts_client.assume_role(
-            RoleArn=role_arn, 
-            RoleSessionName='my-session-name'
-        )
-        return assume_role_response['Credentials']
+        # Assume the specified role with the provided access and secret keys, reusing cached credentials
+        return _credentials_to_dict(_provider.get_credentials(role_arn, 'my-session-name', access_key, secret_key))
     
     except ClientError as err:
         # Handle and log any errors encountered during role assumption
         logger.error(f"Unable to assume role {role_arn}. Ensure that the APIKey and APISecret are correct and have permission to assume the role.")
         logger.error(f"Error: {err}")
         print(f"Make sure APIKey and APISecret are correct and have permission to assume role - {err}")
-        sys.exit(0)  # Exit the program if role assumption fails
+        sys.exit(1)  # Exit the program if role assumption fails
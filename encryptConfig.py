@@ -51,6 +51,13 @@ try:
     mc.setValue('default', 'VPCEndpointURL', enc.encode_string_to_base64(encrypted))
     logging.info("Encrypted and stored VPCEndpointURL")
 
+    # Encrypt every entry of the optional 'endpoints' section (URL and optional region) the same way
+    if mc._config.has_section('endpoints'):
+        for name, value in list(mc._config['endpoints'].items()):
+            encrypted = en.encrypt(key, value)
+            mc.setValue('endpoints', name, enc.encode_string_to_base64(encrypted))
+        logging.info("Encrypted and stored endpoints")
+
     # Print all configuration values to verify encryption
     mc.print_all_config_values()
 
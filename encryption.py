@@ -1,17 +1,15 @@
-from cryptography.fernet import Fernet
-import logging
-from logging_setup import setup_logging
-
-# Set up logging using the imported function
-setup_logging(log_level=logging.INFO)
+# cryptography is imported inside the functions, so importing this module costs nothing until a value is
+# actually encrypted or decrypted
 
 def generateKey():
+    from cryptography.fernet import Fernet
     # generate secret key to use for encryption
     key = Fernet.generate_key()
     #print('key: ', key)
     return key
 
 def encrypt(key, data):
+    from cryptography.fernet import Fernet
     f = Fernet(key)
      # convert string to bytes
     encoded = str.encode(data)
@@ -23,6 +21,7 @@ def encrypt(key, data):
 def decrypt(key, encrypted):
      # convert string to bytes
     encoded = str.encode(encrypted)
+    from cryptography.fernet import Fernet
     f = Fernet(key)
     # use Fernet to decrypt using Symmetric encryption
     decrypted = f.decrypt(encoded)
@@ -31,7 +30,15 @@ def decrypt(key, encrypted):
     #print(decoded)
     return decoded
 
-logging.info(f"generateKey().decode() is {generateKey().decode()}")    
+def get_fernet(key):
+    # build a Fernet instance once so it can be reused for many decryptions
+    from cryptography.fernet import Fernet
+    return Fernet(key)
+
+def decrypt_with(f, encrypted):
+    # decrypt using an existing Fernet instance
+    return f.decrypt(str.encode(encrypted)).decode()
+
 #print(generateKey().decode())
 
 #if __name__ == '__main__':
@@ -0,0 +1,372 @@
+import random
+import socket
+import ssl
+import threading
+import time
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+import bedrockclient as bd
+import manageConfig as mc
+import metrics
+import resilience
+from logging_setup import get_logger
+
+# Set up logging configuration (shared, non-blocking pipeline)
+logger = get_logger(__name__)
+
+# Error codes that say something about the endpoint (as opposed to the model or the account, e.g. throttling)
+ENDPOINT_ERRORS = {'ServiceUnavailableException', 'InternalServerException'}
+
+# Weight of the newest sample in the per-endpoint latency average
+LATENCY_SMOOTHING = 0.2
+
+# One runtime endpoint in the pool with its routing state
+class Endpoint:
+
+    # Args:
+    #   name: The name from the [endpoints] section
+    #   url: The runtime endpoint URL
+    #   region: The region the endpoint serves
+    def __init__(self, name, url, region):
+        self.name = name
+        self.url = url
+        self.region = region
+        self.outstanding = 0
+        self.latency = None
+        self.consecutive_failures = 0
+        self.healthy = True
+        self.last_failure = 0.0
+
+    def __repr__(self):
+        return f"Endpoint({self.name}, {self.url}, {self.region})"
+
+# Function to check that an endpoint accepts connections (TCP connect plus the TLS handshake for https)
+# Bedrock has no unauthenticated health API, so this checks the path to the endpoint (DNS, the VPC endpoint
+# network interface, security groups) without sending a signed request.
+# Args:
+#   url: The endpoint URL
+#   timeout: Seconds allowed for the connection
+# Returns:
+#   True if the endpoint is reachable
+def probe_endpoint(url, timeout=2.0):
+    parsed = urlparse(url)
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    try:
+        with socket.create_connection((parsed.hostname, port), timeout=timeout) as sock:
+            if parsed.scheme == 'https':
+                with ssl.create_default_context().wrap_socket(sock, server_hostname=parsed.hostname):
+                    pass
+        return True
+    except OSError as e:
+        logger.debug(f"Health check of {url} failed: {e}")
+        return False
+
+# Function to check whether an error should take the endpoint out of rotation
+def is_endpoint_failure(error):
+    # Only called after a call failed, by which point botocore is loaded anyway
+    from botocore.exceptions import BotoCoreError
+    return isinstance(error, BotoCoreError) or resilience.error_code(error) in ENDPOINT_ERRORS
+
+# Pool of runtime endpoints that routes each call to one of them and fails over to the next on endpoint errors
+# The pool has the converse/converse_stream/meta interface of a runtime client, so it can be passed wherever a
+# client is expected; the resilience controller then treats the whole pool as one endpoint while the pool keeps
+# track of the health of each member.
+class EndpointPool:
+
+    # Args:
+    #   endpoints: A list of Endpoint objects
+    #   policy: 'least-outstanding' or 'latency' (weighted by the smoothed latency and the outstanding calls)
+    #   failure_threshold: Consecutive endpoint failures that take an endpoint out of rotation
+    #   health_check_interval: Seconds between health checks; 0 disables the background checker
+    #   health_check_timeout: Seconds allowed for one health check
+    def __init__(self, endpoints, policy='least-outstanding', failure_threshold=3, health_check_interval=10.0,
+                 health_check_timeout=2.0):
+        if not endpoints:
+            raise ValueError("An endpoint pool needs at least one endpoint")
+        if policy not in ('least-outstanding', 'latency'):
+            raise ValueError(f"Unknown routing policy {policy}")
+        self.endpoints = list(endpoints)
+        self.policy = policy
+        self.failure_threshold = failure_threshold
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._checker = None
+        client_config = bd.get_client_config()
+        self.meta = SimpleNamespace(endpoint_url='pool:' + ','.join(e.name for e in self.endpoints),
+                                    config=client_config)
+
+    # Function to pick the endpoint for the next call
+    # Healthy endpoints are preferred; when every candidate is out of rotation the one that failed longest ago is
+    # tried anyway, so a pool whose endpoints all had a bad moment still serves traffic.
+    # Args:
+    #   exclude: Endpoints already tried for this call
+    #   avoid: Endpoints to pass over while another healthy endpoint is available (see PoolView)
+    # Returns:
+    #   An Endpoint, or None when every endpoint was excluded
+    def select(self, exclude=(), avoid=()):
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            if not candidates:
+                return None
+            healthy = [e for e in candidates if e.healthy]
+            if not healthy:
+                return min(candidates, key=lambda e: e.last_failure)
+            healthy = [e for e in healthy if e not in avoid] or healthy
+            if self.policy == 'latency':
+                return self._select_by_latency(healthy)
+            return min(healthy, key=lambda e: (e.outstanding, random.random()))
+
+    def _select_by_latency(self, candidates):
+        known = [e.latency for e in candidates if e.latency is not None]
+        # Endpoints without a sample yet are scored like the fastest one so they get traffic and a measurement
+        fallback = min(known) if known else 1.0
+        weights = [1.0 / (max(e.latency if e.latency is not None else fallback, 0.001) * (e.outstanding + 1))
+                   for e in candidates]
+        return random.choices(candidates, weights)[0]
+
+    def record_success(self, endpoint, seconds):
+        with self._lock:
+            endpoint.consecutive_failures = 0
+            endpoint.latency = seconds if endpoint.latency is None else \
+                (1 - LATENCY_SMOOTHING) * endpoint.latency + LATENCY_SMOOTHING * seconds
+        metrics.observe_phase('endpoint_request', seconds, endpoint=endpoint.name)
+
+    def record_failure(self, endpoint):
+        with self._lock:
+            endpoint.consecutive_failures += 1
+            endpoint.last_failure = time.monotonic()
+            if endpoint.healthy and endpoint.consecutive_failures >= self.failure_threshold:
+                endpoint.healthy = False
+                logger.warning(f"Taking endpoint {endpoint.name} out of rotation after "
+                               f"{endpoint.consecutive_failures} consecutive failures")
+
+    # Function to call Converse on the selected endpoint, failing over to the others on endpoint errors
+    # Args:
+    #   request: The Converse request as keyword arguments
+    # Returns:
+    #   The Converse response
+    def converse(self, **request):
+        return self._route('converse', request)
+
+    # Function to call ConverseStream on the selected endpoint, failing over to the others on endpoint errors
+    # Failover only happens before the stream starts; the endpoint stays counted as busy until the stream ends or is
+    # closed.
+    # Args:
+    #   request: The Converse request as keyword arguments
+    # Returns:
+    #   The ConverseStream response, whose 'stream' is a generator of events
+    def converse_stream(self, **request):
+        return self._route('converse_stream', request)
+
+    # Function to return views of the pool for a request and its duplicates
+    # Args:
+    #   count: Number of sibling views
+    # Returns:
+    #   A list of PoolView objects sharing one group
+    def views(self, count=2):
+        group = []
+        return [PoolView(self, group) for _ in range(count)]
+
+    def _route(self, operation, request, view=None):
+        tried = []
+        last_error = None
+        while True:
+            endpoint = self.select(exclude=tried, avoid=view.avoided() if view is not None else ())
+            if endpoint is None:
+                raise last_error
+            tried.append(endpoint)
+            if view is not None:
+                view.used.append(endpoint)
+            client = bd.get_pooled_runtime_client(endpoint.url, endpoint.region)
+            with self._lock:
+                endpoint.outstanding += 1
+            started = time.perf_counter()
+            try:
+                response = getattr(client, operation)(**request)
+            except Exception as e:
+                self._release(endpoint)
+                # Throttling and other errors of the model or the account are left to the resilience controller,
+                # which retries them with backoff; failing them over would spread one throttling burst over the pool
+                if not is_endpoint_failure(e):
+                    raise
+                self.record_failure(endpoint)
+                logger.warning(f"{operation} on endpoint {endpoint.name} failed with "
+                               f"{resilience.error_code(e) or type(e).__name__}, trying the next endpoint")
+                last_error = e
+                continue
+            if operation == 'converse':
+                self._release(endpoint)
+                self.record_success(endpoint, time.perf_counter() - started)
+                return response
+            return dict(response, stream=_TrackedStream(self, endpoint, started, response.get('stream') or []))
+
+    def _release(self, endpoint):
+        with self._lock:
+            endpoint.outstanding -= 1
+
+    # Function to probe every endpoint once and update its health
+    def check_health(self):
+        for endpoint in self.endpoints:
+            reachable = probe_endpoint(endpoint.url, self.health_check_timeout)
+            with self._lock:
+                if reachable and not endpoint.healthy:
+                    endpoint.healthy = True
+                    endpoint.consecutive_failures = 0
+                    logger.info(f"Endpoint {endpoint.name} passed its health check, back in rotation")
+                elif not reachable and endpoint.healthy:
+                    endpoint.healthy = False
+                    endpoint.last_failure = time.monotonic()
+                    logger.warning(f"Endpoint {endpoint.name} failed its health check, taken out of rotation")
+
+    # Function to start the background health checker
+    def start(self):
+        if self.health_check_interval > 0 and self._checker is None:
+            self._checker = threading.Thread(target=self._run_checker, name='endpoint-health', daemon=True)
+            self._checker.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run_checker(self):
+        while not self._stopped.wait(self.health_check_interval):
+            try:
+                self.check_health()
+            except Exception as e:
+                logger.error(f"Endpoint health check failed: {e}")
+
+    # Function to return the routing state of every endpoint
+    # Returns:
+    #   A list of dictionaries with name, url, region, healthy, outstanding and latency_ms
+    def stats(self):
+        with self._lock:
+            return [{"name": e.name, "url": e.url, "region": e.region, "healthy": e.healthy,
+                     "outstanding": e.outstanding,
+                     "latency_ms": e.latency * 1000 if e.latency is not None else None}
+                    for e in self.endpoints]
+
+# Events of a ConverseStream call routed by the pool; the endpoint counts as busy until the stream ends or is closed
+# This is an iterator object rather than a generator so that close() releases the endpoint even when the stream was
+# never read; otherwise its outstanding count would stay raised and skew the routing away from it for good.
+class _TrackedStream:
+
+    # Args:
+    #   pool: The EndpointPool
+    #   endpoint: The Endpoint the call went to
+    #   started: perf_counter() value when the call was sent
+    #   stream: The iterable of ConverseStream events
+    def __init__(self, pool, endpoint, started, stream):
+        self._pool = pool
+        self._endpoint = endpoint
+        self._started = started
+        self._stream = stream
+        self._iterator = iter(stream)
+        self._first_event = True
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        try:
+            event = next(self._iterator)
+        except StopIteration:
+            self.close()
+            raise
+        except Exception as e:
+            if is_endpoint_failure(e):
+                self._pool.record_failure(self._endpoint)
+            self.close()
+            raise
+        if self._first_event:
+            # The time to the first event reflects the endpoint; the rest depends on the output length
+            self._pool.record_success(self._endpoint, time.perf_counter() - self._started)
+            self._first_event = False
+        return event
+
+    def close(self):
+        if self._done:
+            return
+        self._done = True
+        self._pool._release(self._endpoint)
+        if hasattr(self._stream, 'close'):
+            self._stream.close()
+
+# View of the pool used for one copy of a request that is sent more than once (see hedging.py)
+# A view has the interface of the pool and remembers the endpoints its calls were routed to; a call through one of
+# its siblings passes over those endpoints while another healthy one is available, so a duplicate request goes to a
+# different endpoint (and region, when the pool spans regions) than the original.
+class PoolView:
+
+    # Args:
+    #   pool: The EndpointPool
+    #   group: The list of sibling views this view joins
+    def __init__(self, pool, group):
+        self.pool = pool
+        self.meta = pool.meta
+        self.used = []
+        self._group = group
+        group.append(self)
+
+    # Function to return the endpoints used by the sibling views
+    def avoided(self):
+        return [endpoint for view in self._group if view is not self for endpoint in view.used]
+
+    def converse(self, **request):
+        return self.pool._route('converse', request, self)
+
+    def converse_stream(self, **request):
+        return self.pool._route('converse_stream', request, self)
+
+# Pool shared by every caller in this process; built from the [endpoints] and [routing] sections on first use
+_pool = None
+_pool_lock = threading.Lock()
+
+# Function to return the process-wide endpoint pool
+# Keys in the optional [routing] section: Policy (least-outstanding or latency), FailureThreshold,
+# HealthCheckInterval, HealthCheckTimeout
+# Returns:
+#   The EndpointPool, or None when no [endpoints] section is configured
+def get_endpoint_pool():
+    global _pool
+    settings = mc.get_settings()
+    if not settings.endpoints:
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = EndpointPool(
+                    [Endpoint(name, url, region) for name, url, region in settings.endpoints],
+                    policy=mc.getValueOrDefault('routing', 'Policy', 'least-outstanding'),
+                    failure_threshold=int(mc.getValueOrDefault('routing', 'FailureThreshold', '3')),
+                    health_check_interval=float(mc.getValueOrDefault('routing', 'HealthCheckInterval', '10')),
+                    health_check_timeout=float(mc.getValueOrDefault('routing', 'HealthCheckTimeout', '2')),
+                ).start()
+                logger.info(f"Endpoint pool with {len(settings.endpoints)} endpoints")
+    return _pool
+
+# Function to return what callers should send requests to: the endpoint pool when [endpoints] is configured,
+# otherwise the pooled runtime client for the single configured endpoint
+# Args:
+#   b_endpoint_url: The endpoint URL used when there is no pool
+#   overrides: Optional dict of botocore Config options merged over the [client] settings for that client
+# Returns:
+#   An EndpointPool or a Bedrock runtime client
+def get_runtime(b_endpoint_url, overrides=None):
+    return get_endpoint_pool() or bd.get_pooled_runtime_client(b_endpoint_url, overrides=overrides)
+
+# Function called by manageConfig when the configuration is reloaded; the pool is rebuilt on next use
+def _on_settings_changed(old_settings, new_settings, changed):
+    global _pool
+    if changed & (bd._CLIENT_SETTINGS | {'sections'}):
+        with _pool_lock:
+            stale, _pool = _pool, None
+        if stale is not None:
+            stale.stop()
+
+mc.subscribe(_on_settings_changed)
@@ -0,0 +1,385 @@
+import queue
+import threading
+import time
+
+import endpointPool
+import manageConfig as mc
+import metrics
+import modelRegistry
+from logging_setup import get_logger
+
+# Set up logging configuration (shared, non-blocking pipeline)
+logger = get_logger(__name__)
+
+# Phase label of the time to first token of a hedged request, labelled with the model and the winner: unhedged (no
+# duplicate was sent), primary (the original answered first) or hedge (the duplicate answered first); the counts per
+# winner give the hedge rate and the win rate
+RACE_PHASE = 'hedge_first_token'
+
+# Marks the end of a stream in the race queue
+_END = object()
+
+# Marks in the race queue that a copy was admitted by the rate limiter and its call is being made
+_ADMITTED = object()
+
+# Function to check whether a ConverseStream event decides the race: the first generated text, or the end of a
+# message without any text
+def is_first_token(event):
+    return 'contentBlockDelta' in event or 'messageStop' in event
+
+def _close(stream):
+    if hasattr(stream, 'close'):
+        stream.close()
+
+# Budget that caps the extra load from hedging
+# Every request earns `ratio` of a hedge, up to `burst` saved hedges, and every hedge spends one; over time at most
+# that fraction of the requests is sent twice, however slow the endpoints get.
+class HedgeBudget:
+
+    # Args:
+    #   ratio: Hedges earned per request (e.g. 0.05 for at most 5% extra requests)
+    #   burst: Largest number of hedges that can be saved up
+    def __init__(self, ratio, burst):
+        self.ratio = ratio
+        self.burst = burst
+        self._credit = burst
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._credit = min(self.burst, self._credit + self.ratio)
+
+    # Function to spend one hedge
+    # Returns:
+    #   True if the budget allowed the hedge
+    def withdraw(self):
+        with self._lock:
+            if self._credit < 1:
+                return False
+            self._credit -= 1
+            return True
+
+# One copy of a hedged request, read on its own thread until it produces its first token
+# After that the thread stops and the winner's stream is read directly by the caller. A copy that loses is cancelled:
+# its stream is closed right away, or by its thread as soon as the call or the read it is blocked in returns (a
+# generator cannot be closed while another thread is running it). A copy cancelled during its call is closed before
+# it was ever read; the streams returned by the endpoint pool, the resilience controller and the scheduler release
+# their endpoint, breaker trial and rate-limit reservation on close() whether or not they were read.
+class _Racer:
+
+    # Args:
+    #   role: 'primary' or 'hedge'
+    #   runtime: The runtime client (or pool view) to call
+    #   request: The Converse request
+    #   call: Function (runtime, request, on_admitted) that makes the call and returns its iterable of events
+    #   results: The queue the events are put on, as (racer, event) tuples
+    def __init__(self, role, runtime, request, call, results):
+        self.role = role
+        self.request = request
+        # Set once the rate limiter admitted the call; time spent waiting for a slot is not part of the hedge delay
+        # or the time to first token, since a duplicate would only wait for a slot as well
+        self.started = None
+        # Events read before the race was decided; the winner's are replayed to the caller
+        self.events = []
+        self.stream = None
+        self.error = None
+        self._runtime = runtime
+        self._call = call
+        self._results = results
+        self._lock = threading.Lock()
+        self._running = True
+        self._cancelled = False
+        threading.Thread(target=self._run, name=f'hedge-{role}', daemon=True).start()
+
+    def _run(self):
+        close = False
+        try:
+            self.stream = iter(self._call(self._runtime, self.request, on_admitted=self._admitted))
+            while not self._cancelled:
+                event = next(self.stream, _END)
+                if self._cancelled:
+                    break
+                self._results.put((self, event))
+                if event is _END or is_first_token(event):
+                    break
+        except Exception as e:
+            self._results.put((self, e))
+        finally:
+            with self._lock:
+                self._running = False
+                close = self._cancelled
+            if close:
+                _close(self.stream)
+
+    def _admitted(self):
+        self.started = time.perf_counter()
+        self._results.put((self, _ADMITTED))
+
+    # Function to cancel this copy and close its stream
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            running = self._running
+        if not running:
+            _close(self.stream)
+
+# The events of a hedged request: the original is sent at once, a duplicate follows if no token arrived within the
+# hedge delay, and the events of whichever copy produces the first token are returned
+class _HedgedStream:
+
+    # Args:
+    #   hedger: The Hedger
+    #   runtime: The runtime client or endpoint pool
+    #   request: The Converse request
+    #   call: Function (runtime, request, on_admitted) that makes the call and returns its iterable of events
+    def __init__(self, hedger, runtime, request, call):
+        self._hedger = hedger
+        self._call = call
+        self._model_id = request['modelId']
+        self._hedge_request = hedger.alternate_request(request)
+        self._delay = hedger.delay(self._model_id)
+        self._results = queue.Queue()
+        if isinstance(runtime, endpointPool.EndpointPool):
+            # The duplicate goes to another endpoint of the pool than the original went to
+            primary_runtime, self._hedge_runtime = runtime.views(2)
+        else:
+            primary_runtime = self._hedge_runtime = runtime
+        self._primary = _Racer('primary', primary_runtime, request, call, self._results)
+        self._hedge = None
+        self._events = self._read()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._events)
+
+    def _read(self):
+        winner = self._race()
+        yield from winner.events
+        yield from winner.stream
+
+    def _race(self):
+        while True:
+            timeout = None
+            # The hedge delay runs from the moment the original was admitted
+            if self._hedge is None and self._delay is not None and self._primary.started is not None:
+                timeout = self._primary.started + self._delay - time.perf_counter()
+                if timeout <= 0:
+                    self._send_hedge()
+                    continue
+            try:
+                racer, item = self._results.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if item is _ADMITTED:
+                continue
+            if isinstance(item, Exception):
+                racer.error = item
+                # A copy that is still running can answer instead; the request only fails when every copy failed
+                if self._hedge is None or (self._primary.error is not None and self._hedge.error is not None):
+                    raise self._primary.error
+                logger.warning(f"{racer.role.capitalize()} call for {self._model_id} failed with "
+                               f"{type(item).__name__}, waiting for the other copy")
+                continue
+            if item is not _END:
+                racer.events.append(item)
+            if item is _END or is_first_token(item):
+                self._decide(racer)
+                return racer
+
+    def _send_hedge(self):
+        if not self._hedger.budget.withdraw():
+            self._hedger._count('denied')
+            self._delay = None
+            logger.debug(f"Hedge budget exhausted, not hedging the request for {self._model_id}")
+            return
+        self._hedger._count('hedged')
+        logger.debug(f"No token from {self._model_id} after {self._delay:.2f}s, sending a hedge for "
+                     f"{self._hedge_request['modelId']}")
+        self._hedge = _Racer('hedge', self._hedge_runtime, self._hedge_request, self._call, self._results)
+
+    def _decide(self, winner):
+        loser = self._hedge if winner is self._primary else self._primary
+        now = time.perf_counter()
+        if loser is not None:
+            loser.cancel()
+        outcome = 'unhedged' if self._hedge is None else winner.role
+        # The original's time to first token feeds the hedge delay; when the hedge won it is at least the time so far
+        sample = None if self._primary.error is not None or self._primary.started is None \
+            else now - self._primary.started
+        self._hedger._finish(self._model_id, outcome, sample, failover=loser is not None and loser.error is not None)
+
+    # Function to stop reading; the copies still running are cancelled and their streams closed
+    def close(self):
+        self._events.close()
+        for racer in (self._primary, self._hedge):
+            if racer is not None:
+                racer.cancel()
+
+    def __del__(self):
+        # __init__ may have failed (e.g. on a malformed request) before there was anything to close
+        if getattr(self, '_events', None) is not None:
+            self.close()
+
+# Hedging policy for ConverseStream calls
+# A request that has produced no token within the hedge delay is sent again, to another endpoint of the pool when
+# [endpoints] is configured and to the model's alternate from [hedgemodels] when it has one; the first copy to produce
+# a token is used and the other is cancelled. The delay is a percentile of the model's recent time to first token,
+# so only the slow tail is hedged, and the HedgeBudget caps how many requests are sent twice.
+class Hedger:
+
+    # Args:
+    #   percentile: Percentile of the recent times to first token used as the hedge delay
+    #   min_delay: Lower bound of the hedge delay, in seconds
+    #   max_delay: Upper bound of the hedge delay, in seconds
+    #   initial_delay: Hedge delay used until min_samples times to first token were recorded for the model
+    #   min_samples: Samples needed before the percentile is used
+    #   budget_ratio: Hedges allowed per request
+    #   budget_burst: Hedges that can be saved up for a burst of slow requests
+    #   alternates: Dictionary of model id -> ModelSpec of the equivalent model a hedge is sent to
+    #   window: Number of recent times to first token kept per model
+    def __init__(self, percentile=95, min_delay=0.1, max_delay=5.0, initial_delay=2.0, min_samples=20,
+                 budget_ratio=0.05, budget_burst=5, alternates=None, window=1024):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.budget = HedgeBudget(budget_ratio, budget_burst)
+        self.alternates = alternates or {}
+        self.window = window
+        self._latency = {}
+        self._lock = threading.Lock()
+        self._counters = {"requests": 0, "hedged": 0, "denied": 0, "hedge_wins": 0, "failovers": 0}
+
+    # Function to return the current hedge delay of a model
+    # Returns:
+    #   Seconds to wait for the first token before hedging
+    def delay(self, model_id):
+        histogram = self._latency.get(model_id)
+        if histogram is None or histogram.count < self.min_samples:
+            return self.initial_delay
+        return min(self.max_delay, max(self.min_delay, histogram.percentile(self.percentile)))
+
+    # Function to return the request a hedge sends: the same request, or the request for the model's alternate
+    def alternate_request(self, request):
+        alternate = self.alternates.get(request['modelId'])
+        if alternate is None or request.get('inferenceConfig', {}).get('maxTokens', 0) > alternate.max_tokens:
+            return request
+        return dict(request, modelId=alternate.model_id)
+
+    # Function to return the events of a request, hedging it if no token arrives in time
+    # Args:
+    #   bedrock_runtime: The Bedrock runtime client or endpoint pool
+    #   request: The Converse request
+    #   call: Function (runtime, request, on_admitted) that makes the call and returns its iterable of events (e.g.
+    #         ResilienceController.converse_stream), calling on_admitted() once the rate limiter let it through;
+    #         errors are raised when the events are read
+    # Returns:
+    #   An iterator of the events, with a close() method
+    def stream(self, bedrock_runtime, request, call):
+        self._count('requests')
+        self.budget.deposit()
+        return _HedgedStream(self, bedrock_runtime, request, call)
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _finish(self, model_id, outcome, sample, failover):
+        with self._lock:
+            if outcome == 'hedge':
+                self._counters["hedge_wins"] += 1
+            if failover:
+                self._counters["failovers"] += 1
+            histogram = self._latency.get(model_id)
+            if histogram is None:
+                histogram = self._latency[model_id] = metrics.Histogram(window=self.window)
+        if sample is not None:
+            histogram.observe(sample)
+            metrics.observe_phase(RACE_PHASE, sample, model_id=model_id, winner=outcome)
+
+    # Function to return the counters
+    # Returns:
+    #   A dictionary with requests, hedged, denied (hedges the budget did not allow), hedge_wins, failovers (requests
+    #   answered by one copy after the other failed), hedge_rate, win_rate and the current delay_seconds per model
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            models = list(self._latency)
+        stats["hedge_rate"] = stats["hedged"] / stats["requests"] if stats["requests"] else 0.0
+        stats["win_rate"] = stats["hedge_wins"] / stats["hedged"] if stats["hedged"] else 0.0
+        stats["delay_seconds"] = {model_id: self.delay(model_id) for model_id in models}
+        return stats
+
+# Hedger shared by every caller in this process; built from the [hedging] and [hedgemodels] sections on first use
+_hedger = None
+_hedger_lock = threading.Lock()
+
+# Function to read the alternate models from the optional [hedgemodels] section
+# Each key is a model alias from [models] and each value the alias or model id from [models] of an equivalent model
+# (e.g. the same model through a cross-region inference profile); unknown models and alternates that need a
+# differently built request are skipped
+def _read_alternates():
+    alternates = {}
+    registry = modelRegistry.get_registry()
+    for key, value in mc.getSectionOrDefault('hedgemodels').items():
+        value = value.strip()
+        # registry.get() builds a spec for any string, so a typo would hedge every request to a model that fails
+        if key not in registry or value not in registry:
+            logger.warning(f"Ignoring hedge model {key} = {value}: both must be an alias or model id from [models]")
+            continue
+        spec, alternate = registry.get(key), registry.get(value)
+        if (spec.system_prompt, spec.prompt_caching) != (alternate.system_prompt, alternate.prompt_caching):
+            logger.warning(f"Ignoring hedge model {alternate.model_id} for {spec.model_id}: the models take "
+                           f"differently built requests")
+            continue
+        alternates[spec.model_id] = alternate
+    return alternates
+
+# Function to return the process-wide hedger
+# Keys in the optional [hedging] section: Enabled (default false), Percentile, MinDelay, MaxDelay, InitialDelay,
+# MinSamples, BudgetPercent, BudgetBurst
+# Returns:
+#   The Hedger, or None when hedging is not enabled
+def get_hedger():
+    global _hedger
+    if mc.getValueOrDefault('hedging', 'Enabled', 'false') != 'true':
+        return None
+    if _hedger is None:
+        with _hedger_lock:
+            if _hedger is None:
+                _hedger = Hedger(
+                    percentile=float(mc.getValueOrDefault('hedging', 'Percentile', '95')),
+                    min_delay=float(mc.getValueOrDefault('hedging', 'MinDelay', '0.1')),
+                    max_delay=float(mc.getValueOrDefault('hedging', 'MaxDelay', '5')),
+                    initial_delay=float(mc.getValueOrDefault('hedging', 'InitialDelay', '2')),
+                    min_samples=int(mc.getValueOrDefault('hedging', 'MinSamples', '20')),
+                    budget_ratio=float(mc.getValueOrDefault('hedging', 'BudgetPercent', '5')) / 100,
+                    budget_burst=float(mc.getValueOrDefault('hedging', 'BudgetBurst', '5')),
+                    alternates=_read_alternates(),
+                )
+                logger.info("Hedged requests enabled")
+    return _hedger
+
+# Function to make a ConverseStream call, hedged when [hedging] is enabled
+# Args:
+#   bedrock_runtime: The Bedrock runtime client or endpoint pool
+#   request: The Converse request
+#   call: Function (runtime, request, on_admitted) that makes the call and returns its iterable of events
+# Returns:
+#   An iterable of the events
+def hedged_stream(bedrock_runtime, request, call):
+    hedger = get_hedger()
+    if hedger is None:
+        return call(bedrock_runtime, request)
+    return hedger.stream(bedrock_runtime, request, call)
+
+# Function called by manageConfig when the configuration is reloaded; the hedger is rebuilt on next use
+def _on_settings_changed(old_settings, new_settings, changed):
+    global _hedger
+    if changed & {'models', 'sections'}:
+        _hedger = None
+
+mc.subscribe(_on_settings_changed)
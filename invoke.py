@@ -1,123 +1,223 @@
-import encryption as en
-import base64encode as enc
-import creds
+import argparse
 import json
-import boto3
-import datetime
+import time
 import bedrockclient as bd
+import endpointPool
 import logging
 import sys
-import botocore
-from myutils import create_complete_prompt, pretty_print, read_file_contents
+from myutils import create_complete_prompt
 import manageConfig as mc
+import modelRegistry
+import responseCache
+import metrics
+import structuredOutput
+import tokenBudget
+from promptTemplate import load_template
+from streamSinks import AccumulatorSink, MetricsSink, TerminalSink, consume, parse_events
 from logging_setup import setup_logging
 
-# Set up logging using the imported function
-setup_logging(log_level=logging.DEBUG)
+# boto3, botocore and cryptography are imported by the functions that use them, so `invoke.py --help` and the
+# modules that import helpers from here start without loading them (see startupBenchmark.py)
 
-# Function to read the contents of a file
-# Args: filename: The path to the file.
-# Returns: The contents of the file as a string.
-def read_file_contents(filename):
-    try:
-        # Open and read the file
-        with open(filename, 'r') as f:
-            file_contents = f.read()
-        return file_contents
-    except Exception as e:
-        logging.error(f"Error reading file {filename}: {e}")
-        print(f"Error reading file {filename}: {e}")
-        sys.exit(0)
+# Function to check whether prompt caching is enabled in the configuration
+# Returns:
+#   True if [default] PromptCaching is 'true'
+def prompt_caching_enabled():
+    return mc.getValueOrDefault('default', 'PromptCaching', 'false') == 'true'
+
+# Function to build the keyword arguments for a Converse/ConverseStream call
+# Args:
+#   model_id: The ID of the model to invoke
+#   system_prompt: The system prompt text (may be None or empty)
+#   user_prompt: The complete user prompt text
+#   static_prefix: Optional leading part of user_prompt that is identical across requests (e.g. the few-shot
+#                  part of prompt.txt); for models that support prompt caching it is marked with a cachePoint
+# Returns:
+#   A dictionary of keyword arguments accepted by converse and converse_stream
+# Raises:
+#   modelRegistry.UnsupportedModelOption if the request does not fit the model
+def build_converse_request(model_id, system_prompt, user_prompt, static_prefix=None):
+    # The model registry knows whether the model accepts a system prompt and cachePoint blocks
+    return modelRegistry.get_model(model_id).build_request(system_prompt, user_prompt, static_prefix)
+
+# Function to send one request over ConverseStream and process the response stream
+# Args:
+#   bedrock_runtime: The Bedrock runtime client (or endpoint pool)
+#   model_id: The ID of the model (for metrics labels)
+#   request: The Converse request
+#   output: 'text' streams the response to the terminal; 'json' collects it
+# Returns:
+#   With output 'json', a dictionary with the response, its usage and timings
+def stream_request(bedrock_runtime, model_id, request, output='text'):
+    # Call the model (or replay an identical earlier response when the response cache is enabled)
+    started = time.perf_counter()
+    stream, cached = responseCache.converse_stream_cached(bedrock_runtime, request)
+    sinks = [TerminalSink()] if output == 'text' else [AccumulatorSink(), MetricsSink(started)]
+    if not cached:
+        labels = {"model_id": model_id, "endpoint": metrics.endpoint_label(bedrock_runtime.meta.endpoint_url)}
+        metrics.observe_phase('request_send', time.perf_counter() - started, **labels)
+        sinks.append(metrics.StreamTimingSink(started, **labels))
+    # With [structured] Enabled the JSON answer is parsed while it streams, and the stream is stopped once it is in
+    structured_settings = structuredOutput.get_structured_settings()
+    structured = None
+    if structured_settings.enabled:
+        structured = structuredOutput.StructuredResponseSink(structured_settings.schema,
+                                                             stop_early=structured_settings.stop_early)
+        sinks.append(structured)
+
+    if output == 'text':
+        print("=============================")
+        print("RESULT: \n")
+        if cached:
+            print("(served from response cache)")
+
+    # Process and print the response stream
+    if stream:
+        consume(parse_events(stream), sinks)
+
+    if output == 'text' and structured is not None:
+        report = structured.result()
+        print("\n=============================")
+        print("Structured response: " + ("valid" if report["valid"] else "invalid"))
+        for problem in report["errors"] + [f"Missing field {name}" for name in report["missing"]]:
+            print(f"  {problem}")
+        if report["stopped_early"]:
+            print("(stream stopped once the JSON answer was complete)")
+
+    if output == 'json':
+        result = {"model_id": model_id, **sinks[0].result(), "max_tokens": request["inferenceConfig"]["maxTokens"],
+                  "cached": cached, "timing": sinks[1].summary()}
+        if structured is not None:
+            result["structured"] = structured.result()
+            if structured.stopped_early:
+                # The usage arrives after the text, so it is estimated for a stream stopped early
+                result["estimated_output_tokens"] = tokenBudget.estimate_tokens(sinks[0].text, model_id)
+        return result
 
 # Function to invoke the model with the provided model_id and endpoint URL
+# With [budget] Enabled = true the query file is treated as a log: duplicate entries are grouped, a log that does
+# not fit the context window is split over several requests, and maxTokens is sized to the room that is left.
 # Args: 
 #   b_endpoint_url: The endpoint URL for the Bedrock service
 #   model_id: The ID of the model to invoke
-def invokeModel(b_endpoint_url, model_id):
+#   prompt_file: The prompt template file
+#   query_file: The file substituted for {{log_entry}} in the template
+#   system_file: The system prompt file
+#   output: 'text' streams the response to the terminal; 'json' collects the response instead
+# Returns:
+#   With output 'json', a dictionary with the response, its usage and timings (with a 'parts' list of those
+#   when the log was split over several requests)
+def invokeModel(b_endpoint_url, model_id, prompt_file="prompt.txt", query_file="user-query.txt",
+                system_file="system.txt", output='text'):
+    # Only the exception class is needed here; botocore itself is already loaded by the time a call fails
+    from botocore.exceptions import ClientError
     try:
-        # Fetch the Bedrock runtime client
-        bedrock_runtime = bd.get_bedrock_runtime_client(b_endpoint_url)
+        # Reject a model that cannot be called this way before any connection is made
+        spec = modelRegistry.get_model(model_id)
+        spec.check(streaming=True)
 
-        message_list = []
+        # Fetch the Bedrock runtime client (or the endpoint pool when [endpoints] is configured)
+        bedrock_runtime = endpointPool.get_runtime(b_endpoint_url)
 
-        # Read the system prompt from a file
-        system_prompt = read_file_contents("system.txt")
+        # Read the system prompt from a file (cached until the file changes)
+        system_prompt = load_template(system_file).text
 
-        print("=============================")
-        print("Complete Prompt Context \n\n")
-        print(system_prompt)
-
-        # Create the summary message to be sent to the model
-        summary_message = {
-            "role": "user",
-            "content": []
-        }
-
-        # Check if model_id contains "titan" or "mistral" (case insensitive)
-        # Titan and Mistral models do not support system prompts with the exception of Mistral-Large-2
-        if "titan" in model_id.lower() or "mistral" in model_id.lower():
-            # Append system prompt content first
-            summary_message["content"].append({"text": system_prompt})
-            system_prompt = None  # Remove system prompt for the API call
-        
-        # Append the user query and prompt template to the message list
-        summary_message["content"].append({"text": create_complete_prompt("prompt.txt", "user-query.txt")})
-        
-        # Add the summary message to the message list
-        message_list.append(summary_message)
-
-        # Call the model with or without the system prompt based on the condition
-        response = bedrock_runtime.converse_stream(
-            modelId=model_id,
-            messages=message_list,
-            system=[{"text": system_prompt}] if system_prompt else [],
-            inferenceConfig={
-                "maxTokens": 2000,
-                "temperature": 0
-            },
-        )
-        
-        print("=============================")
-        print("RESULT: \n")
+        if output == 'text':
+            print("=============================")
+            print("Complete Prompt Context \n\n")
+            print(system_prompt)
+
+        # Build the requests, folding the system prompt into the message for models that do not support it
+        # When prompt caching is enabled the template text before {{log_entry}} is sent as a cached prefix
+        template = load_template(prompt_file)
+        static_prefix = template.static_prefix if prompt_caching_enabled() else None
+        budget = tokenBudget.get_budget_settings()
+        if budget.enabled:
+            with open(query_file, 'r') as f:
+                packed = tokenBudget.pack_prompts(spec, system_prompt, template, f.read(), budget)
+            requests = [spec.build_request(system_prompt, p.user_prompt, static_prefix, p.max_tokens) for p in packed]
+            logging.info(f"Sending {sum(p.entries for p in packed)} log entries in {sum(p.groups for p in packed)} "
+                         f"groups as {len(packed)} request(s)")
+        else:
+            requests = [build_converse_request(model_id, system_prompt, create_complete_prompt(prompt_file, query_file),
+                                               static_prefix)]
 
-        # Process and print the response stream
-        stream = response.get('stream')
-        if stream:
-            for event in stream:
-                if 'messageStart' in event:
-                    print(f"\nRole: {event['messageStart']['role']}")
-
-                if 'contentBlockDelta' in event:
-                    print(event['contentBlockDelta']['delta']['text'], end="")
-
-                if 'messageStop' in event:
-                    print(f"\n\nStop reason: {event['messageStop']['stopReason']}")
-
-                if 'metadata' in event:
-                    metadata = event['metadata']
-                    print('=====================')
-                    if 'usage' in metadata:
-                        print("\nToken usage\n")
-                        print(f"Input tokens: {metadata['usage']['inputTokens']}")
-                        print(f"Output tokens: {metadata['usage']['outputTokens']}")
-                        print(f"Total tokens: {metadata['usage']['totalTokens']}")
-                    if 'metrics' in event['metadata']:
-                        print(f"Latency: {metadata['metrics']['latencyMs']} milliseconds")
-
-    except botocore.exceptions.ClientError as error:
+        results = []
+        for part, request in enumerate(requests, 1):
+            if output == 'text' and len(requests) > 1:
+                print(f"\n===== Part {part} of {len(requests)}: {packed[part - 1].entries} log entries =====")
+            results.append(stream_request(bedrock_runtime, model_id, request, output))
+
+        if output == 'json':
+            return results[0] if len(results) == 1 else {"model_id": model_id, "parts": results}
+
+    except modelRegistry.UnsupportedModelOption as e:
+        logging.error(f"Model {model_id} cannot be invoked: {e}")
+        print(f"Model {model_id} cannot be invoked: {e}")
+        sys.exit(1)
+    except ClientError as error:
         logging.error(f"Failed to invoke model {model_id}: {error}")
         print(f"Failed to invoke model {model_id}: {error}")
-        sys.exit(0)
+        sys.exit(1)
     except Exception as e:
         logging.error(f"Unexpected error during model invocation: {e}")
         print(f"Unexpected error during model invocation: {e}")
-        sys.exit(0)
+        sys.exit(1)
+
+# Function to build the command line parser
+# Every option is optional: without --config the configuration file is asked for, and without --model the
+# model menu is shown, so running `python invoke.py` with no arguments behaves as it always has
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='Invoke a Bedrock model through the configured (VPC) endpoint.')
+    parser.add_argument('--config', help='Configuration file (asked for interactively when omitted)')
+    parser.add_argument('--model', help='Alias from [models] or model id (menu when omitted); a comma separated '
+                                        'list compares those models')
+    parser.add_argument('--prompt-file', default='prompt.txt', help='Prompt template file (default: prompt.txt)')
+    parser.add_argument('--query-file', default='user-query.txt',
+                        help='File substituted for {{log_entry}} (default: user-query.txt)')
+    parser.add_argument('--system-file', default='system.txt', help='System prompt file (default: system.txt)')
+    parser.add_argument('--output', choices=('text', 'json'), default='text',
+                        help='text streams the response; json prints one JSON document for scripts (default: text)')
+    return parser
+
+# Function to show the model menu and read the selection
+# Returns:
+#   The list of selected ModelSpecs (more than one means comparison mode)
+def select_from_menu():
+    # Get available models from the model registry (built once from the [models] section)
+    models_list = modelRegistry.get_registry().models
+
+    print("\nAvailable Models:")
+    # Print available models with their index numbers
+    for index, spec in enumerate(models_list):
+        print(f"{index}: {spec.alias}")
+
+    # Allow the user to select a model by entering its index number (several numbers compare those models)
+    selected = input("Select the model by entering the number (or several numbers separated by commas to compare them): ")
+    selected_indexes = [int(index) for index in selected.split(',')]
+
+    # Validate the selected indexes
+    if any(index < 0 or index >= len(models_list) for index in selected_indexes):
+        print("Invalid selection. Exiting...")
+        sys.exit(1)
+    return [models_list[index] for index in selected_indexes]
 
 if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    # Set up logging using the imported function (entry point only, so importing this module leaves the level alone)
+    setup_logging(log_level=logging.DEBUG)
+    text_output = args.output == 'text'
+    results_out = sys.stdout
+    if not text_output:
+        # Everything else printed on the way (prompt echo, credential notes, errors) goes to stderr so that stdout
+        # carries only the JSON document
+        sys.stdout = sys.stderr
     try:
         b_endpoint_url = ''
-        # Request the user to provide the path to the encrypted config file
-        config_file_location = input('\n\nPlease provide configuration file path including its name (if no path is provided it will look for config.properties in the same folder as main.py):  ')
+        config_file_location = args.config
+        if config_file_location is None:
+            # Request the user to provide the path to the encrypted config file
+            config_file_location = input('\n\nPlease provide configuration file path including its name (if no path is provided it will look for config.properties in the same folder as main.py):  ')
 
         # Default to "config.properties" if no path is provided
         if config_file_location == '':
@@ -127,53 +227,60 @@ if __name__ == '__main__':
         if not mc._initialize_config(config_file_location):
             logging.info(f'Please make sure the provided config file path is correct and not empty, exiting ....')
             print(f'Please make sure the provided config file path is correct and not empty, exiting .... ')
-            sys.exit(0)
-        
+            sys.exit(1)
+
+        # Set up the metrics exporter configured in the optional [metrics] section
+        metrics.configure_exporter()
+
         # Check if the config file contains the 'UseVPCe' key
         if not mc.getValue('default', 'UseVPCe'):
             logging.info(f'Ensure that UseVPCe exists in the config file, exiting....')
             print(f'Ensure that UseVPCe exists in the config file, exiting....')
-            sys.exit(0)
-        
-        # Check if 'UseVPCe' is set to 'true' or 'false'
-        elif mc.getValue('default', 'UseVPCe') == 'true':
-            # Fetch and decrypt the VPC Endpoint URL
-            decoded = enc.decode_base64_to_string(mc.getValue('default', 'VPCEndpointURL'))
-            b_endpoint_url = en.decrypt(mc.getValue('default', 'SecretKeyFernet').encode(), decoded)
-            logging.info(f'Bedrock VPCE is enabled. Here is the EndPoint URL - {b_endpoint_url}')
-            print("\nNote:")
-            print(f'Bedrock VPCE is enabled. Here is the EndPoint URL - {b_endpoint_url}')
-        else:
-            # If VPC Endpoint is not enabled, use the default Bedrock Service URL
-            b_endpoint_url = 'https://bedrock-runtime.'+ mc.getValue('default','Region')+'.amazonaws.com'
-            logging.info(f'Bedrock VPCE is not enabled. Here is the Bedrock Service URL - {b_endpoint_url}')
-            print("\nNote:")
-            print(f'Bedrock VPCE is not enabled. Using the Bedrock Service URL - {b_endpoint_url}')
-        
-        # Get available models from the configuration
-        models = mc.get_models()
-
-        # Convert the ItemsView to a list of tuples
-        models_list = list(models)
+            sys.exit(1)
 
-        print("\nAvailable Models:", models)
-        # Print available models with their index numbers
-        for index, (key, value) in enumerate(models_list):
-            print(f"{index}: {key}")
+        # Resolve the VPC Endpoint URL or the default Bedrock Service URL
+        b_endpoint_url = bd.get_runtime_endpoint_url()
+        if text_output:
+            print("\nNote:")
+            if mc.get_settings().use_vpce:
+                print(f'Bedrock VPCE is enabled. Here is the EndPoint URL - {b_endpoint_url}')
+            else:
+                print(f'Bedrock VPCE is not enabled. Using the Bedrock Service URL - {b_endpoint_url}')
 
-        # Allow the user to select a model by entering its index number
-        selected_index = int(input("Select the model by entering the number: ")) 
+        if args.model is None:
+            specs = select_from_menu()
+        else:
+            # Same resolution rules as compareModels --models: configured aliases or model ids
+            import compareModels
+            specs = compareModels.select_models(args.model)
+            if not specs:
+                print("No model given with --model. Exiting...")
+                sys.exit(1)
 
-        # Validate the selected index
-        if selected_index < 0 or selected_index >= len(models_list):
-            print("Invalid selection. Exiting...")
-            sys.exit(0)
+        if len(specs) > 1:
+            # Comparison mode: the same prompt goes to every selected model in parallel
+            import compareModels
+            static_prefix = load_template(args.prompt_file).static_prefix if prompt_caching_enabled() else None
+            runs = compareModels.compare_models(endpointPool.get_runtime(b_endpoint_url), specs,
+                                                load_template(args.system_file).text,
+                                                create_complete_prompt(args.prompt_file, args.query_file), static_prefix,
+                                                progress=text_output)
+            summaries = compareModels.summarize(specs, runs)
+            if text_output:
+                print("\n" + compareModels.format_table(summaries))
+            else:
+                print(json.dumps({"summary": summaries, "runs": runs}, indent=2), file=results_out)
+            sys.exit(0 if all("error" not in run for run in runs) else 1)
 
-        print("\n\nModel Selected: "+ models_list[selected_index][1]+ "\n\n")
+        if text_output:
+            print("\n\nModel Selected: "+ specs[0].model_id+ "\n\n")
         # Invoking the selected model
-        invokeModel(b_endpoint_url, models_list[selected_index][1])
+        result = invokeModel(b_endpoint_url, specs[0].model_id, args.prompt_file, args.query_file, args.system_file,
+                             args.output)
+        if result is not None:
+            print(json.dumps(result, indent=2), file=results_out)
 
     except Exception as e:
         logging.error(f"Unexpected error in the main block: {e}")
         print(f"Unexpected error: {e}")
-        sys.exit(0)
+        sys.exit(1)
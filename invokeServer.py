@@ -0,0 +1,426 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import signal
+import sys
+import time
+
+import bedrockclient as bd
+import configWatcher
+import endpointPool
+import hedging
+import manageConfig as mc
+import metrics
+import modelRegistry
+import requestScheduler
+import structuredOutput
+from asyncbedrockclient import AsyncBedrockRuntime
+from invoke import prompt_caching_enabled
+from logging_setup import setup_logging, shutdown_logging
+from promptTemplate import load_template
+from streamSinks import Metadata, MessageStop, TextDelta, parse_events
+
+# Set up logging using the imported function
+setup_logging(log_level=logging.INFO)
+
+# Largest request head and body the server accepts
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+            500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+# Raised while handling a request to answer with an HTTP error
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+# Function to return the usage fields sent to the client for a Metadata event
+def _metadata_payload(event):
+    return {"usage": event.usage, "latency_ms": event.latency_ms,
+            "cache_read_input_tokens": event.cache_read_input_tokens,
+            "cache_write_input_tokens": event.cache_write_input_tokens}
+
+# Expected JSON types of the optional /invoke fields (bool is excluded from the numbers, since it is an int in Python)
+_PAYLOAD_FIELDS = {
+    'model': ((str,), 'a string'),
+    'variables': ((dict,), 'a JSON object'),
+    'stream': ((bool,), 'true or false'),
+    'structured': ((bool,), 'true or false'),
+    'priority': ((str,), 'a string'),
+    'tenant': ((str,), 'a string'),
+    'timeout': ((int, float), 'a number of seconds'),
+}
+
+# Function to check the shape of an /invoke body before any of it is used
+# Args:
+#   payload: The parsed JSON body
+# Raises:
+#   HttpError 400 if the body is not an object or a field has the wrong type
+def _check_payload(payload):
+    if not isinstance(payload, dict):
+        raise HttpError(400, "Body must be a JSON object")
+    for name, (types, description) in _PAYLOAD_FIELDS.items():
+        value = payload.get(name)
+        if value is not None and (not isinstance(value, types) or (isinstance(value, bool) and bool not in types)):
+            raise HttpError(400, f"'{name}' must be {description}")
+    if payload.get('timeout') is not None and payload['timeout'] <= 0:
+        raise HttpError(400, "'timeout' must be a positive number of seconds")
+
+# Local HTTP service that keeps the configuration, decrypted settings, model registry, templates and runtime
+# client loaded between requests
+# Routes:
+#   POST /invoke   {"model": alias or model id, "variables": {...}, "stream": true/false}
+#                  streams Server-Sent Events when the client accepts text/event-stream, chunked JSON lines
+#                  otherwise, or a single JSON document when "stream" is false
+#   GET  /models   the configured models and their capabilities
+#   GET  /ready    200 once started and until shutdown begins, 503 otherwise (for load balancer health checks)
+#   GET  /healthz  200 while the process is up
+#   GET  /metrics  the client-side latency histograms in the Prometheus text format
+class InvokeServer:
+
+    # Args:
+    #   host: The interface to listen on
+    #   port: The port to listen on
+    #   max_concurrent: Model calls in flight at once
+    #   max_queued: Requests allowed to wait for a slot; further requests get 503 straight away
+    #   drain_seconds: Seconds in-flight requests get to finish on shutdown
+    #   prompt_file: The prompt template rendered with the request variables
+    #   system_file: The system prompt file
+    def __init__(self, host='127.0.0.1', port=8080, max_concurrent=16, max_queued=64, drain_seconds=30,
+                 prompt_file='prompt.txt', system_file='system.txt'):
+        self.host = host
+        self.port = port
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.drain_seconds = drain_seconds
+        self.prompt_file = prompt_file
+        self.system_file = system_file
+        self.ready = False
+        self.in_flight = 0
+        self.runtime = None
+        self._server = None
+        self._slots = None
+        self._idle = None
+
+    # Function to do the per-process work once: settings, model registry, templates and the runtime client
+    def prepare(self):
+        started = time.perf_counter()
+        mc.get_settings()
+        modelRegistry.get_registry()
+        load_template(self.prompt_file)
+        load_template(self.system_file)
+        bedrock_runtime = endpointPool.get_runtime(bd.get_runtime_endpoint_url())
+        self.runtime = AsyncBedrockRuntime(bedrock_runtime.meta.endpoint_url, bedrock_runtime)
+        logging.info(f"Invocation server prepared in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    # Function to run the server until SIGINT or SIGTERM, then drain and stop
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                  limit=MAX_HEADER_BYTES)
+        self.ready = True
+        logging.info(f"Invocation server listening on http://{self.host}:{self.port}")
+        print(f"Invocation server listening on http://{self.host}:{self.port} (Ctrl+C to stop)")
+        await stop.wait()
+        await self.shutdown()
+
+    # Function to stop gracefully: fail readiness and refuse new invocations (the listener stays open so the load
+    # balancer sees /ready fail), let in-flight requests finish, then close the listener
+    async def shutdown(self):
+        self.ready = False
+        logging.info(f"Shutting down, waiting for {self.in_flight} in-flight requests")
+        try:
+            await asyncio.wait_for(self._idle.wait(), self.drain_seconds)
+        except asyncio.TimeoutError:
+            logging.warning(f"{self.in_flight} requests still running after {self.drain_seconds}s, stopping anyway")
+        self._server.close()
+        self.runtime.close()
+        logging.info("Invocation server stopped")
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            method, path, headers, body = await self._read_request(reader)
+            await self._route(method, path, headers, body, writer)
+        except HttpError as e:
+            await self._send_json(writer, e.status, {"error": e.message})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logging.error(f"Unexpected error while handling a request: {e}")
+            await self._send_json(writer, 500, {"error": str(e)})
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except (ConnectionError, RuntimeError):
+                pass
+
+    async def _read_request(self, reader):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.LimitOverrunError:
+            raise HttpError(413, "Request head too large")
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, path, _version = lines[0].split(' ', 2)
+        except ValueError:
+            raise HttpError(400, "Malformed request line")
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_BODY_BYTES:
+            raise HttpError(413, "Request body too large")
+        body = await reader.readexactly(length) if length else b''
+        return method, path.split('?', 1)[0], headers, body
+
+    async def _route(self, method, path, headers, body, writer):
+        if path == '/healthz':
+            await self._send_json(writer, 200, {"status": "ok"})
+        elif path == '/ready':
+            await self._send_json(writer, 200 if self.ready else 503,
+                                  {"ready": self.ready, "in_flight": self.in_flight})
+        elif path == '/models':
+            await self._send_json(writer, 200, {"models": [
+                {"alias": s.alias, "model_id": s.model_id, "system_prompt": s.system_prompt, "streaming": s.streaming,
+                 "prompt_caching": s.prompt_caching, "context_window": s.context_window, "max_tokens": s.max_tokens}
+                for s in modelRegistry.get_registry().models]})
+        elif path == '/scheduler':
+            scheduler = requestScheduler.get_scheduler()
+            await self._send_json(writer, 200, scheduler.stats() if scheduler is not None else {"enabled": False})
+        elif path == '/hedging':
+            hedger = hedging.get_hedger()
+            await self._send_json(writer, 200, hedger.stats() if hedger is not None else {"enabled": False})
+        elif path == '/metrics':
+            await self._send(writer, 200, 'text/plain; version=0.0.4',
+                             metrics.render_prometheus(metrics.get_registry()).encode())
+        elif path == '/invoke':
+            if method != 'POST':
+                raise HttpError(405, "Use POST for /invoke")
+            await self._invoke(headers, body, writer)
+        else:
+            raise HttpError(404, f"Unknown path {path}")
+
+    # Function to parse an /invoke body into a Converse request
+    # Returns:
+    #   A tuple (spec, request, stream, structured, ticket); ticket is None unless the request scheduler is enabled
+    def _build_request(self, headers, body):
+        try:
+            payload = json.loads(body or b'{}')
+        except ValueError as e:
+            raise HttpError(400, f"Body is not valid JSON: {e}")
+        _check_payload(payload)
+        if not payload.get('model'):
+            raise HttpError(400, "Missing 'model' (an alias from [models] or a model id)")
+        registry = modelRegistry.get_registry()
+        if payload['model'] not in registry and '.' not in payload['model']:
+            raise HttpError(400, f"Unknown model {payload['model']}")
+        spec = registry.get(payload['model'])
+        template = load_template(self.prompt_file)
+        variables = {name: str(value) for name, value in (payload.get('variables') or {}).items()}
+        # Templates render leniently, but a request to the server has to fill in every placeholder
+        missing = template.missing(**variables)
+        if missing:
+            raise HttpError(400, f"No value provided for placeholder {missing[0]} in template {self.prompt_file}")
+        user_prompt = template.render(**variables)
+        static_prefix = template.static_prefix if prompt_caching_enabled() else None
+        try:
+            spec.check(streaming=True)
+            request = spec.build_request(load_template(self.system_file).text, user_prompt, static_prefix)
+        except modelRegistry.UnsupportedModelOption as e:
+            raise HttpError(400, str(e))
+        structured = payload.get('structured', structuredOutput.get_structured_settings().enabled)
+        try:
+            # The tenant can also be set by a gateway in front of the server
+            ticket = requestScheduler.make_ticket(payload.get('priority'),
+                                                  payload.get('tenant') or headers.get('x-tenant'), payload.get('timeout'))
+        except ValueError as e:
+            raise HttpError(400, str(e))
+        return spec, request, payload.get('stream', True), structured, ticket
+
+    async def _invoke(self, headers, body, writer):
+        if not self.ready:
+            raise HttpError(503, "Server is shutting down")
+        if self.in_flight >= self.max_concurrent + self.max_queued:
+            raise HttpError(503, "Too many requests queued")
+        spec, request, stream, structured, ticket = self._build_request(headers, body)
+
+        self.in_flight += 1
+        self._idle.clear()
+        grant = None
+        try:
+            if ticket is not None:
+                # The scheduler decides which queued request goes next (by priority class and tenant), in place of
+                # the first-come-first-served slots; a request that cannot finish before its deadline is refused
+                try:
+                    grant = await requestScheduler.get_scheduler().admit_async(ticket, request)
+                except requestScheduler.DeadlineExceeded as e:
+                    raise HttpError(503, str(e))
+            async with (self._slots if grant is None else contextlib.nullcontext()):
+                started = time.perf_counter()
+                labels = {"model_id": spec.model_id, "endpoint": metrics.endpoint_label(self.runtime.endpoint_url)}
+                timing = metrics.StreamTimingSink(started, **labels)
+                parser = None
+                if structured:
+                    settings = structuredOutput.get_structured_settings()
+                    parser = structuredOutput.StructuredResponseSink(settings.schema, stop_early=settings.stop_early)
+                events = self._typed_events(self.runtime.converse_stream(ticket=grant, **request), timing, parser)
+                try:
+                    if not stream:
+                        await self._respond_whole(writer, events)
+                    elif 'text/event-stream' in headers.get('accept', ''):
+                        await self._respond_sse(writer, events)
+                    else:
+                        await self._respond_chunked(writer, events)
+                finally:
+                    await events.aclose()
+                    timing.close()
+        finally:
+            if grant is not None:
+                grant.release()
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self._idle.set()
+
+    # Function to turn the raw model stream into typed events
+    # With a StructuredResponseSink, every completed JSON field is yielded as a JsonField right after the delta that
+    # completed it; once the answer is complete a MessageStop('json_complete') ends the stream early.
+    async def _typed_events(self, raw_events, timing, parser=None):
+        try:
+            async for raw in raw_events:
+                for event in parse_events([raw]):
+                    timing.on_event(event)
+                    yield event
+                    if parser is not None and isinstance(event, TextDelta):
+                        for field in parser.feed(event.text):
+                            yield field
+                        if parser.stopped_early:
+                            yield MessageStop('json_complete')
+                            return
+        finally:
+            # Stops the model stream (and frees its connection) when the client went away mid-response
+            await raw_events.aclose()
+
+    async def _respond_whole(self, writer, events):
+        text, result = [], {}
+        async for event in events:
+            if isinstance(event, TextDelta):
+                text.append(event.text)
+            elif isinstance(event, MessageStop):
+                result["stop_reason"] = event.stop_reason
+            elif isinstance(event, Metadata):
+                result.update(_metadata_payload(event))
+            elif isinstance(event, structuredOutput.JsonField) and len(event.path) == 1:
+                result.setdefault("fields", {})[event.path[0]] = event.value
+        await self._send_json(writer, 200, {"output": "".join(text), **result})
+
+    async def _respond_sse(self, writer, events):
+        writer.write(self._head(200, 'text/event-stream', extra={'Cache-Control': 'no-cache'}))
+        try:
+            async for event in events:
+                name, data = self._event_payload(event)
+                if name:
+                    writer.write(f"event: {name}\ndata: {json.dumps(data)}\n\n".encode())
+                    await writer.drain()
+        except Exception as e:
+            # The status line is already sent, so the error is reported as a final event
+            writer.write(f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n".encode())
+        await writer.drain()
+
+    async def _respond_chunked(self, writer, events):
+        writer.write(self._head(200, 'application/x-ndjson', extra={'Transfer-Encoding': 'chunked'}))
+        try:
+            async for event in events:
+                name, data = self._event_payload(event)
+                if name:
+                    self._write_chunk(writer, (json.dumps({"type": name, **data}) + "\n").encode())
+                    await writer.drain()
+        except Exception as e:
+            self._write_chunk(writer, (json.dumps({"type": "error", "error": str(e)}) + "\n").encode())
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+    @staticmethod
+    def _event_payload(event):
+        if isinstance(event, TextDelta):
+            return 'delta', {"text": event.text}
+        if isinstance(event, MessageStop):
+            return 'stop', {"stop_reason": event.stop_reason}
+        if isinstance(event, Metadata):
+            return 'metadata', _metadata_payload(event)
+        if isinstance(event, structuredOutput.JsonField):
+            return 'field', {"path": list(event.path), "value": event.value}
+        return None, None
+
+    @staticmethod
+    def _write_chunk(writer, data):
+        writer.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+
+    @staticmethod
+    def _head(status, content_type, length=None, extra=None):
+        lines = [f"HTTP/1.1 {status} {_REASONS.get(status, '')}", f"Content-Type: {content_type}", "Connection: close"]
+        if length is not None:
+            lines.append(f"Content-Length: {length}")
+        for name, value in (extra or {}).items():
+            lines.append(f"{name}: {value}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+    async def _send(self, writer, status, content_type, data):
+        writer.write(self._head(status, content_type, len(data)) + data)
+        await writer.drain()
+
+    async def _send_json(self, writer, status, body):
+        await self._send(writer, status, 'application/json', json.dumps(body).encode())
+
+# Function to build the server from the optional [server] section
+# Keys: Host, Port, MaxConcurrent, MaxQueued, DrainSeconds, PromptFile, SystemFile
+def server_from_config(host=None, port=None):
+    return InvokeServer(
+        host=host or mc.getValueOrDefault('server', 'Host', '127.0.0.1'),
+        port=port or int(mc.getValueOrDefault('server', 'Port', '8080')),
+        max_concurrent=int(mc.getValueOrDefault('server', 'MaxConcurrent', '16')),
+        max_queued=int(mc.getValueOrDefault('server', 'MaxQueued', '64')),
+        drain_seconds=float(mc.getValueOrDefault('server', 'DrainSeconds', '30')),
+        prompt_file=mc.getValueOrDefault('server', 'PromptFile', 'prompt.txt'),
+        system_file=mc.getValueOrDefault('server', 'SystemFile', 'system.txt'),
+    )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve Bedrock model invocations over HTTP with streaming responses.')
+    parser.add_argument('--config', default='config.properties', help='Configuration file (default: config.properties)')
+    parser.add_argument('--host', help='Interface to listen on (default: [server] Host or 127.0.0.1)')
+    parser.add_argument('--port', type=int, help='Port to listen on (default: [server] Port or 8080)')
+    args = parser.parse_args()
+
+    watcher = None
+    try:
+        if not mc._initialize_config(args.config):
+            print(f'Please make sure the provided config file path is correct and not empty, exiting .... ')
+            sys.exit(1)
+        metrics.configure_exporter()
+        # Pick up changes to the configuration file while the server runs
+        watcher = configWatcher.start_config_watcher_from_config('server')
+        server = server_from_config(args.host, args.port)
+        server.prepare()
+        asyncio.run(server.serve())
+    except Exception as e:
+        logging.error(f"Invocation server failed: {e}")
+        print(f"Invocation server failed: {e}")
+        sys.exit(1)
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        shutdown_logging()
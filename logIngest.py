@@ -0,0 +1,463 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import bedrockclient as bd
+import configWatcher
+import endpointPool
+import manageConfig as mc
+import metrics
+import modelRegistry
+import resilience
+import responseCache
+import tokenBudget
+from batchInvoke import converse_once
+from invoke import build_converse_request, prompt_caching_enabled
+from myutils import render_prompt
+from promptTemplate import load_template
+from logging_setup import setup_logging, shutdown_logging
+
+# Longest line kept from a log file; the rest of a longer line is dropped so one bad line cannot exhaust memory
+MAX_LINE_BYTES = 64 * 1024
+
+# Lines read from one file per round before moving to the next file, so a busy file cannot starve the others
+LINES_PER_ROUND = 500
+
+# nginx error log line: "2023/05/21 18:15:45 [crit] 12345#12345: *5432109 message"
+_NGINX_ERROR = re.compile(r'^(?P<time>\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2}) \[(?P<level>\w+)\] \d+#\d+: '
+                          r'(?:\*\d+ )?(?P<message>.*)$')
+
+# nginx levels sent to the model by default
+DEFAULT_LEVELS = ('error', 'crit', 'alert', 'emerg')
+
+# Function to follow a log file like `tail -F`
+# The generator never ends: it yields each complete line as it is written and None whenever there is nothing new,
+# so several files can be followed from one thread. When the file is rotated (a new file appears at the path) the
+# rest of the old file is read before switching; when it is truncated in place (copytruncate) reading restarts at
+# the beginning.
+# Args:
+#   path: The log file
+#   from_start: Read the lines already in the file; otherwise only lines written from now on. A file that does not
+#               exist yet, or that replaces a rotated one, is always read from its start.
+# Returns:
+#   A generator of lines (without the line break) and None
+def follow(path, from_start=False):
+    f = None
+    identity = None
+    partial = b''
+    try:
+        while True:
+            if f is None:
+                try:
+                    f = open(path, 'rb')
+                except FileNotFoundError:
+                    # Everything in a file created from now on is new
+                    from_start = True
+                    yield None
+                    continue
+                stat = os.fstat(f.fileno())
+                identity = (stat.st_dev, stat.st_ino)
+                if not from_start:
+                    f.seek(0, os.SEEK_END)
+                from_start = True
+                partial = b''
+
+            line = f.readline(MAX_LINE_BYTES)
+            if line:
+                if line.endswith(b'\n'):
+                    yield (partial + line).rstrip(b'\r\n').decode('utf-8', errors='replace')
+                    partial = b''
+                elif len(partial) < MAX_LINE_BYTES:
+                    # Keep an incomplete last line (or the start of an overlong one) until its line break arrives
+                    partial = (partial + line)[:MAX_LINE_BYTES]
+                continue
+
+            # At the end of the file: check for rotation and truncation before reporting that there is nothing new
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            if stat is not None and (stat.st_dev, stat.st_ino) != identity:
+                logging.info(f"{path} was rotated, following the new file")
+                f.close()
+                f = None
+                continue
+            if stat is not None and stat.st_size < f.tell():
+                logging.info(f"{path} was truncated, reading from the start")
+                f.seek(0)
+                partial = b''
+            yield None
+    finally:
+        if f is not None:
+            f.close()
+
+# Function to follow several log files from one thread
+# Args:
+#   paths: The log files
+#   from_start: See follow()
+#   poll_interval: Seconds to wait when no file has new lines
+#   stop: threading.Event that ends the generator
+# Returns:
+#   A generator of (path, line) tuples, and None after every round (so consumers can act on time even while the
+#   files are busy with lines they drop)
+def tail_files(paths, from_start=False, poll_interval=0.5, stop=None):
+    stop = stop or threading.Event()
+    followers = [(path, follow(path, from_start)) for path in paths]
+    try:
+        while not stop.is_set():
+            idle = True
+            for path, follower in followers:
+                for _ in range(LINES_PER_ROUND):
+                    line = next(follower)
+                    if line is None:
+                        break
+                    idle = False
+                    yield path, line
+            if idle:
+                stop.wait(poll_interval)
+            yield None
+    finally:
+        for _, follower in followers:
+            follower.close()
+
+# One error line picked up from a log file
+@dataclass
+class LogEvent:
+    source: str
+    time: str
+    level: str
+    message: str
+    line: str
+    fingerprint: str
+    # Occurrences of the same fingerprint suppressed since this error was last sent to the model
+    repeats_suppressed: int = 0
+
+# Function to parse an nginx error log line
+# Args:
+#   source: The file the line came from
+#   line: The line
+#   levels: The levels to keep
+# Returns:
+#   A LogEvent, or None for other lines and other levels
+def parse_error_line(source, line, levels=DEFAULT_LEVELS):
+    match = _NGINX_ERROR.match(line)
+    if match is None or match.group('level') not in levels:
+        return None
+    fingerprint = error_fingerprint(match.group('level'), match.group('message'))
+    return LogEvent(source, match.group('time'), match.group('level'), match.group('message'), line, fingerprint)
+
+# Function to fingerprint an error: a hash of its level and its message with the variable parts (addresses,
+# numbers, ids) removed, so repeats of the same problem share a fingerprint
+def error_fingerprint(level, message):
+    signature = f"{level} {tokenBudget.log_signature(message)}"
+    return hashlib.sha1(signature.encode('utf-8')).hexdigest()[:16]
+
+# Remembers which fingerprints were sent recently and suppresses repeats within a time window
+# Memory is bounded: at most max_fingerprints are remembered, the ones sent longest ago are forgotten first.
+class DuplicateSuppressor:
+
+    # Args:
+    #   window_seconds: How long after sending an error its repeats are suppressed
+    #   max_fingerprints: Most fingerprints remembered at once
+    def __init__(self, window_seconds=300, max_fingerprints=10000):
+        self.window_seconds = window_seconds
+        self.max_fingerprints = max_fingerprints
+        # fingerprint -> [monotonic time last sent, repeats suppressed since], oldest send first
+        self._seen = OrderedDict()
+        self.suppressed = 0
+
+    # Function to decide whether an event is sent to the model
+    # Returns:
+    #   True if the event should be sent; its repeats_suppressed is then set to the repeats dropped since the
+    #   previous send
+    def admit(self, event, now=None):
+        now = time.monotonic() if now is None else now
+        entry = self._seen.get(event.fingerprint)
+        if entry is not None and now - entry[0] < self.window_seconds:
+            entry[1] += 1
+            self.suppressed += 1
+            return False
+        event.repeats_suppressed = entry[1] if entry is not None else 0
+        self._seen[event.fingerprint] = [now, 0]
+        self._seen.move_to_end(event.fingerprint)
+        while len(self._seen) > self.max_fingerprints:
+            self._seen.popitem(last=False)
+        return True
+
+# Function to group events into micro-batches
+# A batch is emitted when it has batch_size events or when its oldest event has waited max_wait seconds.
+# Args:
+#   events: A generator of LogEvent objects and None ticks
+#   batch_size: Most events per batch
+#   max_wait: Most seconds an event waits for its batch to fill
+# Returns:
+#   A generator of lists of LogEvent objects
+def micro_batches(events, batch_size=20, max_wait=5.0):
+    batch = []
+    deadline = None
+    for event in events:
+        if event is not None:
+            if not batch:
+                deadline = time.monotonic() + max_wait
+            batch.append(event)
+        if batch and (len(batch) >= batch_size or time.monotonic() >= deadline):
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Counters of one ingestion run
+class IngestStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.lines = 0
+        self.events = 0
+        self.suppressed = 0
+        self.batches = 0
+        self.failed_batches = 0
+
+    def add(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def summary(self):
+        with self._lock:
+            return {"lines": self.lines, "events": self.events, "suppressed": self.suppressed,
+                    "batches": self.batches, "failed_batches": self.failed_batches}
+
+# Writes one JSON result per line, flushed after every record so a tailing reader sees it straight away
+class JsonlResultSink:
+    def __init__(self, path):
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+# Pipeline from log files to the model: tail -> parse and fingerprint -> suppress duplicates -> micro-batch ->
+# bounded queue -> worker threads -> JSONL sink
+# The reading side is a chain of generators on one thread. When the workers fall behind, the queue fills up and the
+# reader blocks, so unread lines stay in the log files instead of piling up in memory.
+class LogIngestor:
+
+    # Args:
+    #   bedrock_runtime: The Bedrock runtime client (or endpoint pool)
+    #   spec: The ModelSpec of the model
+    #   system_prompt: The system prompt text
+    #   template: The compiled prompt template; the batch is substituted for {{log_entry}}
+    #   sink: The JsonlResultSink receiving one record per request
+    #   paths: The log files to follow
+    #   levels: The nginx levels to send
+    #   batch_size, batch_wait: See micro_batches()
+    #   window_seconds: Duplicate suppression window
+    #   queue_size: Batches waiting for a worker before the reader blocks
+    #   workers: Concurrent model calls
+    #   from_start: Read the lines already in the files
+    #   poll_interval: Seconds between checks of idle files
+    def __init__(self, bedrock_runtime, spec, system_prompt, template, sink, paths, levels=DEFAULT_LEVELS,
+                 batch_size=20, batch_wait=5.0, window_seconds=300, queue_size=8, workers=2, from_start=False,
+                 poll_interval=0.5):
+        self.bedrock_runtime = bedrock_runtime
+        self.spec = spec
+        self.system_prompt = system_prompt
+        self.template = template
+        self.sink = sink
+        self.paths = list(paths)
+        self.levels = tuple(levels)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.suppressor = DuplicateSuppressor(window_seconds)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.workers = workers
+        self.from_start = from_start
+        self.poll_interval = poll_interval
+        self.stats = IngestStats()
+        self.stop_event = threading.Event()
+
+    # Function to turn tailed lines into events that pass duplicate suppression (None ticks pass through)
+    def _events(self, lines):
+        for item in lines:
+            if item is None:
+                yield None
+                continue
+            self.stats.add(lines=1)
+            event = parse_error_line(item[0], item[1], self.levels)
+            if event is None:
+                continue
+            if self.suppressor.admit(event):
+                self.stats.add(events=1)
+                yield event
+            else:
+                self.stats.add(suppressed=1)
+
+    # Function to render a batch as the {{log_entry}} content
+    @staticmethod
+    def render_batch(batch):
+        lines = []
+        for event in batch:
+            lines.append(event.line)
+            if event.repeats_suppressed:
+                lines.append(f"(seen {event.repeats_suppressed} more times since it was last reported)")
+        return "\n".join(lines)
+
+    # Function to build the requests for a batch (several when [budget] splits an oversized batch)
+    def _build_requests(self, batch):
+        static_prefix = self.template.static_prefix if prompt_caching_enabled() else None
+        content = self.render_batch(batch)
+        budget = tokenBudget.get_budget_settings()
+        if budget.enabled:
+            packed = tokenBudget.pack_prompts(self.spec, self.system_prompt, self.template, content, budget)
+            return [self.spec.build_request(self.system_prompt, p.user_prompt, static_prefix, p.max_tokens)
+                    for p in packed]
+        return [build_converse_request(self.spec.model_id, self.system_prompt, render_prompt(self.template, content),
+                                       static_prefix)]
+
+    # Function to send one batch and write its result records
+    def _process(self, number, batch, queued_at):
+        metrics.observe_phase('ingest_queue_wait', time.monotonic() - queued_at, model_id=self.spec.model_id)
+        events = [{"source": e.source, "time": e.time, "level": e.level, "fingerprint": e.fingerprint,
+                   "repeats_suppressed": e.repeats_suppressed} for e in batch]
+        started = time.perf_counter()
+        try:
+            requests = self._build_requests(batch)
+            for part, request in enumerate(requests, 1):
+                record = {"batch": number, "model_id": self.spec.model_id, "events": events}
+                if len(requests) > 1:
+                    record["part"] = part
+                record.update(converse_once(self.bedrock_runtime, request))
+                record["status"] = "ok"
+                record["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                self.sink.write(record)
+            self.stats.add(batches=1)
+        except Exception as e:
+            logging.error(f"Ingestion batch {number} failed: {e}")
+            self.stats.add(batches=1, failed_batches=1)
+            self.sink.write({"batch": number, "model_id": self.spec.model_id, "events": events, "status": "error",
+                             "error": {"code": resilience.error_code(e) or type(e).__name__, "message": str(e)},
+                             "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)})
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self._process(*item)
+
+    # Function to run the pipeline until stop() is called
+    # Batches already read are sent before this returns.
+    def run(self):
+        threads = [threading.Thread(target=self._worker, name=f'ingest-worker-{i}', daemon=True)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        number = 0
+        try:
+            lines = tail_files(self.paths, self.from_start, self.poll_interval, self.stop_event)
+            for batch in micro_batches(self._events(lines), self.batch_size, self.batch_wait):
+                number += 1
+                # Blocks while the queue is full: this is where backpressure stops the reading
+                self.queue.put((number, batch, time.monotonic()))
+        finally:
+            for _ in threads:
+                self.queue.put(None)
+            for thread in threads:
+                thread.join()
+        return self.stats.summary()
+
+    def stop(self):
+        self.stop_event.set()
+
+# Function to read a setting of the optional [ingest] section, preferring the command line value
+def _setting(value, key, default, convert=str):
+    if value is not None:
+        return value
+    return convert(mc.getValueOrDefault('ingest', key, default))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Follow nginx error logs and send new errors to a Bedrock model in micro-batches.')
+    parser.add_argument('files', nargs='*', help='Log files to follow (default: [ingest] Files)')
+    parser.add_argument('--config', default='config.properties', help='Configuration file (default: config.properties)')
+    parser.add_argument('--model', help='Model alias from [models] or model id (default: [ingest] Model)')
+    parser.add_argument('--output', help='JSONL file results are appended to (default: [ingest] Output or ingest-results.jsonl)')
+    parser.add_argument('--from-start', action='store_true', help='Also process the lines already in the files')
+    parser.add_argument('--levels', help='Comma separated nginx levels to send (default: error,crit,alert,emerg)')
+    parser.add_argument('--batch-size', type=int, help='Most errors per request (default: 20)')
+    parser.add_argument('--batch-wait', type=float, help='Most seconds an error waits for its batch (default: 5)')
+    parser.add_argument('--window', type=float, help='Seconds repeats of a sent error are suppressed (default: 300)')
+    parser.add_argument('--queue-size', type=int, help='Batches waiting for a worker before reading pauses (default: 8)')
+    parser.add_argument('--workers', type=int, help='Concurrent model calls (default: 2)')
+    parser.add_argument('--prompt-file', help='Prompt template file (default: [ingest] PromptFile or prompt.txt)')
+    parser.add_argument('--system-file', help='System prompt file (default: [ingest] SystemFile or system.txt)')
+    args = parser.parse_args()
+
+    setup_logging(log_level=logging.INFO)
+    watcher = None
+    try:
+        if not mc._initialize_config(args.config):
+            print(f'Please make sure the provided config file path is correct and not empty, exiting .... ')
+            sys.exit(1)
+        metrics.configure_exporter()
+        # Pick up changes to the configuration file (endpoints, credentials, limits) while following the logs
+        watcher = configWatcher.start_config_watcher_from_config('ingest')
+
+        files = args.files or [f.strip() for f in mc.getValueOrDefault('ingest', 'Files', '').split(',') if f.strip()]
+        model = _setting(args.model, 'Model', '')
+        if not files or not model:
+            print("Give the log files and --model (or [ingest] Files and Model)")
+            sys.exit(1)
+        spec = modelRegistry.get_model(model)
+        # Cached responses are replayed as streams, so the model must support streaming when the cache is on
+        spec.check(streaming=responseCache.get_response_cache() is not None)
+
+        output = _setting(args.output, 'Output', 'ingest-results.jsonl')
+        sink = JsonlResultSink(output)
+        ingestor = LogIngestor(
+            endpointPool.get_runtime(bd.get_runtime_endpoint_url()), spec,
+            load_template(_setting(args.system_file, 'SystemFile', 'system.txt')).text,
+            load_template(_setting(args.prompt_file, 'PromptFile', 'prompt.txt')), sink, files,
+            levels=[level.strip() for level in _setting(args.levels, 'Levels', ','.join(DEFAULT_LEVELS)).split(',')],
+            batch_size=_setting(args.batch_size, 'BatchSize', '20', int),
+            batch_wait=_setting(args.batch_wait, 'BatchWaitSeconds', '5', float),
+            window_seconds=_setting(args.window, 'DuplicateWindowSeconds', '300', float),
+            queue_size=_setting(args.queue_size, 'QueueSize', '8', int),
+            workers=_setting(args.workers, 'Workers', '2', int),
+            from_start=args.from_start,
+            poll_interval=float(mc.getValueOrDefault('ingest', 'PollInterval', '0.5')),
+        )
+        # SIGTERM and Ctrl+C stop reading; the batches already read are still sent
+        signal.signal(signal.SIGTERM, lambda *_: ingestor.stop())
+        signal.signal(signal.SIGINT, lambda *_: ingestor.stop())
+
+        print(f"Following {', '.join(files)} with model {spec.model_id}, results in {output} (Ctrl+C to stop)")
+        logging.info(f"Log ingestion started for {files} with model {spec.model_id}")
+        summary = ingestor.run()
+        sink.close()
+        logging.info(f"Log ingestion stopped: {summary}")
+        print(f"Stopped: {summary['lines']} lines read, {summary['events']} errors sent in {summary['batches']} "
+              f"batches ({summary['failed_batches']} failed), {summary['suppressed']} repeats suppressed")
+    except Exception as e:
+        logging.error(f"Log ingestion failed: {e}")
+        print(f"Log ingestion failed: {e}")
+        sys.exit(1)
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        shutdown_logging()
@@ -1,25 +1,92 @@
+import atexit
 import logging
-import os
+import logging.handlers
+import queue
+import threading
+
+# Shared logging state: every module logs through a single QueueHandler on the root logger, and one
+# QueueListener thread does the formatting and the file writes, so callers never block on disk I/O.
+_listener = None
+_setup_lock = threading.Lock()
+
+# When enabled, per-lookup configuration access logs are skipped (see manageConfig.getValue)
+_hot_path = False
+
+# QueueHandler that enqueues the record as-is; the message is only formatted by the listener thread,
+# and only if a handler actually emits it
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
 
 def setup_logging(log_level=logging.INFO, log_format=None, log_file=None):
-    if log_format is None:
-        log_format = '%(asctime)s - %(name)s - %(filename)s - %(levelname)s - %(message)s'
-
-    # If no log_file is provided, create one based on the script's name
-    if log_file is None:
-        script_name = os.path.basename(__file__)
-        log_file = script_name.replace('.py', '.log')
-
-    # Clear previous logging handlers to avoid duplication
-    for handler in logging.root.handlers[:]:
-        logging.root.removeHandler(handler)
-
-    # Set up file handler to log only to the file
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setLevel(log_level)
-    file_handler.setFormatter(logging.Formatter(log_format))
-
-    # Get the root logger and add only the file handler
-    logger = logging.getLogger()
-    logger.setLevel(log_level)
-    logger.addHandler(file_handler)
+    """
+    Configures the shared, non-blocking logging pipeline. The first call installs the queue handler and starts the
+    listener that writes to the log file; later calls only adjust the root log level, so modules can call this at
+    import time without reopening files or replacing handlers.
+
+    :param log_level: The root log level.
+    :param log_format: The format used for the log file (first call only).
+    :param log_file: The log file (first call only). Defaults to invoke.log.
+    """
+    global _listener
+    with _setup_lock:
+        logging.getLogger().setLevel(log_level)
+        if _listener is not None:
+            return
+
+        if log_format is None:
+            log_format = '%(asctime)s - %(name)s - %(filename)s - %(levelname)s - %(message)s'
+        if log_file is None:
+            log_file = 'invoke.log'
+
+        # Clear previous logging handlers to avoid duplication
+        for handler in logging.root.handlers[:]:
+            logging.root.removeHandler(handler)
+
+        # The file handler is owned by the listener thread; it is opened on the first record
+        file_handler = logging.FileHandler(log_file, delay=True)
+        file_handler.setFormatter(logging.Formatter(log_format))
+
+        log_queue = queue.SimpleQueue()
+        logging.getLogger().addHandler(_LazyQueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+def shutdown_logging():
+    """
+    Flushes pending records and stops the listener thread. Called automatically at interpreter exit.
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+            _listener = None
+
+def get_logger(name):
+    """
+    Returns a module logger that writes through the shared pipeline, configuring it with defaults if needed.
+
+    :param name: The logger name, usually __name__.
+    :return: The logger.
+    """
+    if _listener is None:
+        setup_logging()
+    return logging.getLogger(name)
+
+def set_hot_path(enabled):
+    """
+    Enables or disables hot-path mode, which skips configuration access logs on the request path.
+
+    :param enabled: True to skip the logs.
+    """
+    global _hot_path
+    _hot_path = enabled
+
+def is_hot_path():
+    """
+    :return: True if hot-path mode is enabled.
+    """
+    return _hot_path
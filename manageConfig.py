@@ -2,30 +2,52 @@ import encryption as en
 import base64encode as enc
 import logging
 import configparser
-from logging_setup import setup_logging
+import threading
+from dataclasses import dataclass, field, fields
+from typing import Any, Optional, Tuple
+from logging_setup import get_logger, set_hot_path, is_hot_path
+import metrics
 
-# Set up logging using the imported function
-setup_logging(log_level=logging.INFO)
+# Make sure the shared logging pipeline is installed; the log level is left to the entry point
+get_logger(__name__)
 
 # Initialize the config object at the module level to hold the configuration
 _config = None
+_config_file_path = 'config.properties'
+
+# Decrypted settings snapshot built from _config (see get_settings)
+_settings = None
+_settings_lock = threading.Lock()
+
+# Callbacks notified with (old_settings, new_settings, changed_field_names) whenever the settings are swapped
+_subscribers = []
 
 # Function to initialize the configuration by reading the config file
 # Args:
-#   file_path: The path to the configuration file. Defaults to 'config.properties'.
+#   file_path: The path to the configuration file. Defaults to the file already loaded, or 'config.properties'.
 # Returns:
 #   True if the initialization is successful
-def _initialize_config(file_path='config.properties'):
-    global _config
+def _initialize_config(file_path=None):
+    global _config, _config_file_path
+    if _config is not None and file_path is not None and file_path != _config_file_path:
+        # A different file is asked for after one was already loaded (e.g. a module read a value at import time
+        # before the entry point parsed --config): switch to it, rebuilding the settings if they were built already
+        if _settings is not None:
+            reload_settings(file_path)
+            return True
+        _config = None
     if _config is None:
+        file_path = file_path or _config_file_path
         try:
             # Create a ConfigParser object to read the configuration file
             config = configparser.ConfigParser()
             config.optionxform = str  # Disable case folding for option names (case-sensitive keys)
             
             # Read the configuration file
-            config.read(file_path)
+            with metrics.timer('config_load'):
+                config.read(file_path)
             _config = config
+            _config_file_path = file_path
             logging.info(f"Configuration initialized from {file_path}")
         except FileNotFoundError as e:
             logging.error(f"Configuration file not found: {file_path}")
@@ -43,7 +65,7 @@ def _initialize_config(file_path='config.properties'):
 # Returns:
 #   True if the reinitialization is successful
 def _reinitialize_config(file_path='config.properties'):
-    global _config
+    global _config, _config_file_path
     try:
         # Create a new ConfigParser object to reload the configuration file
         config = configparser.ConfigParser()
@@ -52,6 +74,7 @@ def _reinitialize_config(file_path='config.properties'):
         # Read the configuration file
         config.read(file_path)
         _config = config
+        _config_file_path = file_path
         logging.info(f"Configuration reinitialized from {file_path}")
     except FileNotFoundError as e:
         logging.error(f"Configuration file not found: {file_path}")
@@ -71,9 +94,12 @@ def _reinitialize_config(file_path='config.properties'):
 #   The value corresponding to the provided section and key
 def getValue(section, key):
     try:
-        _initialize_config()  # Ensure the config is initialized
+        if _config is None:
+            _initialize_config()  # Ensure the config is initialized
         value = _config[section].get(key)
-        logging.info(f"Retrieved value for {key} in section {section}: {value}")
+        # Values are never logged since several of them are secrets; the access itself is skipped on the hot path
+        if not is_hot_path():
+            logging.debug("Retrieved value for %s in section %s", key, section)
         return value
     except KeyError as e:
         logging.error(f"KeyError: {e} - Section: '{section}', Key: '{key}' not found.")
@@ -84,6 +110,32 @@ def getValue(section, key):
         print(f"Failed to get value from config: {e}")
         raise e  # Re-raise the exception after logging
 
+# Function to retrieve a value from an optional section of the configuration
+# Args:
+#   section: The section in the configuration file where the key is located
+#   key: The key whose value needs to be retrieved
+#   default: The value returned when the section or key is not present
+# Returns:
+#   The value corresponding to the provided section and key, or the default
+def getValueOrDefault(section, key, default=None):
+    if _config is None:
+        _initialize_config()  # Ensure the config is initialized
+    if not _config.has_section(section):
+        return default
+    return _config[section].get(key, default)
+
+# Function to retrieve every key and value of an optional section of the configuration
+# Args:
+#   section: The section in the configuration file
+# Returns:
+#   A dict of the section's keys and values, in file order (empty when the section is not present)
+def getSectionOrDefault(section):
+    if _config is None:
+        _initialize_config()  # Ensure the config is initialized
+    if not _config.has_section(section):
+        return {}
+    return dict(_config[section].items())
+
 # Function to set a value in the configuration
 # Args:
 #   section: The section in the configuration file where the key is located
@@ -95,7 +147,7 @@ def setValue(section, key, value):
     try:
         _initialize_config()  # Ensure the config is initialized
         _config.set(section, key, value)
-        logging.info(f"Set value for {key} in section {section} to {value}")
+        logging.info(f"Set value for {key} in section {section}")
         return True
     except Exception as e:
         logging.error(f"Failed to set value in config: {e}")
@@ -153,3 +205,167 @@ def get_models():
         print(f"Error fetching models: {e}")
         raise e  # Re-raise the exception after logging
     return []
+
+# Immutable, already-decrypted view of the configuration
+# Encrypted values are decrypted once when the snapshot is built; fields that are not needed for the configured
+# UseVPCe / GetCredentialsFrom options are left as None so placeholder values are never decrypted.
+@dataclass(frozen=True)
+class Settings:
+    file_path: str
+    use_vpce: bool
+    get_credentials_from: str
+    region: str
+    vpc_endpoint_url: Optional[str]
+    assume_role_arn: Optional[str]
+    access_key: Optional[str] = field(repr=False)
+    secret_key: Optional[str] = field(repr=False)
+    prompt_file_path: Optional[str]
+    debug: bool
+    models: Tuple[Tuple[str, str], ...]
+    client: Tuple[Tuple[str, str], ...]
+    # (name, url, region) of every endpoint in the optional [endpoints] section; empty when it is not present
+    endpoints: Tuple[Tuple[str, str, str], ...]
+    # Every other optional section as (name, items); used to detect changes, read the values through getValueOrDefault
+    sections: Tuple[Tuple[str, Tuple[Tuple[str, str], ...]], ...]
+    fernet: Any = field(repr=False, compare=False)
+
+    # The Bedrock runtime endpoint: the VPC Endpoint URL when enabled, otherwise the public regional URL
+    @property
+    def runtime_endpoint_url(self):
+        if self.use_vpce:
+            return self.vpc_endpoint_url
+        return 'https://bedrock-runtime.' + self.region + '.amazonaws.com'
+
+# Function to parse one entry of the [endpoints] section
+# Each value is "url" or "url, region"; a value that is not a URL is taken as encrypted (see encryptConfig.py)
+# Args:
+#   name: The endpoint name
+#   value: The configured value
+#   default_region: The Region from [default], used when the entry has no region
+#   decrypt_value: Function that decrypts an encrypted value
+# Returns:
+#   A tuple (name, url, region)
+def _parse_endpoint(name, value, default_region, decrypt_value):
+    if not value.startswith(('http://', 'https://')):
+        value = decrypt_value(value)
+    url, _, region = (part.strip() for part in value.partition(','))
+    return (name, url, region or default_region)
+
+# Function to build a Settings snapshot from a parsed configuration
+# Args:
+#   config: A ConfigParser holding the configuration
+#   file_path: The path the configuration was read from
+# Returns:
+#   A Settings object
+def _build_settings(config, file_path):
+    if not config.has_section('default'):
+        raise ValueError(f"Section 'default' not found in configuration file {file_path}")
+    default = config['default']
+    if default.get('UseVPCe') not in ('true', 'false'):
+        raise ValueError(f"UseVPCe must be 'true' or 'false' in configuration file {file_path}")
+    if default.get('GetCredentialsFrom') not in ('0', '1', '2'):
+        raise ValueError(f"GetCredentialsFrom must be 0, 1 or 2 in configuration file {file_path}")
+    if not default.get('Region'):
+        raise ValueError(f"Region is not set in configuration file {file_path}")
+    use_vpce = default.get('UseVPCe') == 'true'
+    get_credentials_from = default.get('GetCredentialsFrom')
+
+    fernet = None
+    def decrypt_value(value):
+        nonlocal fernet
+        with metrics.timer('decryption'):
+            if fernet is None:
+                fernet = en.get_fernet(default['SecretKeyFernet'].encode())
+            return en.decrypt_with(fernet, enc.decode_base64_to_string(value))
+
+    def decrypt(key):
+        return decrypt_value(default[key])
+
+    return Settings(
+        file_path=file_path,
+        use_vpce=use_vpce,
+        get_credentials_from=get_credentials_from,
+        region=default.get('Region'),
+        vpc_endpoint_url=decrypt('VPCEndpointURL') if use_vpce else None,
+        assume_role_arn=decrypt('AssumeRoleARN') if get_credentials_from in ('1', '2') else None,
+        access_key=decrypt('AccessKey') if get_credentials_from == '2' else None,
+        secret_key=decrypt('SecretKey') if get_credentials_from == '2' else None,
+        prompt_file_path=default.get('PromptFilePath'),
+        debug=default.get('Debug', 'false') == 'true',
+        models=tuple(config['models'].items()) if config.has_section('models') else (),
+        client=tuple(config['client'].items()) if config.has_section('client') else (),
+        endpoints=tuple(_parse_endpoint(name, value, default.get('Region'), decrypt_value)
+                        for name, value in config['endpoints'].items()) if config.has_section('endpoints') else (),
+        sections=tuple((name, tuple(config[name].items())) for name in config.sections()
+                       if name not in ('default', 'models', 'client', 'endpoints')),
+        fernet=fernet,
+    )
+
+# Function to return the decrypted settings, building them from the loaded configuration on first use
+# Returns:
+#   The current Settings object
+def get_settings():
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _initialize_config(_config_file_path)
+                _set_settings(_build_settings(_config, _config_file_path))
+    return _settings
+
+# Function to re-read the configuration file and rebuild the decrypted settings
+# The file is parsed and validated before anything is replaced; if it is invalid the current configuration stays
+# in place and the error is raised. The parsed config and the settings are swapped together, and subscribers are
+# notified of the fields that changed.
+# Args:
+#   file_path: The path to the configuration file; defaults to the file that was last loaded
+# Returns:
+#   The new Settings object
+def reload_settings(file_path=None):
+    global _config, _config_file_path
+    file_path = file_path or _config_file_path
+    config = configparser.ConfigParser()
+    config.optionxform = str  # Disable case folding for option names (case-sensitive keys)
+    with metrics.timer('config_load'):
+        if not config.read(file_path):
+            raise FileNotFoundError(f"Configuration file not found: {file_path}")
+    new_settings = _build_settings(config, file_path)
+
+    with _settings_lock:
+        old_settings = _settings
+        _config = config
+        _config_file_path = file_path
+        _set_settings(new_settings)
+    logging.info(f"Settings reloaded from {file_path}")
+
+    if old_settings is not None:
+        changed = {f.name for f in fields(Settings)
+                   if f.compare and getattr(old_settings, f.name) != getattr(new_settings, f.name)}
+        if changed:
+            _notify_subscribers(old_settings, new_settings, changed)
+    return new_settings
+
+# Function to register a callback for settings changes
+# Args:
+#   callback: Called as callback(old_settings, new_settings, changed) where changed is a set of Settings field names
+def subscribe(callback):
+    if callback not in _subscribers:
+        _subscribers.append(callback)
+
+# Function to remove a callback registered with subscribe
+def unsubscribe(callback):
+    if callback in _subscribers:
+        _subscribers.remove(callback)
+
+def _notify_subscribers(old_settings, new_settings, changed):
+    logging.info(f"Settings changed: {sorted(changed)}")
+    for callback in list(_subscribers):
+        try:
+            callback(old_settings, new_settings, changed)
+        except Exception as e:
+            logging.error(f"Settings subscriber {callback} failed: {e}")
+
+def _set_settings(settings):
+    global _settings
+    _settings = settings
+    # Configuration access logs are only written when Debug is enabled
+    set_hot_path(not settings.debug)
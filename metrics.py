@@ -0,0 +1,225 @@
+import atexit
+import bisect
+import json
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from logging_setup import get_logger
+from streamSinks import StreamSink, TextDelta
+
+# Set up logging configuration (shared, non-blocking pipeline)
+logger = get_logger(__name__)
+
+# Name of the histogram that records every client-side phase; the phase is a label
+PHASE_METRIC = 'bedrock_client_phase_seconds'
+
+# Bucket upper bounds in seconds, from sub-millisecond token gaps up to long generations
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Bucket upper bounds of histograms that do not record seconds (e.g. queue depths), by metric name
+METRIC_BUCKETS = {
+    'bedrock_scheduler_queue_depth': (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+}
+
+# Histogram with fixed buckets for export plus a window of recent samples for percentiles
+class Histogram:
+
+    # Args:
+    #   buckets: Sorted bucket upper bounds
+    #   window: Number of recent samples kept for percentile estimates
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=1024):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self._recent.append(value)
+
+    # Function to estimate a percentile from the recent samples
+    # Args:
+    #   p: The percentile, between 0 and 100
+    # Returns:
+    #   The estimated value, or None if nothing was observed yet
+    def percentile(self, p):
+        with self._lock:
+            samples = sorted(self._recent)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def snapshot(self):
+        with self._lock:
+            return {"count": self.count, "sum": self.sum, "buckets": list(zip(self.buckets, self.counts)),
+                    "overflow": self.counts[-1]}
+
+# Registry of histograms keyed by metric name and labels
+class MetricsRegistry:
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    # Function to return the histogram for a metric and label set, creating it on first use
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(METRIC_BUCKETS.get(name, DEFAULT_BUCKETS)))
+        return histogram
+
+    # Function to record a value (in seconds, or in the unit of a METRIC_BUCKETS metric) and pass it on to push-based
+    # exporters
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+        for listener in self._listeners:
+            listener(name, value, labels)
+
+    # Function to time a block of code
+    # Args:
+    #   phase: The phase label (e.g. config_load, client_construction)
+    #   labels: Additional labels (e.g. model_id, endpoint)
+    @contextmanager
+    def timer(self, phase, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(PHASE_METRIC, time.perf_counter() - started, phase=phase, **labels)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    # Function to return every histogram with its labels
+    # Returns:
+    #   A list of (name, labels dict, Histogram) tuples
+    def items(self):
+        with self._lock:
+            return [(name, dict(labels), histogram) for (name, labels), histogram in self._histograms.items()]
+
+# Function to render a registry in the Prometheus text exposition format
+def render_prometheus(registry):
+    lines = []
+    seen = set()
+    for name, labels, histogram in sorted(registry.items(), key=lambda item: (item[0], sorted(item[1].items()))):
+        if name not in seen:
+            lines.append(f"# TYPE {name} histogram")
+            seen.add(name)
+        snapshot = histogram.snapshot()
+        label_text = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+        series = f"{{{label_text}}}" if label_text else ""
+        prefix = label_text + "," if label_text else ""
+        cumulative = 0
+        for bound, count in snapshot["buckets"]:
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {snapshot["count"]}')
+        lines.append(f'{name}_sum{series} {snapshot["sum"]}')
+        lines.append(f'{name}_count{series} {snapshot["count"]}')
+    return "\n".join(lines) + "\n"
+
+# Function to render a registry as a JSON document with counts, sums and percentiles per series
+def render_json(registry):
+    series = []
+    for name, labels, histogram in registry.items():
+        snapshot = histogram.snapshot()
+        series.append({"name": name, "labels": labels, "count": snapshot["count"], "sum": snapshot["sum"],
+                       "p50": histogram.percentile(50), "p95": histogram.percentile(95),
+                       "p99": histogram.percentile(99)})
+    return json.dumps({"timestamp": time.time(), "series": series}, indent=2)
+
+# Push exporter that sends every observation to StatsD as a timer (tags in the DogStatsD format)
+class StatsdExporter:
+    def __init__(self, host='127.0.0.1', port=8125, prefix='bedrock'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, name, value, labels):
+        metric = f"{self.prefix}.{labels.get('phase', name)}"
+        tags = ",".join(f"{key}:{tag}" for key, tag in sorted(labels.items()) if key != 'phase')
+        # Durations are sent as timers in milliseconds, other values (e.g. queue depths) as gauges
+        packet = (f"{metric}:{value:g}|g" if name in METRIC_BUCKETS else f"{metric}:{value * 1000:.3f}|ms") + \
+            (f"|#{tags}" if tags else "")
+        try:
+            self._socket.sendto(packet.encode(), self.address)
+        except OSError as e:
+            logger.debug("Unable to send metric to StatsD: %s", e)
+
+# Function to write the registry to a file in Prometheus text or JSON format
+def write_metrics_file(registry, path, fmt='json'):
+    with open(path, 'w') as f:
+        f.write(render_prometheus(registry) if fmt == 'prometheus' else render_json(registry))
+
+# Registry shared by every module in this process
+_registry = MetricsRegistry()
+_exporter_configured = False
+
+def get_registry():
+    return _registry
+
+# Function to time a phase in the shared registry
+def timer(phase, **labels):
+    return _registry.timer(phase, **labels)
+
+# Function to record a phase duration (in seconds) in the shared registry
+def observe_phase(phase, seconds, **labels):
+    _registry.observe(PHASE_METRIC, seconds, phase=phase, **labels)
+
+# Function to return the endpoint label for a runtime endpoint URL (or an endpoint pool, see endpointPool.py)
+def endpoint_label(b_endpoint_url):
+    if (b_endpoint_url or '').startswith('pool:'):
+        return 'pool'
+    return 'vpce' if '.vpce.' in (b_endpoint_url or '') else 'public'
+
+# Function to set up the exporter from the optional [metrics] section
+# Keys: Exporter (none, prometheus, json or statsd), Path (prometheus/json file written at exit),
+#       StatsdHost, StatsdPort, StatsdPrefix
+def configure_exporter():
+    global _exporter_configured
+    if _exporter_configured:
+        return
+    _exporter_configured = True
+    import manageConfig as mc
+    exporter = mc.getValueOrDefault('metrics', 'Exporter', 'none')
+    if exporter == 'statsd':
+        _registry.add_listener(StatsdExporter(mc.getValueOrDefault('metrics', 'StatsdHost', '127.0.0.1'),
+                                              mc.getValueOrDefault('metrics', 'StatsdPort', '8125'),
+                                              mc.getValueOrDefault('metrics', 'StatsdPrefix', 'bedrock')))
+    elif exporter in ('prometheus', 'json'):
+        path = mc.getValueOrDefault('metrics', 'Path', 'metrics.prom' if exporter == 'prometheus' else 'metrics.json')
+        atexit.register(write_metrics_file, _registry, path, exporter)
+    logger.info("Metrics exporter: %s", exporter)
+
+# Sink that records time to first token, inter-token gaps and stream completion for one request
+class StreamTimingSink(StreamSink):
+
+    # Args:
+    #   started: perf_counter() value when the request was sent
+    #   labels: Labels for every observation (model_id, endpoint)
+    def __init__(self, started, **labels):
+        self.started = started
+        self.labels = labels
+        self._last_token_at = None
+
+    def on_event(self, event):
+        if isinstance(event, TextDelta):
+            now = time.perf_counter()
+            if self._last_token_at is None:
+                observe_phase('time_to_first_token', now - self.started, **self.labels)
+            else:
+                observe_phase('inter_token', now - self._last_token_at, **self.labels)
+            self._last_token_at = now
+
+    def close(self):
+        observe_phase('stream_completion', time.perf_counter() - self.started, **self.labels)
@@ -0,0 +1,210 @@
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import manageConfig as mc
+from logging_setup import get_logger
+
+# Set up logging configuration (shared, non-blocking pipeline)
+logger = get_logger(__name__)
+
+# Cross-region inference profile prefixes that may precede a model id (e.g. us.anthropic.claude-...)
+INFERENCE_PROFILE_PREFIXES = ('us', 'eu', 'apac')
+
+# Capabilities by model id prefix; the first matching prefix wins, so more specific prefixes come first
+# system_prompt: accepts Converse system blocks (otherwise the system prompt is folded into the user message)
+# prompt_caching: accepts cachePoint blocks
+# context_window: input plus output tokens the model can handle in one request
+# max_tokens: largest maxTokens the model accepts
+# prices: on-demand (input, output) USD per 1K tokens in us-east-1, used for cost estimates only
+MODEL_CAPABILITIES = (
+    ('anthropic.claude-3-5-haiku', dict(prompt_caching=True, context_window=200000, max_tokens=8192, prices=(0.0008, 0.004))),
+    ('anthropic.claude-3-5-sonnet', dict(context_window=200000, max_tokens=8192, prices=(0.003, 0.015))),
+    ('anthropic.claude-3-7-sonnet', dict(prompt_caching=True, context_window=200000, max_tokens=8192, prices=(0.003, 0.015))),
+    ('anthropic.claude-sonnet-4', dict(prompt_caching=True, context_window=200000, max_tokens=8192, prices=(0.003, 0.015))),
+    ('anthropic.claude-opus-4', dict(prompt_caching=True, context_window=200000, max_tokens=8192, prices=(0.015, 0.075))),
+    ('anthropic.claude-3-opus', dict(context_window=200000, max_tokens=4096, prices=(0.015, 0.075))),
+    ('anthropic.claude-3-sonnet', dict(context_window=200000, max_tokens=4096, prices=(0.003, 0.015))),
+    ('anthropic.claude-3-haiku', dict(context_window=200000, max_tokens=4096, prices=(0.00025, 0.00125))),
+    ('anthropic.claude-v2', dict(context_window=100000, max_tokens=4096, prices=(0.008, 0.024))),
+    ('meta.llama3-1-405b', dict(context_window=128000, max_tokens=2048, prices=(0.00532, 0.016))),
+    ('meta.llama3-1-70b', dict(context_window=128000, max_tokens=2048, prices=(0.00099, 0.00099))),
+    ('meta.llama3-1-8b', dict(context_window=128000, max_tokens=2048, prices=(0.00022, 0.00022))),
+    ('meta.llama3-8b', dict(context_window=8192, max_tokens=2048, prices=(0.0003, 0.0006))),
+    # Mistral Large 2 is the only Mistral model that accepts a system prompt
+    ('mistral.mistral-large-2', dict(context_window=128000, max_tokens=8192, prices=(0.002, 0.006))),
+    ('mistral.mistral-7b', dict(system_prompt=False, context_window=32000, max_tokens=8192, prices=(0.00015, 0.0002))),
+    ('mistral.mixtral-8x7b', dict(system_prompt=False, context_window=32000, max_tokens=4096, prices=(0.00045, 0.0007))),
+    ('mistral.', dict(system_prompt=False, context_window=32000, max_tokens=4096)),
+    ('amazon.titan-text-lite', dict(system_prompt=False, context_window=4096, max_tokens=4096, prices=(0.00015, 0.0002))),
+    ('amazon.titan-text-express', dict(system_prompt=False, context_window=8192, max_tokens=8192, prices=(0.0002, 0.0006))),
+    ('amazon.titan-', dict(system_prompt=False, context_window=4096, max_tokens=4096)),
+    ('amazon.nova-micro', dict(prompt_caching=True, context_window=128000, max_tokens=5000, prices=(0.000035, 0.00014))),
+    ('amazon.nova-lite', dict(prompt_caching=True, context_window=300000, max_tokens=5000, prices=(0.00006, 0.00024))),
+    ('amazon.nova-pro', dict(prompt_caching=True, context_window=300000, max_tokens=5000, prices=(0.0008, 0.0032))),
+    ('amazon.nova-', dict(prompt_caching=True, context_window=128000, max_tokens=5000)),
+)
+
+# Capabilities assumed for a model that is not in the table
+DEFAULT_CAPABILITIES = dict(system_prompt=True, streaming=True, prompt_caching=False, context_window=8192,
+                            max_tokens=4096, prices=None)
+
+# Raised when a request asks for something the model does not support
+class UnsupportedModelOption(ValueError):
+    pass
+
+# Function to strip a cross-region inference profile prefix from a model id
+def base_model_id(model_id):
+    prefix, _, rest = model_id.partition('.')
+    return rest if prefix in INFERENCE_PROFILE_PREFIXES and rest else model_id
+
+# Function to look up the capabilities of a model id in MODEL_CAPABILITIES
+# Returns:
+#   A dictionary with every key of DEFAULT_CAPABILITIES
+def lookup_capabilities(model_id):
+    base_id = base_model_id(model_id)
+    for prefix, capabilities in MODEL_CAPABILITIES:
+        if base_id.startswith(prefix):
+            return {**DEFAULT_CAPABILITIES, **capabilities}
+    return dict(DEFAULT_CAPABILITIES)
+
+# Request builder for models that accept Converse system blocks
+def _build_with_system(system_prompt, content):
+    return ([{"text": system_prompt}] if system_prompt else []), content
+
+# Request builder for models without system prompt support: the system prompt becomes the first user block
+def _build_inline_system(system_prompt, content):
+    return [], ([{"text": system_prompt}] if system_prompt else []) + content
+
+# Everything the client needs to know about one model, computed once when the registry is built
+@dataclass(frozen=True)
+class ModelSpec:
+    alias: Optional[str]
+    model_id: str
+    system_prompt: bool
+    streaming: bool
+    prompt_caching: bool
+    context_window: int
+    max_tokens: int
+    prices: Optional[tuple]
+    builder: Any = field(repr=False, compare=False)
+
+    # Function to build the keyword arguments for a Converse/ConverseStream call to this model
+    # Args:
+    #   system_prompt: The system prompt text (may be None or empty)
+    #   user_prompt: The complete user prompt text
+    #   static_prefix: Optional leading part of user_prompt that is identical across requests; it is marked with
+    #                  a cachePoint when the model supports prompt caching
+    #   max_tokens: The maxTokens of the request
+    #   temperature: The temperature of the request
+    # Returns:
+    #   A dictionary of keyword arguments accepted by converse and converse_stream
+    # Raises:
+    #   UnsupportedModelOption if max_tokens is above what the model accepts
+    def build_request(self, system_prompt, user_prompt, static_prefix=None, max_tokens=2000, temperature=0):
+        if max_tokens > self.max_tokens:
+            raise UnsupportedModelOption(f"{self.model_id} accepts at most {self.max_tokens} output tokens, "
+                                         f"{max_tokens} requested")
+        cache_prefix = bool(static_prefix) and self.prompt_caching and user_prompt.startswith(static_prefix)
+        if cache_prefix:
+            # Only the suffix after the cachePoint is sent as fresh input tokens
+            content = [{"text": static_prefix}, {"cachePoint": {"type": "default"}}]
+            if len(user_prompt) > len(static_prefix):
+                content.append({"text": user_prompt[len(static_prefix):]})
+        else:
+            content = [{"text": user_prompt}]
+        system, content = self.builder(system_prompt, content)
+        if cache_prefix and system:
+            system.append({"cachePoint": {"type": "default"}})
+        return {
+            "modelId": self.model_id,
+            "messages": [{"role": "user", "content": content}],
+            "system": system,
+            "inferenceConfig": {"maxTokens": max_tokens, "temperature": temperature},
+        }
+
+    # Function to check that the model supports the way it is about to be called
+    # Raises:
+    #   UnsupportedModelOption if streaming is requested from a model that cannot stream
+    def check(self, streaming=False):
+        if streaming and not self.streaming:
+            raise UnsupportedModelOption(f"{self.model_id} does not support ConverseStream")
+
+    # Function to estimate the cost of a call from its usage
+    # Args:
+    #   usage: The usage dictionary of a Converse response or metadata event
+    # Returns:
+    #   The estimated cost in USD, or None when the model's prices are unknown
+    def estimate_cost(self, usage):
+        if not self.prices or not usage:
+            return None
+        return (usage.get('inputTokens', 0) * self.prices[0] + usage.get('outputTokens', 0) * self.prices[1]) / 1000
+
+# Function to build the ModelSpec of a model id
+# Args:
+#   model_id: The model id
+#   alias: The alias from the [models] section, if any
+def build_spec(model_id, alias=None):
+    capabilities = lookup_capabilities(model_id)
+    return ModelSpec(alias=alias, model_id=model_id,
+                     builder=_build_with_system if capabilities['system_prompt'] else _build_inline_system,
+                     **capabilities)
+
+# Models from the [models] section indexed by alias and by model id
+class ModelRegistry:
+
+    # Args:
+    #   models: An iterable of (alias, model_id) pairs in menu order
+    def __init__(self, models):
+        self.models = [build_spec(model_id, alias) for alias, model_id in models]
+        self._by_key = {}
+        for spec in self.models:
+            self._by_key.setdefault(spec.alias, spec)
+            self._by_key.setdefault(spec.model_id, spec)
+        self._lock = threading.Lock()
+
+    # Function to return the spec of a model
+    # Args:
+    #   name: An alias from the [models] section or a model id; model ids that are not configured get a spec built
+    #         from MODEL_CAPABILITIES on first use
+    # Returns:
+    #   The ModelSpec
+    def get(self, name):
+        spec = self._by_key.get(name)
+        if spec is None:
+            with self._lock:
+                spec = self._by_key.setdefault(name, build_spec(name))
+        return spec
+
+    def __contains__(self, name):
+        return name in self._by_key
+
+    # Function to resolve an alias or model id to the model id
+    def resolve(self, name):
+        return self.get(name).model_id
+
+# Registry shared by every caller in this process; built from the [models] section on first use
+_registry = None
+_registry_lock = threading.Lock()
+
+# Function to return the process-wide model registry
+def get_registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ModelRegistry(mc.get_settings().models)
+                logger.info(f"Model registry built with {len(_registry.models)} models")
+    return _registry
+
+# Function to return the spec of a model by alias or model id
+def get_model(name):
+    return get_registry().get(name)
+
+# Function called by manageConfig when the configuration is reloaded; the registry is rebuilt on next use
+def _on_settings_changed(old_settings, new_settings, changed):
+    global _registry
+    if 'models' in changed:
+        _registry = None
+
+mc.subscribe(_on_settings_changed)
@@ -2,10 +2,11 @@
 import textwrap
 import logging
 from enum import Enum
-from logging_setup import setup_logging
+from logging_setup import get_logger
+from promptTemplate import PromptTemplate, load_template
 
-# Set up logging using the imported function
-setup_logging(log_level=logging.INFO)
+# Make sure the shared logging pipeline is installed; the log level is left to the entry point
+get_logger(__name__)
 
 
 def pretty_print(text):
@@ -43,30 +44,51 @@ def read_file_contents(file_name):
         logging.error(error_message)
         return error_message
 
-def create_complete_prompt(template_file, content_file):
+def render_prompt(template, content, **variables):
     """
-    Reads the prompt template and content files, replaces the variables in the template with the content,
-    and returns the complete prompt.
+    Renders an already loaded prompt template, substituting the content for the {{log_entry}} placeholder.
+
+    :param template: The compiled PromptTemplate (or the raw template text).
+    :param content: The content to substitute for the {{log_entry}} placeholder.
+    :param variables: Values for any other placeholders in the template.
+    :return: The complete prompt as a string.
+    """
+    if not isinstance(template, PromptTemplate):
+        template = PromptTemplate(template)
+    return template.render(log_entry=content, **variables)
+
+def create_complete_prompt(template_file, content_file, **variables):
+    """
+    Loads the compiled prompt template (read from disk only when the file changes) and the content file,
+    substitutes the content and any other variables, and returns the complete prompt.
 
     :param template_file: The file name of the prompt template.
     :param content_file: The file name of the content to replace in the template.
+    :param variables: Values for any other placeholders in the template.
     :return: The complete prompt as a string, or an error message if file reading fails.
     """
-    # Read the prompt template and content files
-    template = read_file_contents(template_file)
+    # Load the compiled prompt template and read the content file
+    try:
+        template = load_template(template_file)
+    except FileNotFoundError:
+        template = None
+        template_error = f"Error: The file {template_file} was not found."
+    except Exception as e:
+        template = None
+        template_error = f"Error: An error occurred while reading the file {template_file}. Details: {e}"
     content = read_file_contents(content_file)
     
     # Check if there were errors reading the files
-    if template.startswith("Error:") or content.startswith("Error:"):
+    if template is None or content.startswith("Error:"):
         # If either file read resulted in an error, return the error messages
-        error_message = f"Template file error: {template}\nContent file error: {content}"
+        error_message = f"Template file error: {template_error if template is None else ''}\nContent file error: {content}"
         logging.error(error_message)
         return error_message
     
-    # Replace the placeholder in the template with the actual content
+    # Substitute the content into the template
     try:
-        complete_prompt = template.replace("{{log_entry}}", content)
-        logging.info(f"Prompt successfully created using template {template_file} and content {content_file}")
+        complete_prompt = render_prompt(template, content, **variables)
+        logging.info("Prompt successfully created using template %s and content %s", template_file, content_file)
         print(complete_prompt)  # Optional: print the complete prompt for debugging purposes
         return complete_prompt
     except Exception as e:
@@ -0,0 +1,74 @@
+import os
+import re
+import threading
+
+# Placeholders look like {{name}}; surrounding whitespace inside the braces is allowed
+_PLACEHOLDER = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+# Compiled templates keyed by path, together with the (mtime, size) they were compiled from
+_template_cache = {}
+_template_cache_lock = threading.Lock()
+
+class PromptTemplate:
+    """
+    A prompt template split once at its {{...}} placeholders. Rendering joins the literal segments with the
+    variable values, so the template text is never rescanned.
+    """
+
+    def __init__(self, text, source=None):
+        """
+        :param text: The template text.
+        :param source: Optional path the template was read from (used in error messages).
+        """
+        self.text = text
+        self.source = source
+        # segments alternates literal text and placeholder names: [literal, name, literal, name, ..., literal]
+        self.segments = _PLACEHOLDER.split(text)
+        self.variables = tuple(dict.fromkeys(self.segments[1::2]))
+        # The placeholders as written, put back for names that get no value
+        self._placeholders = [match.group(0) for match in _PLACEHOLDER.finditer(text)]
+
+    def render(self, **values):
+        """
+        Renders the template. Like the original str.replace of {{log_entry}}, a placeholder without a value is left
+        in the text as it is written.
+
+        :param values: Values for the placeholders in the template.
+        :return: The rendered text.
+        """
+        parts = self.segments[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = values.get(parts[i], self._placeholders[i // 2])
+        return "".join(parts)
+
+    def missing(self, **values):
+        """
+        :param values: Values for the placeholders in the template.
+        :return: The names of the placeholders that have no value, in template order.
+        """
+        return [name for name in self.variables if name not in values]
+
+    @property
+    def static_prefix(self):
+        """
+        :return: The literal text before the first placeholder (the whole text if there is none).
+        """
+        return self.segments[0]
+
+def load_template(path):
+    """
+    Returns the compiled template for a file, reading and compiling it only when the file is new or has changed.
+
+    :param path: The path to the template file.
+    :return: The PromptTemplate.
+    """
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _template_cache.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with open(path, 'r') as f:
+        template = PromptTemplate(f.read(), source=path)
+    with _template_cache_lock:
+        _template_cache[path] = (signature, template)
+    return template
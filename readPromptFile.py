@@ -1,16 +1,9 @@
 import logging
 
-# Set up logging configuration
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+from logging_setup import get_logger
 
-formatter = logging.Formatter('%(asctime)s  %(name)s  %(levelname)s: %(message)s')
-
-# Create and configure a file handler to log messages to a file named 'invoke.log'
-file_handler = logging.FileHandler('invoke.log')
-file_handler.setFormatter(formatter)
-
-logger.addHandler(file_handler)
+# Set up logging configuration (shared, non-blocking pipeline)
+logger = get_logger(__name__)
 
 def read_file_contents(filename):
     """
@@ -0,0 +1,444 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Optional
+
+import manageConfig as mc
+import metrics
+import resilience
+from logging_setup import get_logger
+
+# Set up logging configuration (shared, non-blocking pipeline)
+logger = get_logger(__name__)
+
+# Histogram of the time requests spend queued, labelled with the priority class and the outcome (admitted, dropped)
+WAIT_METRIC = 'bedrock_scheduler_wait_seconds'
+
+# Histogram of the queue depth of a priority class, observed every time a request is queued
+DEPTH_METRIC = 'bedrock_scheduler_queue_depth'
+
+# Weight of each new sample in the moving average of a model's service time
+SERVICE_TIME_ALPHA = 0.2
+
+# Tenants whose fair-queuing state is kept before tenants with nothing queued are forgotten
+MAX_TRACKED_TENANTS = 1024
+
+# Raised when a request is dropped because it can no longer finish before its deadline
+class DeadlineExceeded(Exception):
+    pass
+
+# A priority class
+# priority: classes with a lower number are admitted first
+# max_concurrent: calls of this class in flight at once; keeping it below the scheduler's MaxConcurrent reserves the
+#                 remaining slots for the classes above it
+# tokens_per_minute: token budget of the class (0: no budget)
+# deadline_seconds: default time a request of this class may take, queueing included (0: no deadline)
+@dataclass(frozen=True)
+class PriorityClass:
+    name: str
+    priority: int
+    max_concurrent: int
+    tokens_per_minute: float = 0
+    deadline_seconds: float = 0
+
+# Classes used when the [priorityclasses] section is not present
+DEFAULT_CLASSES = (
+    PriorityClass('interactive', 0, 16, 0, 30),
+    PriorityClass('bulk', 1, 12, 0, 0),
+)
+
+# Who is asking and how urgently: the priority class, the tenant (for fair queuing within the class) and the
+# time.monotonic() deadline, if any
+@dataclass(frozen=True)
+class Ticket:
+    priority: str
+    tenant: str = 'default'
+    deadline: Optional[float] = None
+
+# A slot held by an admitted request; release it when the call is over
+class Grant:
+
+    def __init__(self, scheduler, state, waiter):
+        self.scheduler = scheduler
+        self.priority = state.spec.name
+        self.model_id = waiter.model_id
+        self.cost = waiter.cost
+        self.started = time.monotonic()
+        self._state = state
+        self._released = False
+        self._lock = threading.Lock()
+
+    # Function to give the slot back; only the first call has an effect
+    # Args:
+    #   usage: The usage of the finished call, used to settle the token budget and learn the model's service time
+    def release(self, usage=None):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self.scheduler._release(self, self._state, usage)
+
+class _Waiter:
+    __slots__ = ('ticket', 'model_id', 'cost', 'enqueued', 'start_tag', 'future')
+
+    def __init__(self, ticket, model_id, cost):
+        self.ticket = ticket
+        self.model_id = model_id
+        self.cost = cost
+        self.enqueued = time.monotonic()
+        self.start_tag = 0.0
+        self.future = Future()
+
+# Queue and counters of one priority class
+class _ClassState:
+
+    def __init__(self, spec):
+        self.spec = spec
+        # Heap of (finish tag, sequence, waiter)
+        self.queue = []
+        self.active = 0
+        self.admitted = 0
+        self.dropped = 0
+        # Weighted fair queuing: the class's virtual time and the finish tag of each tenant's last request
+        self.virtual_time = 0.0
+        self.finish_tags = {}
+        self.bucket = resilience.TokenBucket(spec.tokens_per_minute / 60.0, spec.tokens_per_minute) \
+            if spec.tokens_per_minute else None
+
+# Admission scheduler shared by every caller of the model in the process
+# A dispatcher thread hands out up to max_concurrent slots. Classes are served in priority order, each within its own
+# concurrency limit and token budget, so a lower class only gets the capacity the classes above it leave unused.
+# Within a class, tenants share the slots in proportion to their weights (start-time fair queuing on the estimated
+# tokens of each request). A request that can no longer finish before its deadline, given the recent service time of
+# its model, is dropped from the queue with DeadlineExceeded instead of being sent late.
+class RequestScheduler:
+
+    # Args:
+    #   classes: The PriorityClass objects
+    #   max_concurrent: Calls in flight at once across all classes
+    #   default_class: The class of requests that do not name one
+    #   tenant_weights: Dictionary of tenant -> weight (tenants not listed weigh 1)
+    def __init__(self, classes=DEFAULT_CLASSES, max_concurrent=16, default_class='interactive', tenant_weights=None):
+        self.classes = {spec.name: _ClassState(spec) for spec in classes}
+        if default_class not in self.classes:
+            raise ValueError(f"Default priority class {default_class} is not defined")
+        self.max_concurrent = max_concurrent
+        self.default_class = default_class
+        self.tenant_weights = tenant_weights or {}
+        self._order = sorted(self.classes.values(), key=lambda state: state.spec.priority)
+        self._active = 0
+        self._service_times = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+        threading.Thread(target=self._dispatch_loop, name='request-scheduler', daemon=True).start()
+
+    # Function to build the ticket of a request
+    # Args:
+    #   priority: The priority class (default: the default class)
+    #   tenant: The tenant or caller the request belongs to
+    #   timeout: Seconds the request may take, queueing included (default: the class's deadline)
+    # Returns:
+    #   The Ticket
+    # Raises:
+    #   ValueError for an unknown priority class
+    def ticket(self, priority=None, tenant=None, timeout=None):
+        priority = priority or self.default_class
+        state = self.classes.get(priority)
+        if state is None:
+            raise ValueError(f"Unknown priority class {priority}; expected one of {', '.join(self.classes)}")
+        timeout = timeout if timeout is not None else state.spec.deadline_seconds
+        return Ticket(priority, tenant or 'default', time.monotonic() + timeout if timeout else None)
+
+    # Function to queue a request for admission
+    # Args:
+    #   ticket: The Ticket (None uses the default class)
+    #   request: The Converse request; its estimated tokens are its cost for the token budget and fair queuing
+    # Returns:
+    #   A concurrent.futures.Future that resolves to a Grant, or fails with DeadlineExceeded
+    def submit(self, ticket, request):
+        ticket = ticket or self.ticket()
+        state = self.classes.get(ticket.priority)
+        if state is None:
+            raise ValueError(f"Unknown priority class {ticket.priority}")
+        waiter = _Waiter(ticket, request.get('modelId'), max(1, resilience.estimate_request_tokens(request)))
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The scheduler has been replaced after a configuration reload")
+            if len(state.finish_tags) > MAX_TRACKED_TENANTS:
+                state.finish_tags = {tenant: tag for tenant, tag in state.finish_tags.items()
+                                     if tag > state.virtual_time}
+            weight = float(self.tenant_weights.get(ticket.tenant, 1))
+            waiter.start_tag = max(state.virtual_time, state.finish_tags.get(ticket.tenant, 0.0))
+            finish_tag = waiter.start_tag + waiter.cost / weight
+            state.finish_tags[ticket.tenant] = finish_tag
+            heapq.heappush(state.queue, (finish_tag, next(self._sequence), waiter))
+            depth = len(state.queue)
+            self._condition.notify()
+        metrics.get_registry().observe(DEPTH_METRIC, depth, priority=state.spec.name)
+        return waiter.future
+
+    # Function to wait for admission
+    # Returns:
+    #   The Grant; release it when the call is over
+    # Raises:
+    #   DeadlineExceeded if the request was dropped
+    def admit(self, ticket, request):
+        return self.submit(ticket, request).result()
+
+    # Function to wait for admission without blocking the event loop
+    # Returns:
+    #   The Grant; release it when the call is over
+    # Raises:
+    #   DeadlineExceeded if the request was dropped
+    async def admit_async(self, ticket, request):
+        future = self.submit(ticket, request)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # Cancelling the wrapper cancels a queued request; a slot handed out at the same moment is given back
+            if future.done() and not future.cancelled() and future.exception() is None:
+                future.result().release()
+            raise
+
+    # Function to return the queue and slot counters
+    # Returns:
+    #   A dictionary with the slots in use and, per class, the requests queued and in flight and the totals
+    #   admitted and dropped
+    def stats(self):
+        with self._condition:
+            return {
+                "active": self._active,
+                "max_concurrent": self.max_concurrent,
+                "classes": {state.spec.name: {"queued": len(state.queue), "active": state.active,
+                                              "max_concurrent": state.spec.max_concurrent,
+                                              "admitted": state.admitted, "dropped": state.dropped}
+                            for state in self._order},
+                "service_seconds": dict(self._service_times),
+            }
+
+    # Function to stop the dispatcher once the requests already queued have been handled
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def _release(self, grant, state, usage):
+        with self._condition:
+            state.active -= 1
+            self._active -= 1
+            if usage:
+                # Only complete calls say how long the model takes; a call stopped early would pull the average down
+                elapsed = time.monotonic() - grant.started
+                previous = self._service_times.get(grant.model_id)
+                self._service_times[grant.model_id] = elapsed if previous is None else \
+                    previous + SERVICE_TIME_ALPHA * (elapsed - previous)
+            self._condition.notify()
+        if state.bucket is not None and usage:
+            state.bucket.adjust(grant.cost - usage.get('totalTokens', grant.cost))
+
+    def _dispatch_loop(self):
+        with self._condition:
+            while True:
+                timeout = self._dispatch()
+                if self._closed and not any(state.queue for state in self._order):
+                    return
+                self._condition.wait(timeout)
+
+    # Function to drop late requests and hand out free slots; called with the lock held
+    # Returns:
+    #   Seconds until a token budget refills or a queued request reaches its deadline, or None
+    def _dispatch(self):
+        now = time.monotonic()
+        wake = []
+        for state in self._order:
+            kept = []
+            for item in state.queue:
+                waiter = item[2]
+                if waiter.future.cancelled():
+                    continue
+                if waiter.ticket.deadline is not None:
+                    latest_start = waiter.ticket.deadline - self._service_times.get(waiter.model_id, 0.0)
+                    if now >= latest_start:
+                        self._drop(state, waiter, now)
+                        continue
+                    wake.append(latest_start - now)
+                kept.append(item)
+            if len(kept) != len(state.queue):
+                heapq.heapify(kept)
+                state.queue = kept
+
+        while self._active < self.max_concurrent:
+            for state in self._order:
+                if not state.queue or state.active >= state.spec.max_concurrent:
+                    continue
+                waiter = state.queue[0][2]
+                if state.bucket is not None:
+                    refill = state.bucket.try_acquire(waiter.cost)
+                    if refill:
+                        # Out of budget: lower classes may use the slot meanwhile
+                        wake.append(refill)
+                        continue
+                heapq.heappop(state.queue)
+                if not waiter.future.set_running_or_notify_cancel():
+                    if state.bucket is not None:
+                        state.bucket.adjust(waiter.cost)
+                    break
+                state.virtual_time = waiter.start_tag
+                state.active += 1
+                state.admitted += 1
+                self._active += 1
+                waiter.future.set_result(Grant(self, state, waiter))
+                metrics.get_registry().observe(WAIT_METRIC, now - waiter.enqueued, priority=state.spec.name,
+                                               outcome='admitted')
+                break
+            else:
+                break
+        return min(wake) if wake else None
+
+    def _drop(self, state, waiter, now):
+        if not waiter.future.set_running_or_notify_cancel():
+            return
+        state.dropped += 1
+        waiter.future.set_exception(DeadlineExceeded(
+            f"{state.spec.name} request from {waiter.ticket.tenant} for {waiter.model_id} dropped after "
+            f"{now - waiter.enqueued:.1f}s in the queue; it could not finish before its deadline"))
+        metrics.get_registry().observe(WAIT_METRIC, now - waiter.enqueued, priority=state.spec.name,
+                                       outcome='dropped')
+
+# Scheduler shared by every caller in this process; built from the [scheduler] section on first use
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+# Function to read the priority classes from the optional [priorityclasses] section
+# Each value is "priority, max concurrent, tokens per minute, deadline seconds" (the last two may be left out or 0)
+def _read_classes():
+    configured = mc.getSectionOrDefault('priorityclasses')
+    if not configured:
+        return DEFAULT_CLASSES
+    classes = []
+    for name, value in configured.items():
+        parts = [part.strip() for part in value.split(',')] + ['0', '0']
+        classes.append(PriorityClass(name, int(parts[0]), int(parts[1]), float(parts[2] or 0), float(parts[3] or 0)))
+    return tuple(classes)
+
+# Function to read the tenant weights from [scheduler] TenantWeights ("tenant:weight, tenant:weight")
+def _read_tenant_weights():
+    weights = {}
+    for item in mc.getValueOrDefault('scheduler', 'TenantWeights', '').split(','):
+        if ':' in item:
+            tenant, weight = item.rsplit(':', 1)
+            weights[tenant.strip()] = float(weight)
+    return weights
+
+# Function to return the process-wide scheduler
+# Keys in the optional [scheduler] section: Enabled (default false), MaxConcurrent, DefaultClass, TenantWeights
+# Returns:
+#   The RequestScheduler, or None when scheduling is not enabled
+def get_scheduler():
+    global _scheduler
+    if mc.getValueOrDefault('scheduler', 'Enabled', 'false') != 'true':
+        return None
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = RequestScheduler(
+                    classes=_read_classes(),
+                    max_concurrent=int(mc.getValueOrDefault('scheduler', 'MaxConcurrent', '16')),
+                    default_class=mc.getValueOrDefault('scheduler', 'DefaultClass', 'interactive'),
+                    tenant_weights=_read_tenant_weights(),
+                )
+                logger.info(f"Request scheduler enabled with classes {', '.join(_scheduler.classes)}")
+    return _scheduler
+
+# Function to build a ticket for the process-wide scheduler
+# Returns:
+#   The Ticket, or None when scheduling is not enabled
+# Raises:
+#   ValueError for an unknown priority class
+def make_ticket(priority=None, tenant=None, timeout=None):
+    scheduler = get_scheduler()
+    return scheduler.ticket(priority, tenant, timeout) if scheduler is not None else None
+
+# Function to make a ConverseStream call once the scheduler admits it; the slot is held until the stream ends
+# Args:
+#   ticket: The Ticket of the request, or a Grant the caller already holds (e.g. the server admits asynchronously)
+#   request: The Converse request
+#   call: Function that makes the call and returns its iterable of events
+# Returns:
+#   An iterable of the events
+def scheduled_stream(ticket, request, call):
+    scheduler = get_scheduler()
+    if scheduler is None:
+        return call()
+    grant = ticket if isinstance(ticket, Grant) else scheduler.admit(ticket, request)
+    try:
+        stream = call()
+    except Exception:
+        grant.release()
+        raise
+    return _GrantedStream(grant, stream)
+
+# Events of a scheduled ConverseStream call; the slot is returned when the stream ends or is closed
+# This is an iterator object rather than a generator so that close() returns the slot even when the stream was never
+# read (e.g. a coalesced call that every caller left before reading it).
+class _GrantedStream:
+
+    def __init__(self, grant, stream):
+        self._grant = grant
+        self._stream = stream
+        self._iterator = iter(stream)
+        self._usage = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            event = next(self._iterator)
+        except BaseException:
+            self.close()
+            raise
+        if 'metadata' in event:
+            self._usage = event['metadata'].get('usage')
+        return event
+
+    def close(self):
+        if hasattr(self._stream, 'close'):
+            self._stream.close()
+        # Grant.release is idempotent, so closing twice (or after the end of the stream) is harmless
+        self._grant.release(self._usage)
+
+# Function to make a Converse call once the scheduler admits it
+# Args:
+#   ticket: The Ticket of the request (or a Grant already held)
+#   request: The Converse request
+#   call: Function that makes the call and returns the Converse response
+# Returns:
+#   The Converse response
+def scheduled_call(ticket, request, call):
+    scheduler = get_scheduler()
+    if scheduler is None:
+        return call()
+    grant = ticket if isinstance(ticket, Grant) else scheduler.admit(ticket, request)
+    usage = None
+    try:
+        response = call()
+        usage = response.get('usage')
+        return response
+    finally:
+        grant.release(usage)
+
+# Function called by manageConfig when the configuration is reloaded
+# A new scheduler is built on next use; the old one still serves the requests it has queued
+def _on_settings_changed(old_settings, new_settings, changed):
+    global _scheduler
+    if 'sections' in changed and _scheduler is not None:
+        old, _scheduler = _scheduler, None
+        old.close()
+
+mc.subscribe(_on_settings_changed)
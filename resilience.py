@@ -0,0 +1,411 @@
+import random
+import threading
+import time
+
+import manageConfig as mc
+import modelRegistry
+import tokenBudget
+from logging_setup import get_logger
+
+# Set up logging configuration (shared, non-blocking pipeline)
+logger = get_logger(__name__)
+
+# Error codes worth retrying: throttling, a model that is still loading, and transient service errors
+# (a model stream error is transient too; the service asks for the request to be retried)
+RETRYABLE_ERRORS = {'ThrottlingException', 'ModelNotReadyException', 'ServiceUnavailableException',
+                    'InternalServerException', 'ModelTimeoutException', 'TooManyRequestsException',
+                    'ModelStreamErrorException'}
+
+# Raised when a call is rejected because the circuit for its model or endpoint is open
+class CircuitOpenError(Exception):
+    pass
+
+# Raised when a call could not be admitted by the rate limiter within its wait budget
+class RateLimitTimeout(Exception):
+    pass
+
+# Token bucket that refills continuously at `rate` units per second up to `capacity`
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Function to take `amount` units, waiting for the bucket to refill if necessary
+    # Args:
+    #   amount: Units to take (requests or tokens); amounts above capacity are capped so they can still pass
+    #   timeout: Maximum seconds to wait, or None to wait indefinitely
+    # Returns:
+    #   True if the units were taken, False on timeout
+    def acquire(self, amount=1, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(amount)
+            if wait == 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    # Function to take `amount` units if they are available, without waiting
+    # Returns:
+    #   0 if the units were taken, otherwise the seconds until the bucket will hold enough
+    def try_acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) / self.rate
+
+    # Function to add (or, with a negative amount, take) units without waiting, e.g. to settle an estimate
+    def adjust(self, amount):
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+# Circuit breaker: opens after `failure_threshold` consecutive failures, lets a single trial call through
+# after `reset_seconds`, and closes again when that call succeeds
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_seconds=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.reset_seconds else 'open'
+
+    # Function to check whether a call may proceed
+    # Returns:
+    #   True if the call is the trial call of a half-open circuit
+    # Raises:
+    #   CircuitOpenError if the circuit is open (or half-open with a trial call already in flight)
+    def before_call(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return False
+            if state == 'half-open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+        raise CircuitOpenError(f"Circuit for {self.name} is open")
+
+    # Function to give back the trial slot of a call that was never made (e.g. another breaker rejected it)
+    def release_trial(self):
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                if self.opened_at is None:
+                    logger.warning("Opening circuit for %s after %s consecutive failures", self.name, self.failures)
+                self.opened_at = time.monotonic()
+
+# Function to estimate the tokens a request will consume before it is sent (input estimated with the model's
+# tokenizer profile, plus the maxTokens the output may use)
+def estimate_request_tokens(request):
+    model_id = request.get('modelId')
+    tokens = 0
+    for block in request.get('system', []):
+        tokens += tokenBudget.estimate_tokens(block.get('text', ''), model_id)
+    for message in request.get('messages', []):
+        for block in message.get('content', []):
+            tokens += tokenBudget.estimate_tokens(block.get('text', ''), model_id)
+    return tokens + request.get('inferenceConfig', {}).get('maxTokens', 0)
+
+# Function to extract the error code of a botocore ClientError (or None for other exceptions)
+# The error is inspected through its response attribute so botocore does not have to be imported here. Errors
+# raised while reading a ConverseStream (EventStreamError) carry the lowerCamel name of the stream member (e.g.
+# throttlingException); the first letter is upper-cased so every code compares against RETRYABLE_ERRORS alike.
+def error_code(error):
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        code = response.get('Error', {}).get('Code')
+        return code[:1].upper() + code[1:] if code else code
+    return None
+
+# Admission control and retry policy shared by every Converse call in the process
+class ResilienceController:
+
+    # Args:
+    #   max_attempts: Attempts per call, including the first
+    #   base_delay: Base of the exponential backoff, in seconds
+    #   max_delay: Upper bound of a single backoff, in seconds
+    #   failure_threshold: Consecutive failures that open a circuit
+    #   reset_seconds: Seconds an open circuit waits before letting a trial call through
+    #   limits: Dictionary of model id (or 'Default') -> (requests per minute, tokens per minute)
+    #   max_wait: Maximum seconds a call waits for rate-limit admission
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=20.0, failure_threshold=5, reset_seconds=30,
+                 limits=None, max_wait=300.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.limits = limits or {}
+        self.max_wait = max_wait
+        self._buckets = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    # Function to return the (requests, tokens) buckets for a model, or None when it is not limited
+    def buckets_for(self, model_id):
+        with self._lock:
+            if model_id not in self._buckets:
+                limit = self.limits.get(model_id, self.limits.get('Default'))
+                if limit is None:
+                    self._buckets[model_id] = None
+                else:
+                    requests_per_minute, tokens_per_minute = limit
+                    self._buckets[model_id] = (TokenBucket(requests_per_minute / 60.0, requests_per_minute),
+                                               TokenBucket(tokens_per_minute / 60.0, tokens_per_minute))
+            return self._buckets[model_id]
+
+    # Function to return the circuit breaker for a key (a model id or an endpoint URL)
+    def breaker(self, key):
+        with self._lock:
+            if key not in self._breakers:
+                self._breakers[key] = CircuitBreaker(key, self.failure_threshold, self.reset_seconds)
+            return self._breakers[key]
+
+    # Function to wait for rate-limit admission of a request
+    # Returns:
+    #   The number of tokens reserved, to be settled once the real usage is known
+    def admit(self, model_id, request):
+        buckets = self.buckets_for(model_id)
+        if buckets is None:
+            return 0
+        estimated = estimate_request_tokens(request)
+        started = time.monotonic()
+        if not buckets[0].acquire(1, self.max_wait) or \
+                not buckets[1].acquire(estimated, max(0.0, self.max_wait - (time.monotonic() - started))):
+            raise RateLimitTimeout(f"Rate limit for {model_id} did not admit the request within {self.max_wait}s")
+        return estimated
+
+    # Function to return unused reserved tokens (or charge for the overshoot) once the usage is known
+    def settle(self, model_id, reserved, usage):
+        buckets = self.buckets_for(model_id)
+        if buckets is not None and usage:
+            buckets[1].adjust(reserved - usage.get('totalTokens', reserved))
+
+    # Function to compute the backoff before a retry (exponential with full jitter)
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    # Function to call Converse with admission control, circuit breakers and retries
+    # Args:
+    #   bedrock_runtime: The Bedrock runtime client
+    #   request: The Converse request
+    # Returns:
+    #   The Converse response
+    def converse(self, bedrock_runtime, request):
+        model_id = request['modelId']
+        reserved = self.admit(model_id, request)
+        try:
+            response = self._call_with_retries(bedrock_runtime, 'converse', request)
+        except Exception:
+            # Nothing was generated; the reservation goes back to the bucket
+            self.settle(model_id, reserved, {'totalTokens': 0})
+            raise
+        self.settle(model_id, reserved, response.get('usage'))
+        return response
+
+    # Function to call ConverseStream with admission control, circuit breakers and retries
+    # Retries only happen before the stream starts; a failure mid-stream is reported to the breakers and raised.
+    # Args:
+    #   bedrock_runtime: The Bedrock runtime client
+    #   request: The Converse request
+    #   on_admitted: Optional function called once the rate limiter admitted the request, before the call is made
+    # Returns:
+    #   An iterator of ConverseStream events with a close() method
+    def converse_stream(self, bedrock_runtime, request, on_admitted=None):
+        model_id = request['modelId']
+        reserved = self.admit(model_id, request)
+        if on_admitted is not None:
+            on_admitted()
+        try:
+            response = self._call_with_retries(bedrock_runtime, 'converse_stream', request, record_success=False)
+        except Exception:
+            self.settle(model_id, reserved, {'totalTokens': 0})
+            raise
+        breakers = (self.breaker(model_id), self.breaker(bedrock_runtime.meta.endpoint_url))
+        return WatchedStream(self, breakers, model_id, reserved, response.get('stream') or [],
+                             request.get('inferenceConfig', {}).get('maxTokens', 0))
+
+    def _call_with_retries(self, bedrock_runtime, operation, request, record_success=True):
+        model_id = request['modelId']
+        breakers = (self.breaker(model_id), self.breaker(bedrock_runtime.meta.endpoint_url))
+        attempt = 0
+        while True:
+            claimed = []
+            try:
+                for breaker in breakers:
+                    if breaker.before_call():
+                        claimed.append(breaker)
+            except CircuitOpenError:
+                # The call is not made, so the trial slots already handed out must not stay taken
+                for breaker in claimed:
+                    breaker.release_trial()
+                raise
+            try:
+                response = getattr(bedrock_runtime, operation)(**request)
+            except Exception as e:
+                code = error_code(e)
+                if code is not None and code not in RETRYABLE_ERRORS:
+                    # The request itself is wrong (validation, access denied); the service answered, so it counts
+                    # as healthy for the breakers
+                    for breaker in breakers:
+                        breaker.record_success()
+                    raise
+                for breaker in breakers:
+                    breaker.record_failure()
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    raise
+                delay = self.backoff(attempt)
+                logger.warning("%s for %s failed with %s (attempt %s/%s), retrying in %.2fs",
+                               operation, model_id, code or type(e).__name__, attempt, self.max_attempts, delay)
+                time.sleep(delay)
+                continue
+            if record_success:
+                for breaker in breakers:
+                    breaker.record_success()
+            return response
+
+# Events of a ConverseStream call, passed through while the outcome is reported to the breakers and the rate limiter
+# This is an iterator object rather than a generator so that close() settles the call even when the stream was never
+# read (a generator that never started runs no cleanup when it is closed); otherwise a half-open breaker would keep
+# waiting for its trial call forever.
+class WatchedStream:
+
+    # Args:
+    #   controller: The ResilienceController
+    #   breakers: The circuit breakers of the model and the endpoint
+    #   model_id: The model id
+    #   reserved: Tokens reserved by admit(), settled once the usage is known
+    #   stream: The iterable of ConverseStream events
+    #   max_tokens: The maxTokens of the request (the output part of the reservation)
+    def __init__(self, controller, breakers, model_id, reserved, stream, max_tokens=0):
+        self._controller = controller
+        self._breakers = breakers
+        self._model_id = model_id
+        self._reserved = reserved
+        self._max_tokens = max_tokens
+        self._stream = stream
+        self._iterator = iter(stream)
+        self._usage = None
+        # Text received so far, kept only when the call holds a reservation (to settle a stream stopped early)
+        self._chunks = []
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        try:
+            event = next(self._iterator)
+        except StopIteration:
+            self._finish(True)
+            self._controller.settle(self._model_id, self._reserved, self._usage)
+            raise
+        except Exception as e:
+            # A request the service rejected (e.g. validation) still says the service is healthy
+            code = error_code(e)
+            self._finish(code is not None and code not in RETRYABLE_ERRORS)
+            raise
+        if 'metadata' in event:
+            self._usage = event['metadata'].get('usage')
+        elif self._reserved and 'contentBlockDelta' in event:
+            self._chunks.append(event['contentBlockDelta'].get('delta', {}).get('text', ''))
+        return event
+
+    # Function to stop reading early (see streamSinks.StopStream); the call itself went fine
+    # The metadata event with the usage never arrives, so the reservation is settled with an estimate: the input
+    # part of the reservation plus the tokens of the text received before the stream was closed.
+    def close(self):
+        if self._done:
+            return
+        self._finish(True)
+        if self._reserved:
+            output_tokens = tokenBudget.estimate_tokens("".join(self._chunks), self._model_id)
+            self._controller.settle(self._model_id, self._reserved,
+                                    {'totalTokens': max(0, self._reserved - self._max_tokens) + output_tokens})
+
+    def _finish(self, success):
+        self._done = True
+        if hasattr(self._stream, 'close'):
+            self._stream.close()
+        for breaker in self._breakers:
+            if success:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+
+# Controller shared by every caller in this process; built from the [retry] and [ratelimits] sections on first use
+_controller = None
+_controller_lock = threading.Lock()
+
+# Function to read the per-model limits from the optional [ratelimits] section
+# Each key is a model alias from [models], a model id, or Default; each value is "requests_per_minute, tokens_per_minute"
+# An empty value leaves that model (or, for Default, every model without its own entry) unlimited
+def _read_limits():
+    limits = {}
+    registry = modelRegistry.get_registry()
+    for key, value in mc.getSectionOrDefault('ratelimits').items():
+        if not value.strip():
+            continue
+        requests_per_minute, tokens_per_minute = (float(part) for part in value.split(','))
+        limits[key if key == 'Default' else registry.resolve(key)] = (requests_per_minute, tokens_per_minute)
+    return limits
+
+# Function to return the process-wide resilience controller
+def get_controller():
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = ResilienceController(
+                    max_attempts=int(mc.getValueOrDefault('retry', 'MaxAttempts', '5')),
+                    base_delay=float(mc.getValueOrDefault('retry', 'BaseDelay', '0.5')),
+                    max_delay=float(mc.getValueOrDefault('retry', 'MaxDelay', '20')),
+                    failure_threshold=int(mc.getValueOrDefault('retry', 'BreakerFailureThreshold', '5')),
+                    reset_seconds=float(mc.getValueOrDefault('retry', 'BreakerResetSeconds', '30')),
+                    limits=_read_limits(),
+                    max_wait=float(mc.getValueOrDefault('retry', 'MaxQueueWait', '300')),
+                )
+    return _controller
+
+# Function called by manageConfig when the configuration is reloaded
+# The controller (and with it the buckets and breakers) is rebuilt on next use when the limits may have changed
+def _on_settings_changed(old_settings, new_settings, changed):
+    global _controller
+    if changed & {'models', 'sections'}:
+        _controller = None
+
+mc.subscribe(_on_settings_changed)
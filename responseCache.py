@@ -0,0 +1,228 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import hedging
+import manageConfig as mc
+import requestScheduler
+import resilience
+import singleFlight
+from logging_setup import get_logger
+
+# Set up logging configuration (shared, non-blocking pipeline)
+logger = get_logger(__name__)
+
+# Request fields that determine the model output; anything else (e.g. client options) is ignored in the key
+_KEY_FIELDS = ('modelId', 'system', 'messages', 'inferenceConfig')
+
+# Function to compute the cache key of a Converse request
+# Args:
+#   request: The keyword arguments for converse/converse_stream (see invoke.build_converse_request)
+# Returns:
+#   A hex SHA-256 digest of the canonical JSON form of the request
+def cache_key(request):
+    canonical = json.dumps({field: request.get(field) for field in _KEY_FIELDS},
+                           sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+# Function to check whether a request is deterministic and therefore safe to serve from the cache
+def is_cacheable(request):
+    return request.get('inferenceConfig', {}).get('temperature') == 0
+
+# Function to replay cached ConverseStream events as a synthetic stream
+# Args:
+#   events: The list of event dictionaries recorded from a previous stream
+# Returns:
+#   A generator yielding the events in their original order
+def replay(events):
+    for event in events:
+        yield event
+
+# Response cache for deterministic (temperature=0) Converse requests
+# Responses are stored as the list of ConverseStream events so a cached result can be replayed through the same
+# event loop as a live stream. Entries live in an in-memory LRU with a TTL and, optionally, in a SQLite file that
+# several processes can share.
+class ResponseCache:
+
+    # Args:
+    #   max_entries: Maximum number of entries kept in memory
+    #   ttl_seconds: Seconds after which an entry is no longer served
+    #   sqlite_path: Optional path of the shared on-disk store
+    def __init__(self, max_entries=1024, ttl_seconds=3600, sqlite_path=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "bytes_saved": 0, "tokens_saved": 0}
+        self._db = None
+        if sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, timeout=5, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, events TEXT NOT NULL, created REAL NOT NULL)")
+
+    # Function to look up a request
+    # Args:
+    #   request: The Converse request
+    # Returns:
+    #   The recorded list of events, or None on a miss
+    def get(self, request):
+        key = cache_key(request)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is None and self._db is not None:
+                row = self._db.execute("SELECT events, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[1] <= self.ttl_seconds:
+                    entry = (row[0], row[1])
+                    self._store_in_memory(key, entry)
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            events = json.loads(entry[0])
+            self._counters["hits"] += 1
+            self._counters["bytes_saved"] += len(entry[0])
+            for event in events:
+                if 'metadata' in event:
+                    self._counters["tokens_saved"] += event['metadata'].get('usage', {}).get('totalTokens', 0)
+            return events
+
+    # Function to store the events of a completed stream
+    # Args:
+    #   request: The Converse request
+    #   events: The list of event dictionaries
+    def put(self, request, events):
+        key = cache_key(request)
+        entry = (json.dumps(events, default=str), time.time())
+        with self._lock:
+            self._store_in_memory(key, entry)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses (key, events, created) VALUES (?, ?, ?)",
+                                 (key, entry[0], entry[1]))
+
+    # Function to pass a live stream through while recording it; the events are stored once the stream completes
+    # Args:
+    #   request: The Converse request
+    #   stream: The iterable of ConverseStream events
+    # Returns:
+    #   An iterator of the events of the live stream, with a close() method
+    def record(self, request, stream):
+        return _RecordedStream(self, request, stream)
+
+    # Function to return the cache counters
+    # Returns:
+    #   A dictionary with hits, misses, hit_rate, bytes_saved, tokens_saved and the number of entries in memory
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _store_in_memory(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+# Events of a live stream passed through while they are recorded for the cache
+# This is an iterator object rather than a generator so that close() also closes the live stream when it was never
+# read (a generator that never started does not run its cleanup).
+class _RecordedStream:
+
+    def __init__(self, cache, request, stream):
+        self._cache = cache
+        self._request = request
+        self._stream = stream
+        self._iterator = iter(stream)
+        self._events = []
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        try:
+            event = next(self._iterator)
+        except StopIteration:
+            self.close()
+            self._done = True
+            # Only complete responses are cached; a stream interrupted by an error never gets here
+            if any('messageStop' in event for event in self._events):
+                self._cache.put(self._request, self._events)
+            raise
+        except BaseException:
+            self.close()
+            raise
+        self._events.append(event)
+        return event
+
+    def close(self):
+        if hasattr(self._stream, 'close'):
+            self._stream.close()
+
+# Cache shared by every caller in this process; built from the [cache] section on first use
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+# Function to return the process-wide response cache
+# Keys in the optional [cache] section: Enabled (default false), MaxEntries, TTLSeconds, SQLitePath
+# Returns:
+#   The ResponseCache, or None when caching is not enabled
+def get_response_cache():
+    global _response_cache
+    if mc.getValueOrDefault('cache', 'Enabled', 'false') != 'true':
+        return None
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache(
+                    max_entries=int(mc.getValueOrDefault('cache', 'MaxEntries', '1024')),
+                    ttl_seconds=float(mc.getValueOrDefault('cache', 'TTLSeconds', '3600')),
+                    sqlite_path=mc.getValueOrDefault('cache', 'SQLitePath') or None,
+                )
+                logger.info("Response cache enabled")
+    return _response_cache
+
+# Function to return the ConverseStream events for a request, from the cache when possible
+# Live calls go through the request scheduler (priority classes, when enabled), the hedging policy (a duplicate for a
+# slow first token, when enabled) and the resilience controller (rate limits, circuit breakers and retries), so a
+# hedge shares the scheduler slot of its request. A deterministic request that is identical to one already in flight shares
+# that call instead of making its own (see singleFlight.py), so a burst of the same error line costs one model call
+# even before the cache has an answer.
+# Args:
+#   bedrock_runtime: The Bedrock runtime client
+#   request: The Converse request
+#   ticket: Optional requestScheduler Ticket (or Grant) of the request; the default priority class is used when None
+# Returns:
+#   A tuple (events, cached) where events is an iterable of ConverseStream events
+def converse_stream_cached(bedrock_runtime, request, ticket=None):
+    def live_call():
+        return requestScheduler.scheduled_stream(ticket, request, lambda: hedging.hedged_stream(
+            bedrock_runtime, request, resilience.get_controller().converse_stream))
+
+    if not is_cacheable(request):
+        return live_call(), False
+    cache = get_response_cache()
+    if cache is not None:
+        events = cache.get(request)
+        if events is not None:
+            return replay(events), True
+
+    def call():
+        stream = live_call()
+        return cache.record(request, stream) if cache is not None else stream
+
+    coalescer = singleFlight.get_single_flight()
+    if coalescer is None:
+        return call(), False
+    return coalescer.stream(cache_key(request), call), False
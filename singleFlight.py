@@ -0,0 +1,186 @@
+import threading
+
+import manageConfig as mc
+from logging_setup import get_logger
+
+# Set up logging configuration (shared, non-blocking pipeline)
+logger = get_logger(__name__)
+
+# One upstream ConverseStream call shared by every caller that sent the same request while it was in flight
+class _Flight:
+
+    def __init__(self, key):
+        self.key = key
+        self.stream = None
+        # Every event read so far; a subscriber that attaches late replays them from the start
+        self.events = []
+        self.done = False
+        self.error = None
+        # True while one subscriber is reading the next event from the upstream stream; a new flight starts out
+        # reading because the first caller is still making the call
+        self.reading = True
+        # Set when the last subscriber leaves while another thread is still reading; the reader then closes the stream
+        self.abandoned = False
+        self.subscribers = 0
+        self.condition = threading.Condition()
+
+# One caller's view of a flight: an iterator over the shared events
+# There is no reader thread; whichever subscriber needs an event that has not arrived yet reads it from the upstream
+# stream while the others wait, so the stream is read as fast as the fastest subscriber and a subscriber that goes
+# away never holds the others up.
+class _Subscription:
+
+    def __init__(self, group, flight):
+        self._group = group
+        self._flight = flight
+        self._index = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        flight = self._flight
+        if flight is None:
+            raise StopIteration
+        while True:
+            with flight.condition:
+                while self._index >= len(flight.events) and not flight.done and flight.reading:
+                    flight.condition.wait()
+                if self._index < len(flight.events):
+                    self._index += 1
+                    return flight.events[self._index - 1]
+                if flight.done:
+                    error = flight.error
+                    break
+                flight.reading = True
+            # The event is read outside the lock so the other subscribers can take the buffered events meanwhile
+            try:
+                event = next(flight.stream)
+            except StopIteration:
+                self._group._finish(flight)
+            except Exception as e:
+                # The call failed: every subscriber gets the same error and the next identical request starts afresh
+                self._group._finish(flight, e)
+            else:
+                with flight.condition:
+                    flight.events.append(event)
+                    flight.reading = False
+                    abandoned = flight.abandoned
+                    flight.condition.notify_all()
+                if abandoned:
+                    self._group._finish(flight, close=True)
+        self.close()
+        if error is not None:
+            raise error
+        raise StopIteration
+
+    # Function to stop receiving events; the upstream stream is closed when no subscriber is left
+    def close(self):
+        flight, self._flight = self._flight, None
+        if flight is not None:
+            self._group._leave(flight)
+
+    def __del__(self):
+        self.close()
+
+# Coalesces identical concurrent ConverseStream requests into one call
+# While a request is in flight, an identical request (same key) attaches to it instead of calling the model again and
+# receives the same events. The flight is forgotten as soon as the stream ends or fails, so later requests make a new
+# call (or are answered by the response cache); this covers the burst before the first response has completed.
+class SingleFlight:
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "coalesced": 0}
+
+    # Function to return the events of a request, sharing an in-flight call when there is one
+    # Args:
+    #   key: The canonical key of the request (see responseCache.cache_key)
+    #   call: Function that makes the call and returns its iterable of events; called only when no identical
+    #         request is in flight, on the caller's thread, so errors raised by the call itself reach this caller
+    # Returns:
+    #   An iterator of the events, with a close() method
+    def stream(self, key, call):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight(key)
+                self._counters["calls"] += 1
+            else:
+                self._counters["coalesced"] += 1
+            flight.subscribers += 1
+            # The subscription exists before the lock is released so a failing call always has one to close
+            subscription = _Subscription(self, flight)
+        if not leader:
+            logger.debug(f"Request {key[:12]} attached to the call in flight")
+            return subscription
+        try:
+            stream = iter(call())
+        except Exception as e:
+            self._finish(flight, e)
+            subscription.close()
+            raise
+        with flight.condition:
+            flight.stream = stream
+            flight.reading = False
+            flight.condition.notify_all()
+        return subscription
+
+    # Function to mark a flight as finished and forget it
+    # Args:
+    #   flight: The flight
+    #   error: The exception the call failed with, if any
+    #   close: Close the upstream stream (it was abandoned by every subscriber)
+    def _finish(self, flight, error=None, close=False):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        with flight.condition:
+            flight.done = True
+            flight.error = error
+            flight.reading = False
+            flight.condition.notify_all()
+        if close and hasattr(flight.stream, 'close'):
+            flight.stream.close()
+
+    # Function called when a subscriber goes away
+    # The last subscriber to leave a flight that is still running closes the upstream stream, so the model stops
+    # generating; if another thread is reading from it at that moment, the reader closes it when the read returns.
+    def _leave(self, flight):
+        with self._lock:
+            flight.subscribers -= 1
+            if flight.subscribers > 0:
+                return
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        with flight.condition:
+            if flight.done:
+                return
+            if flight.reading:
+                flight.abandoned = True
+                return
+            flight.done = True
+        if hasattr(flight.stream, 'close'):
+            flight.stream.close()
+
+    # Function to return the counters
+    # Returns:
+    #   A dictionary with calls (requests that called the model), coalesced (requests that shared a call) and
+    #   in_flight (calls currently running)
+    def stats(self):
+        with self._lock:
+            return {**self._counters, "in_flight": len(self._flights)}
+
+# Coalescer shared by every caller in this process
+_single_flight = SingleFlight()
+
+# Function to return the process-wide coalescer
+# Key in the optional [cache] section: Coalesce (default false); coalescing works whether or not the cache is enabled
+# Returns:
+#   The SingleFlight, or None when coalescing is turned off
+def get_single_flight():
+    if mc.getValueOrDefault('cache', 'Coalesce', 'false') != 'true':
+        return None
+    return _single_flight
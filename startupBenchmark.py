@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Commands timed by the benchmark: the CLI help (argument parsing only) and importing the invoke module the way
+# batchInvoke, compareModels and invokeServer do
+COMMANDS = {
+    "invoke --help": [sys.executable, "invoke.py", "--help"],
+    "import invoke": [sys.executable, "-c", "import invoke"],
+}
+
+# Modules that must not be loaded by `import invoke`; they are imported when the first request is made
+HEAVY_MODULES = ('boto3', 'botocore', 'cryptography')
+
+# Function to time one command in a fresh interpreter
+# Returns:
+#   The wall clock time in milliseconds
+def time_command(command):
+    started = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    return (time.perf_counter() - started) * 1000
+
+# Function to list the heavy modules that `import invoke` loads
+# Returns:
+#   The names from HEAVY_MODULES found in sys.modules after the import
+def heavy_imports():
+    check = f"import invoke, sys; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", check], check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return [name for name in result.stdout.strip().split(',') if name]
+
+# Function to run every command several times
+# Args:
+#   runs: Timed runs per command (one untimed warm-up run comes first so the .pyc files exist)
+# Returns:
+#   A dictionary with the median, min and max milliseconds of each command
+def run_benchmark(runs):
+    results = {}
+    for label, command in COMMANDS.items():
+        time_command(command)
+        samples = [time_command(command) for _ in range(runs)]
+        results[label] = {"median_ms": statistics.median(samples), "min_ms": min(samples), "max_ms": max(samples)}
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the start-up time of the invoke CLI.')
+    parser.add_argument('--runs', type=int, default=10, help='Timed runs per command (default: 10)')
+    parser.add_argument('--max-ms', type=float, help='Exit with status 1 when a median is above this many ms')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    try:
+        results = run_benchmark(max(1, args.runs))
+        heavy = heavy_imports()
+    except subprocess.CalledProcessError as e:
+        print(f"Start-up benchmark failed: {e}")
+        sys.exit(1)
+
+    print(f"{'command':<16} {'median ms':>10} {'min ms':>8} {'max ms':>8}")
+    for label, r in results.items():
+        print(f"{label:<16} {r['median_ms']:>10.1f} {r['min_ms']:>8.1f} {r['max_ms']:>8.1f}")
+    print(f"\nHeavy modules loaded by `import invoke`: {', '.join(heavy) or 'none'}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"commands": results, "heavy_imports": heavy}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    regressions = [label for label, r in results.items() if args.max_ms is not None and r['median_ms'] > args.max_ms]
+    if heavy or regressions:
+        for label in regressions:
+            print(f"{label}: median {results[label]['median_ms']:.1f} ms is above {args.max_ms:.0f} ms")
+        sys.exit(1)
@@ -0,0 +1,255 @@
+import json
+import sys
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Optional
+
+# Typed ConverseStream events
+# parse_events() turns the raw event dictionaries into these once, so every sink can dispatch on the type
+# instead of probing the dictionaries again.
+
+@dataclass(frozen=True)
+class MessageStart:
+    role: str
+
+@dataclass(frozen=True)
+class TextDelta:
+    text: str
+    index: int = 0
+
+@dataclass(frozen=True)
+class ContentBlockStop:
+    index: int = 0
+
+@dataclass(frozen=True)
+class MessageStop:
+    stop_reason: str
+
+# The prompt-cache token counts are taken out of usage so every sink reports them the same way; they are None when
+# the model did not report them (no cachePoint was sent, or the model does not support prompt caching)
+@dataclass(frozen=True)
+class Metadata:
+    usage: dict = field(default_factory=dict)
+    latency_ms: Optional[int] = None
+    cache_read_input_tokens: Optional[int] = None
+    cache_write_input_tokens: Optional[int] = None
+
+# Function to convert raw ConverseStream event dictionaries into typed events
+# Args:
+#   stream: An iterable of ConverseStream event dictionaries (a live stream or a replayed one)
+# Returns:
+#   A generator of MessageStart, TextDelta, ContentBlockStop, MessageStop and Metadata events
+def parse_events(stream):
+    try:
+        yield from _parse_raw_events(stream)
+    finally:
+        # Closing the typed stream early (see StopStream) closes the model stream too, which ends the generation
+        if hasattr(stream, 'close'):
+            stream.close()
+
+def _parse_raw_events(stream):
+    for event in stream:
+        if 'messageStart' in event:
+            yield MessageStart(event['messageStart']['role'])
+        if 'contentBlockDelta' in event:
+            delta = event['contentBlockDelta']
+            if 'text' in delta['delta']:
+                yield TextDelta(delta['delta']['text'], delta.get('contentBlockIndex', 0))
+        if 'contentBlockStop' in event:
+            yield ContentBlockStop(event['contentBlockStop'].get('contentBlockIndex', 0))
+        if 'messageStop' in event:
+            yield MessageStop(event['messageStop']['stopReason'])
+        if 'metadata' in event:
+            metadata = event['metadata']
+            usage = metadata.get('usage', {})
+            yield Metadata(usage, metadata.get('metrics', {}).get('latencyMs'),
+                           usage.get('cacheReadInputTokens'), usage.get('cacheWriteInputTokens'))
+
+# Raised by a sink's on_event when it has everything it needs; consume() then stops reading the stream
+class StopStream(Exception):
+    pass
+
+# Function to feed typed events to every sink and close the sinks when the stream ends
+# When a sink raises StopStream the other sinks still get the current event, then the stream is closed.
+# Args:
+#   events: An iterable of typed events (see parse_events)
+#   sinks: The sinks to feed
+# Returns:
+#   The list of sinks, so results can be read from them
+def consume(events, sinks):
+    try:
+        for event in events:
+            stop = False
+            for sink in sinks:
+                try:
+                    sink.on_event(event)
+                except StopStream:
+                    stop = True
+            if stop:
+                if hasattr(events, 'close'):
+                    events.close()
+                break
+    finally:
+        for sink in sinks:
+            sink.close()
+    return sinks
+
+# Base class for stream consumers
+class StreamSink:
+    def on_event(self, event):
+        pass
+
+    def close(self):
+        pass
+
+# Sink that prints the response to a terminal in the same layout as invokeModel always has
+# Text deltas are buffered and written once a line is complete or the buffer reaches flush_chars,
+# instead of one unbuffered write per delta.
+class TerminalSink(StreamSink):
+
+    # Args:
+    #   out: The text stream to write to (defaults to sys.stdout)
+    #   flush_chars: Number of buffered characters that forces a write
+    def __init__(self, out=None, flush_chars=512):
+        self.out = out or sys.stdout
+        self.flush_chars = flush_chars
+        self._buffer = []
+        self._buffered = 0
+
+    def on_event(self, event):
+        if isinstance(event, TextDelta):
+            self._buffer.append(event.text)
+            self._buffered += len(event.text)
+            if self._buffered >= self.flush_chars or '\n' in event.text:
+                self.flush()
+            return
+
+        if isinstance(event, MessageStart):
+            self._write(f"\nRole: {event.role}\n")
+        elif isinstance(event, MessageStop):
+            self._write(f"\n\nStop reason: {event.stop_reason}\n")
+        elif isinstance(event, Metadata):
+            lines = ['=====================']
+            if event.usage:
+                lines.append("\nToken usage\n")
+                lines.append(f"Input tokens: {event.usage.get('inputTokens')}")
+                lines.append(f"Output tokens: {event.usage.get('outputTokens')}")
+                lines.append(f"Total tokens: {event.usage.get('totalTokens')}")
+                if event.cache_read_input_tokens is not None or event.cache_write_input_tokens is not None:
+                    lines.append(f"Cache read input tokens: {event.cache_read_input_tokens or 0}")
+                    lines.append(f"Cache write input tokens: {event.cache_write_input_tokens or 0}")
+            if event.latency_ms is not None:
+                lines.append(f"Latency: {event.latency_ms} milliseconds")
+            self._write("\n".join(lines) + "\n")
+
+    def flush(self):
+        if self._buffer:
+            self.out.write("".join(self._buffer))
+            self.out.flush()
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+        self.flush()
+
+    def _write(self, text):
+        self._buffer.append(text)
+        self.flush()
+
+# Sink that writes each event as one JSON line (with the event type and a client-side timestamp)
+class JsonlSink(StreamSink):
+
+    # Args:
+    #   out: A writable text file
+    #   record_id: Optional id added to every line (e.g. the batch record id)
+    def __init__(self, out, record_id=None):
+        self.out = out
+        self.record_id = record_id
+
+    def on_event(self, event):
+        line = {"type": type(event).__name__, "ts": time.time(), **asdict(event)}
+        if self.record_id is not None:
+            line["id"] = self.record_id
+        self.out.write(json.dumps(line) + "\n")
+
+    def close(self):
+        self.out.flush()
+
+# Sink that collects the complete response in memory
+class AccumulatorSink(StreamSink):
+    def __init__(self):
+        self.role = None
+        self.chunks = []
+        self.stop_reason = None
+        self.usage = None
+        self.latency_ms = None
+        self.cache_read_input_tokens = None
+        self.cache_write_input_tokens = None
+
+    def on_event(self, event):
+        if isinstance(event, TextDelta):
+            self.chunks.append(event.text)
+        elif isinstance(event, MessageStart):
+            self.role = event.role
+        elif isinstance(event, MessageStop):
+            self.stop_reason = event.stop_reason
+        elif isinstance(event, Metadata):
+            self.usage = event.usage
+            self.latency_ms = event.latency_ms
+            self.cache_read_input_tokens = event.cache_read_input_tokens
+            self.cache_write_input_tokens = event.cache_write_input_tokens
+
+    @property
+    def text(self):
+        return "".join(self.chunks)
+
+    # Function to return the response in the result format used by the batch runner
+    def result(self):
+        return {"output": self.text, "stop_reason": self.stop_reason, "usage": self.usage, "latency_ms": self.latency_ms,
+                "cache_read_input_tokens": self.cache_read_input_tokens,
+                "cache_write_input_tokens": self.cache_write_input_tokens}
+
+# Sink that measures the stream as seen by the client
+class MetricsSink(StreamSink):
+
+    # Args:
+    #   started: perf_counter() value when the request was sent (defaults to the sink's creation time)
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+        self.deltas = 0
+        self.characters = 0
+        self.output_tokens = None
+        self.cache_read_input_tokens = None
+        self.cache_write_input_tokens = None
+
+    def on_event(self, event):
+        if isinstance(event, TextDelta):
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            self.deltas += 1
+            self.characters += len(event.text)
+        elif isinstance(event, Metadata):
+            self.output_tokens = event.usage.get('outputTokens')
+            self.cache_read_input_tokens = event.cache_read_input_tokens
+            self.cache_write_input_tokens = event.cache_write_input_tokens
+
+    def close(self):
+        self.finished_at = time.perf_counter()
+
+    # Function to return the collected measurements
+    # Returns:
+    #   A dictionary with time to first token, total time (both in ms), delta and character counts, tokens/sec and
+    #   the prompt-cache read and write tokens
+    def summary(self):
+        end = self.finished_at or time.perf_counter()
+        total_ms = (end - self.started) * 1000
+        ttft_ms = (self.first_token_at - self.started) * 1000 if self.first_token_at else None
+        tokens_per_sec = None
+        if self.output_tokens and self.first_token_at and end > self.first_token_at:
+            tokens_per_sec = self.output_tokens / (end - self.first_token_at)
+        return {"ttft_ms": ttft_ms, "total_ms": total_ms, "deltas": self.deltas,
+                "characters": self.characters, "output_tokens": self.output_tokens, "tokens_per_sec": tokens_per_sec,
+                "cache_read_input_tokens": self.cache_read_input_tokens,
+                "cache_write_input_tokens": self.cache_write_input_tokens}
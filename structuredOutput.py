@@ -0,0 +1,292 @@
+import json
+from dataclasses import dataclass
+from typing import Any
+
+import manageConfig as mc
+from streamSinks import StopStream, StreamSink, TextDelta
+
+# A field or array element of the JSON response, emitted as soon as its value is complete
+# path: ('issue',) for a top-level field, ('causes', 0) for the first element of an array field
+@dataclass(frozen=True)
+class JsonField:
+    path: tuple
+    value: Any
+
+# Raised when the response is not valid JSON
+class JsonStreamError(ValueError):
+    pass
+
+# Parsing state of one open object or array
+class _Frame:
+    __slots__ = ('kind', 'path', 'start', 'expect', 'key', 'index')
+
+    def __init__(self, kind, path, start):
+        self.kind = kind
+        self.path = path
+        self.start = start
+        self.expect = 'key' if kind == 'object' else 'value'
+        self.key = None
+        self.index = 0
+
+# JSON parser that is fed the response text delta by delta
+# Text before the first '{' (a preamble or a ```json fence) and anything after the closing '}' is ignored. Every
+# value is parsed with json.loads once it is complete, so strings, escapes and numbers follow the JSON rules exactly;
+# the parser itself only tracks where values start and end.
+class IncrementalJsonParser:
+
+    # Args:
+    #   max_depth: Longest path that is emitted (1: top-level fields only, 2: also the elements of array fields)
+    def __init__(self, max_depth=2):
+        self.max_depth = max_depth
+        self.done = False
+        self.document = None
+        self._text = ''
+        self._pos = 0
+        self._stack = []
+        self._started = False
+        self._in_string = False
+        self._escape = False
+        self._string_is_key = False
+        self._scalar = False
+        self._token_start = None
+
+    @property
+    def started(self):
+        return self._started
+
+    # Function to parse the next piece of the response
+    # Args:
+    #   text: The text delta
+    # Returns:
+    #   A list of JsonField objects completed by this piece
+    # Raises:
+    #   JsonStreamError if the text cannot be valid JSON
+    def feed(self, text):
+        if self.done:
+            return []
+        self._text += text
+        source = self._text
+        fields = []
+        i = self._pos
+        while i < len(source) and not self.done:
+            c = source[i]
+            if not self._started:
+                if c == '{':
+                    self._started = True
+                    self._stack.append(_Frame('object', (), i))
+                i += 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    self._string_done(source, i + 1, fields)
+                i += 1
+            elif self._scalar:
+                if c in ' \t\r\n,}]':
+                    # The delimiter is processed again below as the character after the value
+                    self._scalar = False
+                    self._value_done(source, self._token_start, i, fields)
+                else:
+                    i += 1
+            else:
+                self._structural(source, i, c, fields)
+                i += 1
+        self._pos = i
+        return fields
+
+    def _structural(self, source, i, c, fields):
+        frame = self._stack[-1]
+        if c in ' \t\r\n':
+            return
+        if c == '"':
+            self._string_is_key = frame.kind == 'object' and frame.expect == 'key'
+            if not self._string_is_key:
+                self._begin_value(frame, i, c)
+            self._in_string = True
+            self._token_start = i
+        elif c in '{[':
+            self._begin_value(frame, i, c)
+            key = frame.key if frame.kind == 'object' else frame.index
+            self._stack.append(_Frame('object' if c == '{' else 'array', frame.path + (key,), i))
+        elif c in '}]':
+            if (c == '}') != (frame.kind == 'object') or frame.expect not in ('comma', 'key', 'value'):
+                self._fail(i, c)
+            self._stack.pop()
+            if not self._stack:
+                self.done = True
+                self.document = self._load(source, frame.start, i + 1)
+            else:
+                self._value_done(source, frame.start, i + 1, fields)
+        elif c == ':' and frame.expect == 'colon':
+            frame.expect = 'value'
+        elif c == ',' and frame.expect == 'comma':
+            if frame.kind == 'object':
+                frame.expect = 'key'
+            else:
+                frame.index += 1
+                frame.expect = 'value'
+        elif c in '-0123456789tfn':
+            self._begin_value(frame, i, c)
+            self._scalar = True
+            self._token_start = i
+        else:
+            self._fail(i, c)
+
+    def _begin_value(self, frame, i, c):
+        if frame.expect != 'value':
+            self._fail(i, c)
+        frame.expect = 'in-value'
+
+    def _string_done(self, source, end, fields):
+        if self._string_is_key:
+            frame = self._stack[-1]
+            frame.key = self._load(source, self._token_start, end)
+            frame.expect = 'colon'
+        else:
+            self._value_done(source, self._token_start, end, fields)
+
+    def _value_done(self, source, start, end, fields):
+        frame = self._stack[-1]
+        value = self._load(source, start, end)
+        frame.expect = 'comma'
+        path = frame.path + ((frame.key,) if frame.kind == 'object' else (frame.index,))
+        if len(path) <= self.max_depth:
+            fields.append(JsonField(path, value))
+
+    def _load(self, source, start, end):
+        try:
+            return json.loads(source[start:end])
+        except ValueError as e:
+            raise JsonStreamError(f"Invalid JSON value at offset {start}: {e}") from None
+
+    def _fail(self, i, c):
+        raise JsonStreamError(f"Unexpected {c!r} at offset {i} of the response")
+
+# Expected shape of a JSON response: field name -> str (a string) or [str] (an array of strings)
+class ResponseSchema:
+
+    # Args:
+    #   fields: A dictionary of field name to type
+    #   required: The fields that must be present (defaults to every field)
+    def __init__(self, fields, required=None):
+        self.fields = dict(fields)
+        self.required = tuple(required if required is not None else self.fields)
+
+    # Function to check one completed top-level field
+    # Returns:
+    #   An error message, or None when the field is valid
+    def validate(self, name, value):
+        expected = self.fields.get(name)
+        if expected is None:
+            return f"Unexpected field {name}"
+        if isinstance(expected, list):
+            if not isinstance(value, list) or not all(isinstance(item, expected[0]) for item in value):
+                return f"Field {name} should be a list of {expected[0].__name__}"
+        elif not isinstance(value, expected):
+            return f"Field {name} should be a {expected.__name__}"
+        return None
+
+    def missing(self, document):
+        return [name for name in self.required if name not in document]
+
+# The triage answer prompt.txt and system.txt ask for
+TRIAGE_SCHEMA = ResponseSchema({
+    "issue": str,
+    "causes": [str],
+    "impact": str,
+    "troubleshooting": [str],
+    "prevention": [str],
+})
+
+# Settings from the optional [structured] section
+# Keys: Enabled, Required (comma separated fields that must be present, default: every field of the schema),
+# StopEarly (stop reading the stream once every required field has arrived)
+@dataclass(frozen=True)
+class StructuredSettings:
+    enabled: bool = False
+    stop_early: bool = True
+    schema: ResponseSchema = TRIAGE_SCHEMA
+
+# Function to read the [structured] section
+def get_structured_settings():
+    required = mc.getValueOrDefault('structured', 'Required', '')
+    schema = TRIAGE_SCHEMA
+    if required:
+        schema = ResponseSchema(TRIAGE_SCHEMA.fields, [name.strip() for name in required.split(',') if name.strip()])
+    return StructuredSettings(enabled=mc.getValueOrDefault('structured', 'Enabled', 'false') == 'true',
+                              stop_early=mc.getValueOrDefault('structured', 'StopEarly', 'true') == 'true',
+                              schema=schema)
+
+# Sink that parses the JSON answer while it streams
+# Every completed field and array element is passed to on_field as a JsonField. With stop_early, the sink raises
+# StopStream once the required fields are in (or the object is closed), so consume() stops reading and the model
+# stops generating; trailing prose after the JSON is never paid for.
+class StructuredResponseSink(StreamSink):
+
+    # Args:
+    #   schema: The ResponseSchema to validate against
+    #   on_field: Optional callable receiving each JsonField
+    #   stop_early: Stop the stream once every required field has arrived
+    def __init__(self, schema=TRIAGE_SCHEMA, on_field=None, stop_early=True):
+        self.schema = schema
+        self.on_field = on_field
+        self.stop_early = stop_early
+        self.parser = IncrementalJsonParser()
+        self.document = {}
+        self.errors = []
+        self.stopped_early = False
+        self._failed = False
+
+    # Function to parse a text delta
+    # Returns:
+    #   The JsonField objects completed by the delta; once stop_early applies, stopped_early is set and later
+    #   deltas are ignored
+    def feed(self, text):
+        if self._failed or self.stopped_early or self.parser.done:
+            return []
+        try:
+            fields = self.parser.feed(text)
+        except JsonStreamError as e:
+            self._failed = True
+            self.errors.append(str(e))
+            return []
+        for field in fields:
+            if len(field.path) == 1:
+                name = field.path[0]
+                self.document[name] = field.value
+                error = self.schema.validate(name, field.value)
+                if error:
+                    self.errors.append(error)
+            if self.on_field is not None:
+                self.on_field(field)
+        if self.stop_early and (self.parser.done or not self.schema.missing(self.document)):
+            self.stopped_early = True
+        return fields
+
+    def on_event(self, event):
+        if isinstance(event, TextDelta):
+            self.feed(event.text)
+            if self.stopped_early:
+                raise StopStream()
+
+    @property
+    def complete(self):
+        return not self.schema.missing(self.document)
+
+    # Function to return the parsed answer and its validation result
+    def result(self):
+        missing = self.schema.missing(self.document)
+        errors = self.errors if self.parser.started else self.errors + ["No JSON object in the response"]
+        return {"fields": self.document, "valid": not missing and not errors, "missing": missing, "errors": errors,
+                "stopped_early": self.stopped_early}
+
+# Function to parse and validate a complete answer (from Converse, or a stream read to the end)
+# Returns:
+#   The same dictionary as StructuredResponseSink.result()
+def parse_response(text, schema=TRIAGE_SCHEMA):
+    sink = StructuredResponseSink(schema, stop_early=False)
+    sink.feed(text)
+    return sink.result()
@@ -0,0 +1,43 @@
+import datetime
+import threading
+
+import creds
+
+# Credential provider whose STS calls are answered locally; a refresh can be held until the test lets it finish
+class LocalProvider(creds.AssumeRoleCredentialProvider):
+
+    def __init__(self):
+        super().__init__(refresh_margin=300)
+        self.calls = 0
+        self.hold = None
+
+    def _assume_role(self, entry):
+        self.calls += 1
+        if self.hold is not None:
+            self.hold.wait()
+        expiry = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=900)
+        return {"access_key": "AKIA", "secret_key": "secret", "token": "token", "expiry_time": expiry.isoformat()}
+
+def test_role_session_is_shared():
+    provider = LocalProvider()
+    try:
+        session = provider.get_session('arn:aws:iam::123456789012:role/r', 's')
+        assert provider.get_session('arn:aws:iam::123456789012:role/r', 's') is session
+        assert session.get_credentials() is provider.get_credentials('arn:aws:iam::123456789012:role/r', 's')
+        assert provider.calls == 1
+    finally:
+        provider.clear()
+
+def test_clear_stops_a_refresh_that_is_running_from_rescheduling():
+    provider = LocalProvider()
+    provider.get_credentials('arn:aws:iam::123456789012:role/r', 's')
+    entry = next(iter(provider._entries.values()))
+    scheduled = entry["timer"]
+    provider.hold = threading.Event()
+    refresh = threading.Thread(target=provider._refresh, args=(entry,))
+    refresh.start()
+    provider.clear()
+    provider.hold.set()
+    refresh.join()
+    assert entry["timer"] is scheduled and not scheduled.is_alive()
+    assert provider._entries == {}
@@ -0,0 +1,43 @@
+import pytest
+from botocore.exceptions import ClientError
+
+import bedrockclient as bd
+import endpointPool
+
+EVENTS = [{'contentBlockDelta': {'contentBlockIndex': 0, 'delta': {'text': 'ok'}}},
+          {'messageStop': {'stopReason': 'end_turn'}}]
+
+# Runtime client stand-in that records the endpoints it was called on
+class RecordingClient:
+
+    def __init__(self, url, calls, error=None):
+        self.url = url
+        self.calls = calls
+        self.error = error
+
+    def converse_stream(self, **request):
+        self.calls.append(self.url)
+        if self.error is not None:
+            raise self.error
+        return {'stream': iter(EVENTS)}
+
+def make_pool(monkeypatch, calls, error=None):
+    monkeypatch.setattr(bd, 'get_pooled_runtime_client', lambda url, region=None: RecordingClient(url, calls, error))
+    return endpointPool.EndpointPool([endpointPool.Endpoint('a', 'a', 'us-west-2'),
+                                      endpointPool.Endpoint('b', 'b', 'us-west-2')], health_check_interval=0)
+
+def test_stream_closed_before_reading_releases_its_endpoint(monkeypatch):
+    pool = make_pool(monkeypatch, [])
+    pool.converse_stream(modelId='m')['stream'].close()
+    assert [endpoint['outstanding'] for endpoint in pool.stats()] == [0, 0]
+
+def test_throttling_is_not_failed_over(monkeypatch):
+    calls = []
+    throttled = ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'slow down'}}, 'ConverseStream')
+    pool = make_pool(monkeypatch, calls, throttled)
+    with pytest.raises(ClientError):
+        pool.converse_stream(modelId='m')
+    # The throttle is left to the resilience controller's backoff instead of being sent to the other endpoint
+    assert len(calls) == 1
+    assert [endpoint['outstanding'] for endpoint in pool.stats()] == [0, 0]
+    assert all(endpoint['healthy'] for endpoint in pool.stats())
@@ -0,0 +1,96 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import bedrockclient as bd
+import endpointPool
+import hedging
+import requestScheduler
+import resilience
+import responseCache
+
+# Runtime client stand-in whose first call waits for response headers longer than the hedge delay
+class SlowFirstCallClient:
+    calls = 0
+    lock = threading.Lock()
+
+    def __init__(self, url):
+        self.url = url
+
+    def converse_stream(self, **request):
+        with SlowFirstCallClient.lock:
+            SlowFirstCallClient.calls += 1
+            first = SlowFirstCallClient.calls == 1
+        if first:
+            time.sleep(0.5)
+        events = [{'messageStart': {'role': 'assistant'}},
+                  {'contentBlockDelta': {'contentBlockIndex': 0, 'delta': {'text': self.url}}},
+                  {'messageStop': {'stopReason': 'end_turn'}},
+                  {'metadata': {'usage': {'inputTokens': 1, 'outputTokens': 1, 'totalTokens': 2}}}]
+        return {'stream': iter(events)}
+
+def test_copy_cancelled_during_its_call_restores_pool_breaker_and_scheduler(monkeypatch):
+    monkeypatch.setattr(bd, 'get_client_config', lambda: None)
+    monkeypatch.setattr(bd, 'get_pooled_runtime_client', lambda url, region=None: SlowFirstCallClient(url))
+    pool = endpointPool.EndpointPool([endpointPool.Endpoint('a', 'a', 'us-west-2'),
+                                      endpointPool.Endpoint('b', 'b', 'us-west-2')], health_check_interval=0)
+    controller = resilience.ResilienceController()
+    scheduler = requestScheduler.RequestScheduler(requestScheduler.DEFAULT_CLASSES, 4, 'interactive', {})
+    hedger = hedging.Hedger(initial_delay=0.1, budget_ratio=1, budget_burst=1)
+    monkeypatch.setattr(resilience, 'get_controller', lambda: controller)
+    monkeypatch.setattr(requestScheduler, 'get_scheduler', lambda: scheduler)
+    monkeypatch.setattr(hedging, 'get_hedger', lambda: hedger)
+    request = {'modelId': 'anthropic.claude-3-haiku-20240307-v1:0', 'messages': [],
+               'inferenceConfig': {'maxTokens': 10, 'temperature': 0.5}}
+    try:
+        stream, cached = responseCache.converse_stream_cached(pool, request, scheduler.ticket('interactive'))
+        events = list(stream)
+        stream.close()
+        # The hedge answered while the original was still waiting for its response headers
+        assert not cached
+        assert len(events) == 4
+        assert hedger.stats()['hedge_wins'] == 1
+
+        # The cancelled original is closed by its thread once its call returns
+        time.sleep(0.8)
+        assert [endpoint['outstanding'] for endpoint in pool.stats()] == [0, 0]
+        for key in (request['modelId'], pool.meta.endpoint_url):
+            breaker = controller.breaker(key)
+            assert breaker.state == 'closed' and not breaker._trial_in_flight
+        assert scheduler.stats()['active'] == 0
+    finally:
+        scheduler.close()
+        SlowFirstCallClient.calls = 0
+
+def test_stream_closed_before_reading_settles_half_open_breaker():
+    controller = resilience.ResilienceController(failure_threshold=1, reset_seconds=0.01)
+    runtime = SimpleNamespace(meta=SimpleNamespace(endpoint_url='x'),
+                              converse_stream=lambda **request: {'stream': iter([])})
+    breaker = controller.breaker('m')
+    breaker.record_failure()
+    time.sleep(0.02)
+    controller.converse_stream(runtime, {'modelId': 'm'}).close()
+    assert breaker.state == 'closed' and not breaker._trial_in_flight
+
+def test_wait_for_rate_limit_slot_does_not_count_towards_hedge_delay(monkeypatch):
+    controller = resilience.ResilienceController()
+    def slow_admit(model_id, request):
+        time.sleep(0.3)
+        return 0
+    monkeypatch.setattr(controller, 'admit', slow_admit)
+    events = [{'contentBlockDelta': {'contentBlockIndex': 0, 'delta': {'text': 'ok'}}},
+              {'messageStop': {'stopReason': 'end_turn'}}]
+    runtime = SimpleNamespace(meta=SimpleNamespace(endpoint_url='x'),
+                              converse_stream=lambda **request: {'stream': iter(events)})
+    hedger = hedging.Hedger(initial_delay=0.1, budget_ratio=1, budget_burst=1)
+    stream = hedger.stream(runtime, {'modelId': 'm'}, controller.converse_stream)
+    assert list(stream) == events
+    stream.close()
+    stats = hedger.stats()
+    assert stats['hedged'] == 0
+    # The time to first token is measured from admission, without the 0.3s spent waiting for the slot
+    assert hedger._latency['m'].percentile(100) < 0.3
+
+def test_hedged_stream_whose_init_failed_can_be_collected():
+    stream = hedging._HedgedStream.__new__(hedging._HedgedStream)
+    stream.__del__()
@@ -0,0 +1,18 @@
+import pytest
+
+import invokeServer
+
+@pytest.mark.parametrize('body', [b'[]', b'"text"', b'{"model": 5}', b'{"model": "m.x", "variables": ["a"]}',
+                                  b'{"model": "m.x", "timeout": "soon"}', b'{"model": "m.x", "timeout": true}',
+                                  b'{"model": "m.x", "timeout": -1}', b'{"model": "m.x", "stream": "false"}'])
+def test_malformed_invoke_body_is_a_client_error(body):
+    server = invokeServer.InvokeServer()
+    with pytest.raises(invokeServer.HttpError) as error:
+        server._build_request({}, body)
+    assert error.value.status == 400
+
+def test_missing_template_variable_is_a_client_error():
+    server = invokeServer.InvokeServer()
+    with pytest.raises(invokeServer.HttpError) as error:
+        server._build_request({}, b'{"model": "m.x", "variables": {}}')
+    assert error.value.status == 400 and 'log_entry' in error.value.message
@@ -0,0 +1,6 @@
+from promptTemplate import PromptTemplate
+
+def test_placeholder_without_value_is_left_as_written():
+    template = PromptTemplate("Entry: {{log_entry}}\nHost: {{ host }}")
+    assert template.render(log_entry="boom") == "Entry: boom\nHost: {{ host }}"
+    assert template.missing(log_entry="boom") == ["host"]
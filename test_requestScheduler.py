@@ -0,0 +1,15 @@
+import requestScheduler
+
+def test_stream_closed_before_reading_returns_its_slot(monkeypatch):
+    scheduler = requestScheduler.RequestScheduler(requestScheduler.DEFAULT_CLASSES, 1, 'interactive', {})
+    monkeypatch.setattr(requestScheduler, 'get_scheduler', lambda: scheduler)
+    request = {'modelId': 'm', 'messages': []}
+    try:
+        for _ in range(2):
+            # With one slot, the second call would wait forever if the first stream kept its slot
+            stream = requestScheduler.scheduled_stream(scheduler.ticket('interactive', timeout=1), request,
+                                                       lambda: iter([]))
+            stream.close()
+            assert scheduler.stats()['active'] == 0
+    finally:
+        scheduler.close()
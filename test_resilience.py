@@ -0,0 +1,49 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import resilience
+import tokenBudget
+
+def test_half_open_model_trial_is_released_when_endpoint_circuit_is_open():
+    controller = resilience.ResilienceController(failure_threshold=1, reset_seconds=0.01)
+    runtime = SimpleNamespace(meta=SimpleNamespace(endpoint_url='x'),
+                              converse_stream=lambda **request: {'stream': iter([])})
+    model_breaker = controller.breaker('m')
+    model_breaker.record_failure()
+    time.sleep(0.02)
+    endpoint_breaker = controller.breaker('x')
+    endpoint_breaker.reset_seconds = 60
+    endpoint_breaker.record_failure()
+
+    with pytest.raises(resilience.CircuitOpenError):
+        controller.converse_stream(runtime, {'modelId': 'm'})
+    assert model_breaker.state == 'half-open' and not model_breaker._trial_in_flight
+
+    # Once the endpoint recovers, the model's trial call can still be made
+    endpoint_breaker.record_success()
+    controller.converse_stream(runtime, {'modelId': 'm'}).close()
+    assert model_breaker.state == 'closed'
+
+def test_stream_error_codes_compare_like_client_error_codes():
+    error = SimpleNamespace(response={'Error': {'Code': 'throttlingException'}})
+    assert resilience.error_code(error) == 'ThrottlingException'
+    assert resilience.error_code(error) in resilience.RETRYABLE_ERRORS
+
+def test_stream_stopped_early_settles_reservation_with_text_received(monkeypatch):
+    controller = resilience.ResilienceController(limits={'Default': (600, 100000)})
+    settled = []
+    monkeypatch.setattr(controller, 'settle', lambda model_id, reserved, usage: settled.append((reserved, usage)))
+    events = [{'contentBlockDelta': {'contentBlockIndex': 0, 'delta': {'text': 'hello world'}}},
+              {'contentBlockDelta': {'contentBlockIndex': 0, 'delta': {'text': ' and more'}}}]
+    runtime = SimpleNamespace(meta=SimpleNamespace(endpoint_url='x'),
+                              converse_stream=lambda **request: {'stream': iter(events)})
+    request = {'modelId': 'm', 'messages': [{'role': 'user', 'content': [{'text': 'hi'}]}],
+               'inferenceConfig': {'maxTokens': 100}}
+    stream = controller.converse_stream(runtime, request)
+    next(stream)
+    stream.close()
+    reserved = resilience.estimate_request_tokens(request)
+    # The unused output part of the reservation is returned; the input part and the text received are kept
+    assert settled == [(reserved, {'totalTokens': reserved - 100 + tokenBudget.estimate_tokens('hello world', 'm')})]
@@ -0,0 +1,21 @@
+import io
+import json
+
+from streamSinks import AccumulatorSink, JsonlSink, MetricsSink, TerminalSink, consume, parse_events
+
+def test_prompt_cache_tokens_reach_every_sink():
+    usage = {'inputTokens': 10, 'outputTokens': 2, 'totalTokens': 12,
+             'cacheReadInputTokens': 900, 'cacheWriteInputTokens': 0}
+    events = [{'messageStart': {'role': 'assistant'}},
+              {'contentBlockDelta': {'contentBlockIndex': 0, 'delta': {'text': 'ok'}}},
+              {'messageStop': {'stopReason': 'end_turn'}},
+              {'metadata': {'usage': usage, 'metrics': {'latencyMs': 120}}}]
+    terminal_out, jsonl_out = io.StringIO(), io.StringIO()
+    terminal, jsonl, accumulator, timing = consume(
+        parse_events(events), [TerminalSink(terminal_out), JsonlSink(jsonl_out), AccumulatorSink(), MetricsSink()])
+
+    assert "Cache read input tokens: 900" in terminal_out.getvalue()
+    metadata = json.loads(jsonl_out.getvalue().splitlines()[-1])
+    assert (metadata['cache_read_input_tokens'], metadata['cache_write_input_tokens']) == (900, 0)
+    assert (accumulator.result()['cache_read_input_tokens'], accumulator.result()['cache_write_input_tokens']) == (900, 0)
+    assert (timing.summary()['cache_read_input_tokens'], timing.summary()['cache_write_input_tokens']) == (900, 0)
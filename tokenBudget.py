@@ -0,0 +1,247 @@
+import math
+import re
+from dataclasses import dataclass
+
+import manageConfig as mc
+import modelRegistry
+from logging_setup import get_logger
+
+# Set up logging configuration (shared, non-blocking pipeline)
+logger = get_logger(__name__)
+
+# Tokenizer profile of each model provider: (average characters per token in a run of letters, digits per token)
+# Rough averages for English text and nginx/syslog lines, chosen so the estimate errs on the high side
+TOKENIZER_PROFILES = {
+    'anthropic': (4.0, 1),
+    'meta': (4.5, 3),
+    'mistral': (3.5, 1),
+    'amazon': (4.0, 1),
+}
+
+# Profile used for a provider that is not in the table
+DEFAULT_TOKENIZER_PROFILE = (3.5, 1)
+
+# Runs of letters, runs of digits, runs of punctuation and line breaks; other whitespace is folded into the
+# following token by every tokenizer above and is not counted
+_PIECES = re.compile(r'[^\W\d_]+|\d+|\n+|[^\w\s]+|_+')
+
+# Timestamps at the start of common log formats (nginx error log, ISO 8601, syslog)
+_TIMESTAMP = re.compile(r'\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2}'
+                        r'|\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?'
+                        r'|[A-Z][a-z]{2} [ \d]\d \d{2}:\d{2}:\d{2}')
+
+# Parts of a log line that change between occurrences of the same event: timestamps, IP addresses (with port),
+# hex values and numbers (pids, connection ids, byte counts)
+_VARIABLE_PARTS = re.compile(_TIMESTAMP.pattern + r'|\b(?:\d{1,3}\.){3}\d{1,3}(?::\d+)?\b|\b0x[0-9a-fA-F]+\b|\d+')
+
+# Function to return the tokenizer profile of a model
+def tokenizer_profile(model_id=None):
+    if not model_id:
+        return DEFAULT_TOKENIZER_PROFILE
+    provider = modelRegistry.base_model_id(model_id).partition('.')[0]
+    return TOKENIZER_PROFILES.get(provider, DEFAULT_TOKENIZER_PROFILE)
+
+# Function to estimate the number of tokens in a text without calling the service
+# Args:
+#   text: The text
+#   model_id: The model whose tokenizer is approximated (None uses the default profile)
+# Returns:
+#   The estimated token count
+def estimate_tokens(text, model_id=None):
+    if not text:
+        return 0
+    chars_per_token, digits_per_token = tokenizer_profile(model_id)
+    tokens = 0
+    for piece in _PIECES.findall(text):
+        first = piece[0]
+        if first.isalpha():
+            tokens += math.ceil(len(piece) / chars_per_token)
+        elif first.isdigit():
+            tokens += math.ceil(len(piece) / digits_per_token)
+        elif first == '\n':
+            tokens += 1
+        else:
+            # Common punctuation pairs such as '",' or '()' are usually a single token
+            tokens += math.ceil(len(piece) / 2)
+    return tokens
+
+# Function to return the signature of a log line: the line with its variable parts replaced by '#'
+def log_signature(line):
+    return _VARIABLE_PARTS.sub('#', line.strip())
+
+# All occurrences of one log event
+class LogGroup:
+
+    # Args:
+    #   signature: The log_signature shared by the occurrences
+    #   line: The first occurrence, sent to the model as the representative
+    def __init__(self, signature, line):
+        self.signature = signature
+        self.line = line
+        self.count = 1
+        timestamp = _TIMESTAMP.search(line)
+        self.first_seen = self.last_seen = timestamp.group(0) if timestamp else None
+
+    def add(self, line):
+        self.count += 1
+        timestamp = _TIMESTAMP.search(line)
+        if timestamp:
+            self.last_seen = timestamp.group(0)
+            self.first_seen = self.first_seen or self.last_seen
+
+    # Function to render the group as it is sent to the model
+    def render(self):
+        if self.count == 1:
+            return self.line
+        span = f" between {self.first_seen} and {self.last_seen}" if self.first_seen != self.last_seen else ""
+        return f"{self.line}\n(repeated {self.count} times{span})"
+
+# Function to split a log into entries and group the entries that have the same signature
+# Lines that start with whitespace (stack traces, wrapped messages) belong to the entry before them.
+# Args:
+#   text: The log text
+#   deduplicate: Group identical signatures; when False every entry is its own group
+# Returns:
+#   A list of LogGroup objects in order of first occurrence
+def group_log_lines(text, deduplicate=True):
+    entries = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        if entries and line[0] in ' \t':
+            entries[-1] += "\n" + line
+        else:
+            entries.append(line)
+    groups = {}
+    ordered = []
+    for entry in entries:
+        signature = log_signature(entry) if deduplicate else len(ordered)
+        group = groups.get(signature)
+        if group is None:
+            group = groups[signature] = LogGroup(signature, entry)
+            ordered.append(group)
+        else:
+            group.add(entry)
+    return ordered
+
+# Function to pack rendered groups into chunks that each fit a token budget
+# Groups keep their order; a single group larger than the budget is cut to fit and marked as truncated.
+# Args:
+#   groups: LogGroup objects
+#   budget_tokens: Tokens available for the content of one chunk
+#   model_id: The model whose tokenizer is approximated
+# Returns:
+#   A list of (text, groups) pairs, one per chunk
+def pack_groups(groups, budget_tokens, model_id=None):
+    chunks = []
+    lines, members, used = [], [], 0
+    for group in groups:
+        text = group.render()
+        # The line break that joins the group to the chunk is one token
+        tokens = estimate_tokens(text, model_id) + 1
+        if tokens > budget_tokens:
+            text = truncate_to_tokens(text, budget_tokens - 1, model_id)
+            tokens = budget_tokens
+        if lines and used + tokens > budget_tokens:
+            chunks.append(("\n".join(lines), members))
+            lines, members, used = [], [], 0
+        lines.append(text)
+        members.append(group)
+        used += tokens
+    if lines:
+        chunks.append(("\n".join(lines), members))
+    return chunks
+
+# Function to cut a text so its estimate fits a token count, marking the cut
+def truncate_to_tokens(text, max_tokens, model_id=None):
+    marker = " ...[truncated]"
+    budget = max_tokens - estimate_tokens(marker, model_id)
+    low, high = 0, len(text)
+    # Binary search on the length; the estimate grows monotonically with the prefix length
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle], model_id) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + marker
+
+# One request produced by the packer
+@dataclass(frozen=True)
+class PackedPrompt:
+    user_prompt: str
+    max_tokens: int
+    input_tokens: int
+    entries: int
+    groups: int
+
+# Settings of the packer from the optional [budget] section
+# Keys: Enabled, Deduplicate, ReservedOutputTokens (output room kept when chunking), MaxOutputTokens and
+# MaxInputTokens (optional caps below the model limits), SafetyMargin (fraction added to every estimate)
+@dataclass(frozen=True)
+class BudgetSettings:
+    enabled: bool = False
+    deduplicate: bool = True
+    reserved_output_tokens: int = 1000
+    max_output_tokens: int = 0
+    max_input_tokens: int = 0
+    safety_margin: float = 0.1
+
+# Function to read the [budget] section
+def get_budget_settings():
+    def number(key, default, convert=int):
+        value = mc.getValueOrDefault('budget', key, '')
+        return convert(value) if value else default
+
+    return BudgetSettings(
+        enabled=mc.getValueOrDefault('budget', 'Enabled', 'false') == 'true',
+        deduplicate=mc.getValueOrDefault('budget', 'Deduplicate', 'true') == 'true',
+        reserved_output_tokens=number('ReservedOutputTokens', 1000),
+        max_output_tokens=number('MaxOutputTokens', 0),
+        max_input_tokens=number('MaxInputTokens', 0),
+        safety_margin=number('SafetyMargin', 0.1, float),
+    )
+
+# Function to turn a (possibly very large) log into prompts that fit the model's context window
+# The fixed part of every request (system prompt and template) is estimated once; the log is grouped, packed into
+# the remaining input budget, and every prompt gets the maxTokens left over in the context window (capped by the
+# model's output limit and MaxOutputTokens).
+# Args:
+#   spec: The ModelSpec of the model
+#   system_prompt: The system prompt text
+#   template: The compiled prompt template; the log is substituted for {{log_entry}}
+#   content: The log text
+#   settings: BudgetSettings (defaults to the [budget] section)
+#   variables: Values for any other placeholders in the template
+# Returns:
+#   A list of PackedPrompt objects, one per request
+# Raises:
+#   modelRegistry.UnsupportedModelOption if the system prompt and template alone do not fit
+def pack_prompts(spec, system_prompt, template, content, settings=None, **variables):
+    settings = settings or get_budget_settings()
+    margin = 1 + settings.safety_margin
+    output_limit = min(spec.max_tokens, settings.max_output_tokens or spec.max_tokens)
+    input_limit = spec.context_window - min(settings.reserved_output_tokens, output_limit)
+    if settings.max_input_tokens:
+        input_limit = min(input_limit, settings.max_input_tokens)
+
+    fixed_tokens = estimate_tokens(system_prompt, spec.model_id) + \
+        estimate_tokens(template.render(log_entry='', **variables), spec.model_id)
+    content_budget = int(input_limit / margin) - fixed_tokens
+    if content_budget <= 0:
+        raise modelRegistry.UnsupportedModelOption(
+            f"The system prompt and template need about {fixed_tokens} tokens, more than the {input_limit} input "
+            f"tokens available for {spec.model_id}")
+
+    groups = group_log_lines(content, settings.deduplicate)
+    chunks = pack_groups(groups, content_budget, spec.model_id) or [("", [])]
+    prompts = []
+    for text, members in chunks:
+        user_prompt = template.render(log_entry=text, **variables)
+        input_tokens = estimate_tokens(system_prompt, spec.model_id) + estimate_tokens(user_prompt, spec.model_id)
+        max_tokens = max(1, min(output_limit, spec.context_window - math.ceil(input_tokens * margin)))
+        prompts.append(PackedPrompt(user_prompt, max_tokens, input_tokens, sum(g.count for g in members),
+                                    len(members)))
+    logger.info(f"Packed {sum(p.entries for p in prompts)} log entries into {len(prompts)} request(s) for "
+                f"{spec.model_id}")
+    return prompts